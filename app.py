@@ -1,28 +1,57 @@
-from io import BytesIO
-import os, io
+import os, io, re
+import struct
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from functools import wraps
 from typing import Dict, Tuple, List, Union, Set
 from datetime import datetime
+import hashlib
+import hmac
+import time
+import urllib.parse
 
 import settings
 
 # web framework
+import click
 import flask
 from flask.helpers import url_for
 from flask import abort
+from werkzeug.wsgi import ClosingIterator
 
 # Google authentication
 import google.oauth2.credentials
-import googleapiclient.discovery
-from googleapiclient.http import MediaIoBaseDownload
 import google_auth_oauthlib.flow
 
+import compressedVariants
+import cpuBound
+import curveColumns
+import curveSummary
+import datasetList
+import drivePool
+import fileCache
+import folderAccess
+import jobs
+import labelRuns
+import metrics
+import prefetch
+import singleFlight
+import storage
+import thumbnails
+from storage import StorageBackend
+from pathIndex import PathIndex
+
 # various json manipulation
 import json
 
 SCOPES = ["https://www.googleapis.com/auth/drive.readonly"]
 app = flask.Flask(__name__)
 app.secret_key = settings.FLASK_SECRET_KEY
+jobQueue = jobs.JobQueue(settings.JOB_WORKERS)
+pathIndex = PathIndex(os.path.join(settings.DATABASE_FOLDER, 'pathIndex.sqlite'), settings.PATH_INDEX_TTL, settings.PATH_INDEX_CHANGES_POLL_INTERVAL)
+accessIndex = folderAccess.FolderAccess(os.path.join(settings.DATABASE_FOLDER, 'folderAccess.sqlite'), settings.FOLDER_ACCESS_TTL, settings.FOLDER_ACCESS_DENIED_TTL)
+# sharing changes of a folder show up as changes of the folder, but only in the feeds of users polling it (see pathIndex.py);
+# otherwise FOLDER_ACCESS_TTL bounds how long a revoked user keeps access
+pathIndex.changeListeners.append(accessIndex.revokeFolders)
 
 @app.route('/auth')
 def auth():
@@ -39,14 +68,67 @@ def authRequired(f):
     def decorated_function(*args, **kwargs):
         # flask.session.clear()
         print('@authRequired')
-        flask.session['allowAccessToAll'] = shouldAllowAccessToAll(kwargs)
-        if not credentialsValid() and not flask.session['allowAccessToAll']:
+        with metrics.timed(metrics.authSeconds, 'auth'):
+            flask.session['allowAccessToAll'] = shouldAllowAccessToAll(kwargs)
+            allowed = credentialsValid() or flask.session['allowAccessToAll']
+            if allowed and 'folderId' in kwargs and not flask.session['allowAccessToAll'] and not isAdminRequest():
+                # cached files are served without storage calls, so the storage permissions are checked here
+                if not mayReadFolder(kwargs['folderId']):
+                    abort(403)
+        if not allowed:
             print('credentials')
             flask.session['nextUrl'] = flask.request.url
             return flask.redirect(url_for('auth'))
         return f(*args, **kwargs)
     return decorated_function
 
+@app.before_request
+def startRequestTimer():
+    flask.g.requestStart = time.perf_counter()
+    metrics.beginRequest()
+
+@app.before_request
+def hideCache():
+    '''static/cache is only served through sendCacheFile, after authRequired checked the folder.'''
+    if flask.request.endpoint == 'static':
+        filename = os.path.normpath(flask.request.view_args.get('filename', ''))
+        if filename.split(os.sep)[0] == 'cache':
+            abort(404)
+
+@app.after_request
+def recordRequestTime(response: flask.Response) -> flask.Response:
+    seconds = time.perf_counter() - flask.g.requestStart
+    timings = metrics.endRequest()
+    endpoint = flask.request.endpoint or 'unmatched'
+    metrics.requestSeconds.observe(seconds, endpoint=endpoint, status=response.status_code)
+    if settings.SLOW_REQUEST_SECONDS > 0 and seconds > settings.SLOW_REQUEST_SECONDS:
+        metrics.slowRequests.inc(endpoint=endpoint)
+        # the query string is left out, it may carry the admin token
+        print('SLOW REQUEST', flask.request.method, flask.request.path, response.status_code, '{:.3f}s'.format(seconds),
+            ' '.join('{}={}x/{:.3f}s'.format(kind, count, total) for kind, (count, total) in sorted(timings.items())))
+    return response
+
+def adminRequired(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not isAdminRequest():
+            abort(403)
+        return f(*args, **kwargs)
+    return decorated_function
+
+def isAdminRequest() -> bool:
+    # admin routes are disabled unless ADMIN_TOKEN is configured
+    token = flask.request.headers.get('X-Admin-Token', flask.request.args.get('adminToken', ''))
+    return bool(settings.ADMIN_TOKEN) and hmac.compare_digest(token, settings.ADMIN_TOKEN)
+
+def mayReadFolder(folderId: str) -> bool:
+    '''Whether the signed in user may read folderId, asking storage only when no recent decision is remembered.'''
+    try:
+        return accessIndex.isAllowed(folderAccess.userKey(flask.session['credentials']), folderId, getStorage())
+    except Exception as e:
+        print('ERROR: Failed to check access to', folderId, e)
+        abort(502)
+
 def shouldAllowAccessToAll(args) -> bool:
     if 'folderId' in args and args['folderId'] == settings.DEMO_ID:
         return True
@@ -93,7 +175,7 @@ def getDatasetConfig(datasetId: str) -> str:
     cachePath = './static/cache/datasetList'
     filePath = cachePath + '/' + datasetId + ".json"
     if os.path.exists(filePath):
-        return flask.redirect(filePath[1:]) # don't want '.' here
+        return sendCacheFile(filePath, 'application/json', 'private, no-cache')
 
     return "{}"
 
@@ -103,323 +185,774 @@ def getDatasetList() -> str:
     cachePath = './static/cache/datasetList'
     filePath = cachePath + '/derived/combined.json'
     if os.path.exists(filePath):
-        return flask.redirect(filePath[1:]) # don't want '.' here
+        return sendCacheFile(filePath, 'application/json', 'private, no-cache')
     return "{}"
 
+@app.route('/data/datasets.json')
+@authRequired
+def searchDatasets():
+    '''
+    One page of the dataset list, e.g.
+    ?q=mcf7 drug&author=Jane&folder=Data/2020/&modifiedFrom=2020-01-01&modifiedTo=2020-12-31
+    &minSize=1&maxSize=500&sort=fileSize&order=asc&page=2&pageSize=50
+    q words all have to be in displayName, author repeats, folder is a prefix, sizes are MB.
+    '''
+    args = flask.request.args
+    # the catalog only changes with a rebuild, so its version and the query identify the answer
+    etag = '{}-{}'.format(datasetList.catalog.version(), hashlib.md5(flask.request.query_string).hexdigest()[:16])
+    if etag in flask.request.if_none_match:
+        response = flask.Response(status=304)
+    else:
+        try:
+            page, pageSize = int(args.get('page', 1)), int(args.get('pageSize', 50))
+            total, datasets = datasetList.catalog.search(
+                text=args.get('q', None),
+                authors=args.getlist('author'),
+                folder=args.get('folder', None),
+                modifiedFrom=args.get('modifiedFrom', None),
+                modifiedTo=args.get('modifiedTo', None),
+                minSize=float(args['minSize']) if 'minSize' in args else None,
+                maxSize=float(args['maxSize']) if 'maxSize' in args else None,
+                sort=args.get('sort', 'modifiedDate'),
+                descending=args.get('order', 'desc') != 'asc',
+                page=page,
+                pageSize=pageSize)
+        except ValueError as e:
+            abort(400, str(e))
+        result = dict(datasetList.catalog.facets(), total=total, page=page, pageSize=pageSize, datasetList=datasets)
+        response = flask.jsonify(result)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
 @app.route('/data/update_dataset_list')
 @authRequired
-def updateDataSpecList() -> str:
-    credentials = google.oauth2.credentials.Credentials(**flask.session['credentials'])
-    service: googleapiclient.discovery.Resource = googleapiclient.discovery.build('drive', 'v3', credentials=credentials)
-    query = "name = '.vizMetaData'"
-    responseFields = "nextPageToken, files(id, parents, modifiedTime, owners)"
-    results = service.files().list(q=query, fields=responseFields, pageSize=1000).execute()
-    candidateFiles = results.get('files', [])
-    print('Number of .vizMetaDataFolders:', len(candidateFiles))
-    skipCount = 0
-    filenameSet = set()
-    textLines = []
-    for index, candidateFile in enumerate(candidateFiles):
-        print('Building: {}/{}'.format(index+1, len(candidateFiles)))
-        folderId = candidateFile['id']
-        print('\t' + candidateFile['id'])
-        dataSpecObj, msg = getDataSpecObj(service, candidateFile)
-        print('dataSpecObj', dataSpecObj)
-        if dataSpecObj is None:
-            textLines.append('FAIL (' + msg + ') - ' + folderId)
-            skipCount += 1
-            continue
-        filename = dataSpecObj['uniqueId']
-        if filename in filenameSet:
-            textLines.append('FAIL (duplicate filename[' + filename + ']) - ' + folderId)
-            # Google allows two file of the same name in a folder.
-            # I do not.
-            continue
-        textLines.append('PASS - ' + folderId)
-        filenameSet.add(filename)
-        filename = './static/cache/datasetList/' + filename + '.json'
-        print('open file:', filename)
-        dataSpecFile = open(filename, 'w')
-        writeToFile = json.dumps(dataSpecObj)
-        print('write to file', writeToFile)
-        dataSpecFile.write(writeToFile)
-        dataSpecFile.close()
-    print('')
-    print('done')
-    summaryText = 'Total: {}; '.format(len(candidateFiles))
-    summaryText += 'Passed: {}; '.format(len(candidateFiles) - skipCount)
-    summaryText += 'Failed: {}; '.format(skipCount)
-    # resultStr += 'Unique Filenames: {}; '.format(len(filenameSet))
-    # resultStr += 'dupFilenames: {}'.format(len(candidateFiles) - skipCount - len(filenameSet))
-    combineDatasetSpecsFromLocalFiles()
-    return flask.render_template('update_dataset_list.html', textLines=textLines, summaryText=summaryText, deploy=settings.FLASK_ENV == 'production')
-
-
-def getDataSpecObj(service, googleDriveFile) -> Tuple[Union[Dict, None], str]:
-    folderId = googleDriveFile['id']
-    metaDataFileId, _ = getFileId(folderId, 'experimentMetaData.json', True)
-    if metaDataFileId is None:
-        msg = 'Missing experimentMetaData.json in ' +  folderId
-        print('\tgetDataSpecObj:' + msg)
-        return None, msg
-    metaDataFile = getFileFromGoogleDrive(metaDataFileId, service)
-
-    massOverTimeFileId, _ = getFileId(folderId, 'massOverTime.pb', True)
-    if massOverTimeFileId is None:
-        msg = 'Missing massOverTime.pb in ' + folderId
-        print('\tgetDataSpecObj: ' + msg)
-        return None, msg
-    massOverTimeMetaData = getFileMetaDataFromGoogleDrive(massOverTimeFileId, service, 'size')
-
-    dataSpecObj = json.loads(metaDataFile.read())
-
-    parentId = googleDriveFile['parents'][0]
-    folderPathList = getFolderPathFromGoogleDrive(service, settings.TOP_GOOGLE_DRIVE_FOLDER_ID, parentId)
-    unknownFolder = False
-    if len(folderPathList) == 0:
-        unknownFolder = True
-        msg = 'Cannot find ' + parentId + ' in ' + settings.TOP_GOOGLE_DRIVE_FOLDER_ID
-        print('\tgetDataSpecObj: ' + msg)
-        # return None, msg
-
-    dataSpecObj['googleDriveId'] = parentId
-    if dataSpecObj.get('folder', '') == '':
-        if unknownFolder:
-            dataSpecObj['folder'] = 'unknown'
-        else:
-            dataSpecObj['folder'] = '/'.join(folderPathList) + '/'
-    if dataSpecObj.get('author', '') == '':
-        dataSpecObj['author'] = googleDriveFile['owners'][0]['displayName']
-    if dataSpecObj.get('displayName', '') == '':
-        if unknownFolder:
-            dataSpecObj['displayName'] = 'unkown'
-        else:
-            dataSpecObj['displayName'] = folderPathList[2] + '/.../' + folderPathList[-1]
-    if dataSpecObj.get('uniqueId', '') == '':
-        dataSpecObj['uniqueId'] = parentId
-    dataSpecObj['modifiedDate'] = googleDriveFile['modifiedTime'].split('T')[0]
-    dataSpecObj['fileSize'] = massOverTimeMetaData['size']
-    return dataSpecObj, 'OK'
-
-def getFolderPathFromGoogleDrive(service, topDir, bottomDir) -> List[str]:
-    pathList = []
-    currentDir = bottomDir
-    while currentDir != topDir:
-        currentDirFile = service.files().get(fileId=currentDir, fields='parents, name').execute()
-        parentList = currentDirFile.get('parents', None)
-        if parentList is None:
-            return []
-        pathList.append(currentDirFile['name'])
-        currentDir = currentDirFile['parents'][0]
-    pathList.append('Data')
-    pathList.reverse()
-    return pathList
-
-def combineDatasetSpecsFromLocalFiles() -> None:
-    basePath = './static/cache/datasetList/'
-    fileContentList = []
-    datasetSpecs = os.listdir(basePath)
-    for spec in datasetSpecs:
-        if spec.endswith(".json"):
-           specFile = open(basePath + spec, 'r')
-           fileContentList.append((specFile.read(), spec.split(',')[0]))
-    combinedString = combineDatasetSpecs(fileContentList)
-    out = open(basePath + 'derived/combined.json', 'w')
-    out.write(combinedString)
-    return
-
-def combineDatasetSpecs(fileContentList: List[Tuple[str, str]]) -> str:
-    totalDatset = {}
-    authorSet = set()
-    combinedList = []
-    maxSize = 0
-    for fileContent, filename in fileContentList:
-        fileSpecObj = json.loads(fileContent)
-        id = fileSpecObj['uniqueId']
-        fileSpecObj['vizLinkHtml'] = '<a href="/detailedView/{}" target="_blank">Viz Link</a>'.format(id)
-        driveUrl = 'https://drive.google.com/drive/u/1/folders/{}'.format(fileSpecObj['googleDriveId'])
-        fileSpecObj['driveLinkHtml'] = '<a href="{}" target="_blank">Drive Link</a>'.format(driveUrl)
-        combinedList.append(fileSpecObj)
-        authorSet.add(fileSpecObj['author'])
-        fileSpecObj['fileSize'] = int(fileSpecObj['fileSize']) / (1024 * 1024.0)
-        maxSize = max(maxSize, fileSpecObj['fileSize'])
-
-        del fileSpecObj['locationMaps'] # there is no point in copying these over
-    totalDatset['authorList'] = list(authorSet)
-    totalDatset['sizeRange'] = [0, maxSize]
-    totalDatset['datasetList'] = combinedList
-    return json.dumps(totalDatset, indent=4)
+def updateDataSpecList():
+    force = flask.request.args.get('force', '0') == '1'
+    job = jobQueue.submit('updateDatasetList', 'all', rebuildDatasetListJob, getStorage(), force)
+    return flask.redirect(url_for('getDatasetListJob', jobId=job.id))
+
+@app.route('/data/update_dataset_list/<string:jobId>')
+@authRequired
+def getDatasetListJob(jobId: str) -> str:
+    job = getVisibleJob(jobId)
+    result = job['result'] or {}
+    return flask.render_template('update_dataset_list.html', job=job, textLines=result.get('textLines', []), summaryText=result.get('summaryText', ''), deploy=settings.FLASK_ENV == 'production')
+
+def rebuildDatasetListJob(job: jobs.Job, backend: StorageBackend, force: bool) -> Dict:
+    textLines, summaryText = datasetList.rebuildDatasetList(backend, force, job.setProgress)
+    return {'textLines': textLines, 'summaryText': summaryText}
+
+@app.route('/data/jobs/<string:jobId>.json')
+@authRequired
+def getJobStatus(jobId: str):
+    return flask.jsonify(getVisibleJob(jobId))
+
+def getVisibleJob(jobId: str) -> Dict:
+    job = jobQueue.get(jobId)
+    if job is None:
+        abort(404)
+    # prefetches are queued by admins, their results list dataset files
+    if job['kind'] == 'prefetch' and not isAdminRequest():
+        abort(403)
+    return job
+
+@app.route('/admin/prefetch/<string:folderId>')
+@authRequired
+@adminRequired
+def prefetchDatasetRoute(folderId: str):
+    job = jobQueue.submit('prefetch', folderId, prefetchDatasetJob, getStorage(), folderId)
+    return flask.jsonify(dict(job.toDict(), statusUrl=url_for('getJobStatus', jobId=job.id)))
+
+def prefetchDatasetJob(job: jobs.Job, backend: StorageBackend, folderId: str) -> Dict:
+    return prefetch.prefetchDataset(backend, folderId, job.setProgress)
+
+@app.cli.command('prefetch')
+@click.argument('folderids', nargs=-1, required=True)
+@click.option('--credentials', default=None, help='Authorized user file to read Drive with, defaults to DEMO_CREDENTIALS_FILENAME.')
+def prefetchCommand(folderids, credentials):
+    """Download whole datasets into static/cache."""
+    credentialsFilename = credentials or settings.DEMO_CREDENTIALS_FILENAME
+    backend = storage.createStorage(lambda: drivePool.defaultPool.credentialsFromFile(credentialsFilename))
+    for folderId in folderids:
+        def printProgress(done: int, total: int, message: str) -> None:
+            print('{}: {}/{} {}'.format(folderId, done, total, message))
+        summary = prefetch.prefetchDataset(backend, folderId, printProgress)
+        print(json.dumps(summary, indent=4))
+
+@app.route('/metrics')
+@adminRequired
+def getMetrics():
+    return flask.Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/admin/cache')
+@authRequired
+@adminRequired
+def getCacheStatus():
+    return flask.jsonify(cacheStatus())
+
+@app.route('/admin/cache/<string:folderId>/<any(pin, unpin, purge):action>', methods=['POST'])
+@authRequired
+@adminRequired
+def changeCachedDataset(folderId: str, action: str):
+    if action == 'purge':
+        return flask.jsonify({'folderId': folderId, 'freed': purgeDataset(folderId)})
+    fileCache.index.setPinned(folderId, action == 'pin')
+    return flask.jsonify({'folderId': folderId, 'pinned': action == 'pin'})
+
+@app.route('/admin/cache/evict', methods=['POST'])
+@authRequired
+@adminRequired
+def evictCache():
+    return flask.jsonify({'freed': fileCache.evict(fileCache.quotaBytes())})
+
+@app.route('/admin/access/revoke', methods=['POST'])
+@authRequired
+@adminRequired
+def revokeFolderAccess():
+    '''Forgets the remembered access decisions for ?folderId=, or for every folder without it.'''
+    folderId = flask.request.args.get('folderId', None)
+    return flask.jsonify({'folderId': folderId, 'revoked': accessIndex.revoke(folderId)})
+
+def purgeDataset(folderId: str) -> int:
+    '''Deletes the cached files of a dataset and forgets its folder listings, so it is fetched afresh; returns the bytes freed.'''
+    pathIndex.invalidate(folderId)
+    return fileCache.purgeDataset(folderId)
+
+def cacheStatus() -> Dict:
+    datasets = fileCache.scanDatasets()
+    return {
+        'quota': fileCache.quotaBytes(),
+        'size': sum(dataset['size'] for dataset in datasets.values()),
+        'policy': settings.CACHE_EVICTION_POLICY,
+        'datasets': fileCache.index.datasets(),
+    }
+
+@app.cli.group('cache')
+def cacheCommand():
+    """Inspect and manage static/cache."""
+
+@cacheCommand.command('list')
+def cacheListCommand():
+    """Cached datasets with size, hits and pins."""
+    print(json.dumps(cacheStatus(), indent=4))
+
+@cacheCommand.command('pin')
+@click.argument('folderids', nargs=-1, required=True)
+def cachePinCommand(folderids):
+    """Never evict these datasets."""
+    for folderId in folderids:
+        fileCache.index.setPinned(folderId, True)
+
+@cacheCommand.command('unpin')
+@click.argument('folderids', nargs=-1, required=True)
+def cacheUnpinCommand(folderids):
+    """Allow evicting these datasets again."""
+    for folderId in folderids:
+        fileCache.index.setPinned(folderId, False)
+
+@cacheCommand.command('purge')
+@click.argument('folderids', nargs=-1, required=True)
+def cachePurgeCommand(folderids):
+    """Delete everything cached for these datasets."""
+    for folderId in folderids:
+        print('{}: freed {} bytes'.format(folderId, purgeDataset(folderId)))
+
+@cacheCommand.command('evict')
+def cacheEvictCommand():
+    """Evict down to the quota now."""
+    print('freed {} bytes'.format(fileCache.evict(fileCache.quotaBytes())))
+
+@app.cli.command('revoke-access')
+@click.argument('folderids', nargs=-1)
+def revokeAccessCommand(folderids):
+    """Check access to these dataset folders (all without any) with storage again."""
+    for folderId in folderids or [None]:
+        print('{}: revoked {} decisions'.format(folderId or 'all', accessIndex.revoke(folderId)))
 
 def isCached(folderId: str, filename: str) -> bool:
     return os.path.exists(cachePath(folderId, filename))
 
 def cachePath(folderId: str, filename: str) -> str:
-    cachePath = './static/cache/' + folderId
+    cachePath = fileCache.CACHE_ROOT + '/' + folderId
     return cachePath + '/' + filename
 
-def getCached(folderId: str, filename: str): # -> flask.Response:
+def getCached(folderId: str, filename: str, mimetype: str): # -> flask.Response:
     filePath = cachePath(folderId, filename)
     print('getCached', 'folderId' + '=' + folderId, 'filename' + '=' + filename, 'filePath' + '=' + filePath)
-    return flask.redirect(filePath[1:]) # don't want '.' here
-
-def cache(folderId: str, filename: str, data, isBinary = False) -> None:
-    folderPath = './static/cache/' + folderId
-
-    # cache file
-    if not os.path.exists(folderPath):
-        os.mkdir(folderPath)
-    mode = 'w'
-    if isBinary:
-        mode += 'b'
-    cache = open(folderPath + '/' + filename, mode)
-    cache.write(data)
-    cache.close()
-    return
+    fileCache.markUsed(filePath)
+    return countCacheHit(filePath, sendCacheFile(filePath, mimetype, 'private, max-age={}'.format(settings.CACHE_MAX_AGE)))
+
+def sendCacheFile(filePath: str, mimetype: str, cacheControl: str): # -> flask.Response:
+    '''Hands a file below static/cache to the client the way CACHE_SERVE_MODE says.'''
+    compressedVariants.schedule(filePath)
+    if settings.CACHE_SERVE_MODE == 'accel':
+        response = accelRedirect(flask.Response(mimetype=mimetype), filePath)
+    else:
+        encoding, sendPath = negotiateEncoding(filePath)
+        # werkzeug passes the open file to the server's wsgi.file_wrapper, gunicorn sends it with sendfile
+        response = flask.send_file(sendPath, mimetype=mimetype, conditional=True)
+        setContentEncoding(response, filePath, encoding)
+    response.headers['Cache-Control'] = cacheControl
+    return response
+
+def negotiateEncoding(filePath: str) -> Tuple[Union[str, None], str]:
+    '''(encoding, path to send) of the compressed variant the client accepts best, (None, filePath) if there is none.'''
+    variant = compressedVariants.chooseVariant(filePath, flask.request.accept_encodings)
+    return variant if variant is not None else (None, filePath)
+
+def setContentEncoding(response: flask.Response, filePath: str, encoding: Union[str, None]) -> None:
+    if compressedVariants.isCompressible(filePath):
+        response.vary.add('Accept-Encoding')
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+
+def countCacheHit(filePath: str, response: flask.Response) -> flask.Response:
+    metrics.cacheRequests.inc(file=metricsFileName(filePath), result='hit')
+    if response.status_code in (200, 206):
+        # empty accel responses stand for the whole file nginx sends
+        metrics.bytesServed.inc(response.content_length or os.path.getsize(filePath), source='cache')
+    return response
+
+def metricsFileName(path: str) -> str:
+    ''''data3/D5.jpg' -> 'D.jpg', so a metric label has one value per kind of file.'''
+    return re.sub(r'\d+', '', os.path.basename(path))
+
+def accelRedirect(response: flask.Response, filePath: str) -> flask.Response:
+    '''Lets nginx send the file (see the internal location in nginx.conf), the response body stays empty.'''
+    response.headers['X-Accel-Redirect'] = settings.CACHE_ACCEL_PREFIX + urllib.parse.quote(os.path.relpath(filePath, fileCache.CACHE_ROOT))
+    return response
+
+def awaitFlight(folderId: str, filename: str) -> Union[singleFlight.Flight, None]:
+    '''
+    Waits until no other request is fetching this file; check the cache again afterwards.
+    Range requests do not write the cache, so they never wait. None on timeout.
+    '''
+    if flask.request.range is not None:
+        return None
+    return singleFlight.defaultGroup.acquire(cachePath(folderId, filename))
+
+def releaseFlight(flight: Union[singleFlight.Flight, None]) -> None:
+    if flight is not None:
+        flight.release()
+
+def releaseOnClose(response: flask.Response, flight: Union[singleFlight.Flight, None]) -> flask.Response:
+    '''Keeps the flight until the response, and with it the tee into the cache, is finished.'''
+    if flight is not None:
+        # call_on_close callbacks are skipped for direct_passthrough responses
+        response.response = ClosingIterator(response.response, flight.release)
+    return response
+
+def streamFromStorage(folderId: str, filename: str, fileInfo: storage.FileInfo, backend: StorageBackend, mimetype: str) -> flask.Response:
+    '''
+    Forwards the file to the client chunk by chunk while it downloads. A full download
+    is teed into the cache; a Range request only fetches and returns that range.
+    '''
+    size = fileInfo.size
+    start, end = 0, size
+    if flask.request.range is not None:
+        byteRange = flask.request.range.range_for_length(size)
+        if byteRange is None:
+            response = flask.Response(status=416)
+            response.headers['Content-Range'] = 'bytes */{}'.format(size)
+            return response
+        start, end = byteRange
+
+    metrics.cacheRequests.inc(file=metricsFileName(filename), result='miss')
+    writer = None
+    if start == 0 and end == size:
+        writer = fileCache.AtomicWriter(cachePath(folderId, filename), prefetch.fileValidators(fileInfo))
+    response = flask.Response(streamChunks(backend, fileInfo, start, end, writer), mimetype=mimetype, direct_passthrough=True)
+    # sent as is, later requests may get a compressed copy
+    setContentEncoding(response, filename, None)
+    response.headers['Content-Length'] = str(end - start)
+    response.headers['Accept-Ranges'] = 'bytes'
+    if start != 0 or end != size:
+        response.status_code = 206
+        response.headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, end - 1, size)
+    return response
+
+def streamChunks(backend: StorageBackend, fileInfo: storage.FileInfo, start: int, end: int, writer: Union[fileCache.AtomicWriter, None]):
+    md5 = hashlib.md5()
+    try:
+        for chunk in backend.iterChunks(fileInfo.id, start, end, settings.STREAM_CHUNK_SIZE):
+            if writer is not None:
+                writer.write(chunk)
+                md5.update(chunk)
+            metrics.bytesServed.inc(len(chunk), source='storage')
+            yield chunk
+        # a failed, truncated or corrupted download is never cached
+        if writer is not None and writer.size == fileInfo.size:
+            if fileInfo.md5Checksum is not None and md5.hexdigest() != fileInfo.md5Checksum:
+                raise ValueError('md5Checksum mismatch')
+            writer.commit()
+            compressedVariants.schedule(writer.path)
+            thumbnails.schedule(writer.path)
+    except Exception as e:
+        print('ERROR: Failed to stream file from storage. FileID:', fileInfo.id, e)
+    finally:
+        if writer is not None:
+            writer.discard()
 
 @app.route('/data/<string:folderId>/massOverTime.pb')
 @authRequired
 def getMassOverTimePb(folderId: str): # -> flask.Response:
+    # clients that can decode the columnar layout ask for it in Accept
+    if acceptsColumns():
+        return varyOnAccept(getMassOverTimeColumns(folderId))
     filename = 'massOverTime.pb'
-
-    innerFolderId, _ = getFileId(folderId, '.vizMetaData',True)
-    if innerFolderId is None:
-        print('getMassOverTimePb: ".vizMetaData" does not exist')
-        return '' 
-    fileId, service = getFileId(innerFolderId, filename, True)
-    if fileId is None:
-        print('getMassOverTimePb: "' + filename + '" does not exist')
+    mimetype = 'application/octet-stream'
+
+    validators, fileInfo, backend = revalidateCached(folderId, filename, '.vizMetaData/' + filename)
+    flight = None
+    if validators is None and fileInfo is not None:
+        flight = awaitFlight(folderId, filename)
+        if flight is not None:
+            # another request may have downloaded it while we waited
+            validators, fileInfo, backend = revalidateCached(folderId, filename, '.vizMetaData/' + filename)
+    if validators is not None:
+        releaseFlight(flight)
+        return varyOnAccept(serveCached(folderId, filename, mimetype, validators))
+    if fileInfo is None:
+        releaseFlight(flight)
+        print('getMassOverTimePb: ".vizMetaData/' + filename + '" does not exist')
         return ''
 
-    if isCached(folderId, filename):
-        filePath = cachePath(folderId, filename)
-        cachedModifiedTime = os.path.getmtime(filePath)
-        driveModifiedTime = getLastModifiedTimeFromGoogleDrive(fileId, service)
-        if cachedModifiedTime > driveModifiedTime:
-            print('loading cached files from ' + folderId)
-            return getCached(folderId, filename)
-
     print('getting ' + filename + ' from ' + folderId)
-    f = getFileFromGoogleDrive(fileId, service)
+    response = streamFromStorage(folderId, filename, fileInfo, backend, mimetype)
+    setValidators(response, prefetch.fileValidators(fileInfo))
+    return varyOnAccept(releaseOnClose(response, flight))
 
-    cache(folderId, 'massOverTime.pb', f.getbuffer(), True) 
+@app.route('/data/<string:folderId>/massOverTime.columns')
+@authRequired
+def getMassOverTimeColumns(folderId: str): # -> flask.Response:
+    validators = ensureColumns(folderId)
+    if validators is None:
+        return ''
+    return serveCached(folderId, 'massOverTime.columns', curveColumns.MIMETYPE, validators, '-columns')
 
-    response = flask.send_file(f, mimetype='application/octet-stream')
+@app.route('/data/<string:folderId>/massOverTime/subset')
+@authRequired
+def getMassOverTimeSubset(folderId: str): # -> flask.Response:
+    '''
+    Only the curves and attributes asked for, e.g.
+    ?location=3&frameStart=0&frameEnd=50&pointAttr=Mass (pg)&pointAttr=Frame ID
+    location and curveId take comma separated lists, pointAttr and curveAttr repeat.
+    Answers with a PbCurveList, or the columnar layout when Accept asks for it.
+    '''
+    args = flask.request.args
+    try:
+        query = {
+            'locations': intListArg(args, 'location'),
+            'frameStart': float(args['frameStart']) if 'frameStart' in args else None,
+            'frameEnd': float(args['frameEnd']) if 'frameEnd' in args else None,
+            'curveIds': intListArg(args, 'curveId'),
+            'pointAttrNames': args.getlist('pointAttr') if 'pointAttr' in args else None,
+            'curveAttrNames': args.getlist('curveAttr') if 'curveAttr' in args else None,
+        }
+    except ValueError as e:
+        abort(400, str(e))
+
+    validators = ensureColumns(folderId)
+    if validators is None:
+        return ''
+    asColumns = acceptsColumns()
+    # a subset is a pure function of the .pb version and the query
+    queryKey = json.dumps(query, sort_keys=True) + ('columns' if asColumns else 'pb')
+    etagSuffix = '-subset-' + hashlib.md5(queryKey.encode('utf-8')).hexdigest()[:16]
+    if validatorsEtag(validators) + etagSuffix in flask.request.if_none_match:
+        response = flask.Response(status=304)
+        setValidators(response, validators, etagSuffix)
+        return varyOnAccept(response)
+
+    columnsPath = cachePath(folderId, 'massOverTime.columns')
+    fileCache.markUsed(columnsPath)
+    columns = curveColumns.openColumns(columnsPath)
+    try:
+        # the PbCurveList is built message by message, seconds for millions of points
+        body = cpuBound.run(curveColumns.encodeSubset, columns, query, asColumns)
+    except ValueError as e:
+        abort(400, str(e))
+    response = flask.Response(body, mimetype=curveColumns.MIMETYPE if asColumns else 'application/octet-stream')
+    setValidators(response, validators, etagSuffix)
+    return varyOnAccept(response)
+
+@app.route('/data/<string:folderId>/massOverTime.summary.json')
+@authRequired
+def getMassOverTimeSummary(folderId: str): # -> flask.Response:
+    validators = ensureColumns(folderId)
+    if validators is None:
+        return '{}'
+    filename = 'massOverTime.summary.json'
+    ensureDerived(folderId, filename, curveSummary.VERSION, validators,
+        lambda path, meta: curveSummary.writeSummary(curveColumns.openColumns(cachePath(folderId, 'massOverTime.columns')), path, meta))
+    return serveCached(folderId, filename, 'application/json', validators, '-summary')
+
+def intListArg(args, name: str) -> Union[List[int], None]:
+    if name not in args:
+        return None
+    return [int(value) for arg in args.getlist(name) for value in arg.split(',') if value != '']
+
+def ensureColumns(folderId: str) -> Union[Dict, None]:
+    '''Transcodes the cached massOverTime.pb unless its columnar form is up to date; returns the validators of the .pb.'''
+    pbFilename = 'massOverTime.pb'
+    validators = ensureCached(folderId, pbFilename, '.vizMetaData/' + pbFilename)
+    if validators is None:
+        print('ensureColumns: ".vizMetaData/' + pbFilename + '" does not exist')
+        return None
+
+    ensureDerived(folderId, 'massOverTime.columns', curveColumns.VERSION, validators,
+        lambda path, meta: curveColumns.transcodeFile(cachePath(folderId, pbFilename), path, meta))
+    return validators
+
+def ensureDerived(folderId: str, filename: str, version: int, sourceValidators: Dict, build) -> None:
+    '''
+    Calls build(path, meta) to regenerate a file derived from a cached source unless
+    it was already built by this version of the code from this version of the source.
+    '''
+    filePath = cachePath(folderId, filename)
+
+    def isCurrent() -> bool:
+        derivedMeta = fileCache.readMeta(filePath) if isCached(folderId, filename) else None
+        return derivedMeta is not None and derivedMeta.get('version', None) == version \
+            and validatorsEtag(derivedMeta['source']) == validatorsEtag(sourceValidators)
+
+    if isCurrent():
+        return
+    flight = singleFlight.defaultGroup.acquire(filePath)
+    try:
+        # built by whoever held the flight before us
+        if flight is not None and isCurrent():
+            return
+        print('building ' + filename + ' of ' + folderId)
+        build(filePath, {'version': version, 'source': sourceValidators})
+    finally:
+        releaseFlight(flight)
+
+def acceptsColumns() -> bool:
+    # only when named explicitly, '*/*' keeps getting the protobuf
+    accept = flask.request.accept_mimetypes
+    return any(value == curveColumns.MIMETYPE and quality > 0 for value, quality in accept) \
+        and accept.best_match([curveColumns.MIMETYPE, 'application/octet-stream']) == curveColumns.MIMETYPE
+
+def varyOnAccept(response: flask.Response) -> flask.Response:
+    if isinstance(response, flask.Response):
+        response.vary.add('Accept')
     return response
- 
+
+def revalidateCached(folderId: str, filename: str, path: str) -> Tuple[Union[Dict, None], Union[storage.FileInfo, None], Union[StorageBackend, None]]:
+    '''
+    (validators, None, None) when the cached file is the current version,
+    (None, fileInfo, backend) when it has to be fetched and (None, None, None) when
+    the file does not exist in storage.
+    '''
+    filePath = cachePath(folderId, filename)
+    validators = fileCache.readMeta(filePath) if isCached(folderId, filename) else None
+    if validators is not None and time.time() - validators['checkedAt'] < settings.REVALIDATE_TTL:
+        return validators, None, None
+
+    fileInfo, backend = getCurrentFileInfo(folderId, path, validators)
+    if fileInfo is None:
+        return None, None, None
+
+    if isCached(folderId, filename):
+        # caches written before validators were recorded are trusted if newer than the source
+        if (validators is None and os.path.getmtime(filePath) > fileInfo.modifiedTime) \
+                or (validators is not None and isSameVersion(validators, fileInfo)):
+            print('loading cached files from ' + folderId)
+            validators = prefetch.fileValidators(fileInfo)
+            fileCache.writeMeta(filePath, validators)
+            return validators, None, None
+    return None, fileInfo, backend
+
+def ensureCached(folderId: str, filename: str, path: str) -> Union[Dict, None]:
+    '''Downloads the current version into the cache unless it is there already; returns its validators.'''
+    validators, fileInfo, backend = revalidateCached(folderId, filename, path)
+    if validators is None and fileInfo is not None:
+        filePath = cachePath(folderId, filename)
+        print('getting ' + filename + ' from ' + folderId)
+        metrics.cacheRequests.inc(file=metricsFileName(filename), result='miss')
+        prefetch.fetchToCache(backend, fileInfo, filePath)
+        validators = prefetch.fileValidators(fileInfo)
+        # refreshes checkedAt when another request had just downloaded it
+        fileCache.writeMeta(filePath, validators)
+    return validators
+
+def getCurrentFileInfo(folderId: str, path: str, validators: Union[Dict, None]) -> Tuple[storage.FileInfo, StorageBackend]:
+    '''One metadata call by the remembered fileId when there is one, a path lookup otherwise.'''
+    if validators is not None:
+        backend = getStorage()
+        try:
+            return backend.stat(validators['fileId']), backend
+        except Exception:
+            # deleted or replaced, look it up by path again
+            pass
+    return getFileInfo(folderId, path, True)
+
+def isSameVersion(validators: Dict, fileInfo: storage.FileInfo) -> bool:
+    if validators['md5Checksum'] is not None and fileInfo.md5Checksum is not None:
+        return validators['md5Checksum'] == fileInfo.md5Checksum
+    return validators['size'] == fileInfo.size and validators['modifiedTime'] == fileInfo.modifiedTime
+
+def validatorsEtag(validators: Dict) -> str:
+    return validators['md5Checksum'] or '{}-{}'.format(validators['size'], int(validators['modifiedTime']))
+
+def setValidators(response: flask.Response, validators: Dict, etagSuffix: str = '') -> None:
+    '''etagSuffix tells apart representations derived from the same storage version.'''
+    response.set_etag(validatorsEtag(validators) + etagSuffix)
+    response.last_modified = datetime.utcfromtimestamp(validators['modifiedTime'])
+    # the browser may keep it, but has to ask (and usually gets a 304) before using it
+    response.headers['Cache-Control'] = 'private, no-cache'
+
+def serveCached(folderId: str, filename: str, mimetype: str, validators: Dict, etagSuffix: str = '') -> flask.Response:
+    '''Serves a cached file directly with the validators of its storage version, answering 304 when the client has it.'''
+    filePath = cachePath(folderId, filename)
+    fileCache.markUsed(filePath)
+    compressedVariants.schedule(filePath)
+    if settings.CACHE_SERVE_MODE == 'accel':
+        # 304s are answered here with the storage validators, everything else (ranges included) by nginx
+        response = flask.Response(mimetype=mimetype)
+        setValidators(response, validators, etagSuffix)
+        response = response.make_conditional(flask.request)
+        return countCacheHit(filePath, response if response.status_code == 304 else accelRedirect(response, filePath))
+    encoding, sendPath = negotiateEncoding(filePath)
+    response = flask.send_file(sendPath, mimetype=mimetype, conditional=False)
+    # every encoding is a representation of its own
+    setValidators(response, validators, etagSuffix if encoding is None else etagSuffix + '-' + encoding)
+    setContentEncoding(response, filePath, encoding)
+    return countCacheHit(filePath, response.make_conditional(flask.request, accept_ranges=True, complete_length=os.path.getsize(sendPath)))
+
 @app.route('/data/<string:folderId>/imageMetaData.json')
 @authRequired
 def getImageStackMetaDataJson(folderId: str):
     filename = 'imageMetaData.json'
+    scale = imageScale()
+    if scale != 1:
+        return getScaledImageMetaData(folderId, filename, scale)
+    if isCached(folderId, filename):
+        return getCached(folderId, filename, 'application/json')
+    flight = awaitFlight(folderId, filename)
     if isCached(folderId, filename):
-        return getCached(folderId, filename)
+        releaseFlight(flight)
+        return getCached(folderId, filename, 'application/json')
 
-    innerFolderId, _ = getFileId(folderId, '.vizMetaData',True)
-    if innerFolderId is None:
-        return
-    fileId, service = getFileId(innerFolderId, 'imageMetaData.json', True)
-    if fileId is None:
+    fileInfo, backend = getFileInfo(folderId, '.vizMetaData/' + filename, True)
+    if fileInfo is None:
+        releaseFlight(flight)
         return
-    f = getFileFromGoogleDrive(fileId, service)
-    return flask.send_file(f, mimetype='application/json')
+    return releaseOnClose(streamFromStorage(folderId, filename, fileInfo, backend, 'application/json'), flight)
 
 @app.route('/data/<string:folderId>/img_<int:locationId>_<int:bundleIndex>.jpg')
 @authRequired
 def getImageStackBundle(folderId: str, locationId: int, bundleIndex: int):
     folder = '{}/data{}'.format(folderId, locationId)
     filename = 'D{}.jpg'.format(bundleIndex)
+    mimetype = 'image/jpeg'
+    scale = imageScale()
+    if scale != 1:
+        return getImageThumbnail(folderId, folder, filename, 'data{}/{}'.format(locationId, filename), scale)
     if isCached(folder, filename):
-        return getCached(folder, filename)
+        return getCached(folder, filename, mimetype)
+    flight = awaitFlight(folder, filename)
+    if isCached(folder, filename):
+        releaseFlight(flight)
+        return getCached(folder, filename, mimetype)
 
     try:
-        # Google Drive API sometimes fails inside getFileId
-        innerFolderId, _ = getFileId(folderId, 'data{}'.format(locationId), True)
-        if innerFolderId is None:
-            return
-        fileId, service = getFileId(innerFolderId, 'D{}.jpg'.format(bundleIndex))
-        if fileId is None:
-            return
+        # Google Drive API sometimes fails inside getFileInfo
+        fileInfo, backend = getFileInfo(folderId, 'data{}/D{}.jpg'.format(locationId, bundleIndex))
     except:
-        print('Error: Failed in getFileId because of google drive API')
-        return flask.send_file(io.BytesIO(), mimetype='image/jpeg')
+        releaseFlight(flight)
+        print('Error: Failed in getFileInfo because of google drive API')
+        return flask.send_file(io.BytesIO(), mimetype=mimetype)
 
-    f = getFileFromGoogleDrive(fileId, service)
-    return flask.send_file(f, mimetype='image/jpeg')
+    return releaseOnClose(streamFromStorage(folder, filename, fileInfo, backend, mimetype), flight)
+
+def imageScale() -> int:
+    '''?scale=N of image routes: 1 for the original, otherwise one of THUMBNAIL_SCALES.'''
+    try:
+        scale = int(flask.request.args.get('scale', 1))
+    except ValueError:
+        abort(400)
+    if scale != 1 and scale not in thumbnails.scales():
+        abort(400)
+    return scale
+
+def getScaledImageMetaData(folderId: str, filename: str, scale: int):
+    '''imageMetaData.json describing the bundles downscaled by scale, whose tiles have to stay whole pixels.'''
+    if ensureCached(folderId, filename, '.vizMetaData/' + filename) is None:
+        abort(404)
+    with open(cachePath(folderId, filename)) as metaDataFile:
+        metaData = json.load(metaDataFile)
+    tileWidth, tileHeight = metaData['tileWidth'], metaData['tileHeight']
+    if tileWidth % scale != 0 or tileHeight % scale != 0:
+        abort(400)
+    metaData['tileWidth'] = tileWidth // scale
+    metaData['tileHeight'] = tileHeight // scale
+    # cell coordinates / scaleFactor are pixels of the downscaled bundle
+    metaData['scaleFactor'] = metaData.get('scaleFactor', 1) * scale
+    metaData['scale'] = scale
+    metaData['scales'] = [1] + [option for option in thumbnails.scales() if tileWidth % option == 0 and tileHeight % option == 0]
+    response = flask.jsonify(metaData)
+    response.headers['Cache-Control'] = 'private, max-age={}'.format(settings.CACHE_MAX_AGE)
+    return response
+
+def getImageThumbnail(folderId: str, folder: str, filename: str, path: str, scale: int):
+    '''A downscaled copy of an image bundle, cached next to the bundle, which is fetched first if need be.'''
+    filePath = cachePath(folder, filename)
+    if not isCached(folder, filename):
+        fileInfo, backend = getFileInfo(folderId, path)
+        metrics.cacheRequests.inc(file=metricsFileName(filename), result='miss')
+        try:
+            fetchBundle(backend, fileInfo, filePath)
+        except Exception as e:
+            print('ERROR: Failed to fetch image bundle', folderId, path, e)
+            abort(502)
+    # WebP only for clients naming it, */* does not promise it can be shown
+    acceptsWebp = 'webp' in thumbnails.formats() and 'image/webp' in flask.request.accept_mimetypes.values()
+    format = 'webp' if acceptsWebp else 'jpeg'
+    try:
+        thumbnailPath = thumbnails.ensure(filePath, scale, format)
+    except Exception as e:
+        print('ERROR: Failed to make thumbnail', filePath, scale, format, e)
+        abort(500)
+    response = getCached(folder, os.path.basename(thumbnailPath), thumbnails.MIMETYPES[format])
+    if 'webp' in thumbnails.formats():
+        response.vary.add('Accept')
+    return response
 
 @app.route('/data/<string:folderId>/label_<int:locationId>_<int:bundleIndex>.pb')
 @authRequired
 def getImageLabelBundle(folderId: str, locationId: int, bundleIndex: int):
     folder = '{}/data{}'.format(folderId, locationId)
     filename = 'L{}.pb'.format(bundleIndex)
+    mimetype = 'application/octet-stream'
+    if isCached(folder, filename):
+        return getCached(folder, filename, mimetype)
+    flight = awaitFlight(folder, filename)
     if isCached(folder, filename):
-        return getCached(folder, filename)
+        releaseFlight(flight)
+        return getCached(folder, filename, mimetype)
 
     try:
-        # Google Drive API sometimes fails inside getFileId
-        innerFolderId, _ = getFileId(folderId, 'data{}'.format(locationId), True)
-        if innerFolderId is None:
-            return
-        fileId, service = getFileId(innerFolderId, 'L{}.pb'.format(bundleIndex))
-        if fileId is None:
-            return
+        # Google Drive API sometimes fails inside getFileInfo
+        fileInfo, backend = getFileInfo(folderId, 'data{}/L{}.pb'.format(locationId, bundleIndex))
     except:
-        print('Error: Failed in getFileId because of google drive API')
-        return flask.send_file(io.BytesIO(), mimetype='application/octet-stream')  
-    f = getFileFromGoogleDrive(fileId, service)
-    return flask.send_file(f, mimetype='application/octet-stream')
+        releaseFlight(flight)
+        print('Error: Failed in getFileInfo because of google drive API')
+        return flask.send_file(io.BytesIO(), mimetype=mimetype)  
+    return releaseOnClose(streamFromStorage(folder, filename, fileInfo, backend, mimetype), flight)
 
-def getFileId(folderId: str, filename: str, doNotAbort = False) -> Tuple[str, googleapiclient.discovery.Resource]:
-    if flask.session['allowAccessToAll']:
-        credentials = google.oauth2.credentials.Credentials.from_authorized_user_file(settings.DEMO_CREDENTIALS_FILENAME)
-    else:
-        credentials = google.oauth2.credentials.Credentials(**flask.session['credentials'])
-    service: googleapiclient.discovery.Resource = googleapiclient.discovery.build('drive', 'v3', credentials=credentials)
-    
-    query = "'" + folderId + "' in parents and name='" + filename + "'"
-    responseFields = "nextPageToken, files(id, name)"
-    
-    results = service.files().list(q=query, fields=responseFields).execute()
-    items = results.get('files', [])
-    if len(items) == 0:
+@app.route('/data/<string:folderId>/label_<int:locationId>_<int:bundleIndex>.labels')
+@authRequired
+def getPackedImageLabelBundle(folderId: str, locationId: int, bundleIndex: int):
+    '''The label bundle of getImageLabelBundle as packed arrays, see labelRuns.py.'''
+    pbFilename = 'data{}/L{}.pb'.format(locationId, bundleIndex)
+    filename = 'data{}/L{}.labels'.format(locationId, bundleIndex)
+    try:
+        # Google Drive API sometimes fails inside getFileInfo
+        validators = ensureCached(folderId, pbFilename, pbFilename)
+    except Exception as e:
+        print('Error: Failed to fetch ' + pbFilename + ' of ' + folderId, e)
+        return flask.send_file(io.BytesIO(), mimetype=labelRuns.MIMETYPE)
+    if validators is None:
+        abort(404)
+    ensureDerived(folderId, filename, labelRuns.VERSION, validators,
+        lambda path, meta: labelRuns.transcodeFile(cachePath(folderId, pbFilename), path, meta))
+    return serveCached(folderId, filename, labelRuns.MIMETYPE, validators, '-labels')
+
+@app.route('/data/<string:folderId>/bundles')
+@authRequired
+def getBundleBatch(folderId: str):
+    '''
+    Many image/label bundles in one response, e.g. ?bundle=img_3_0,img_3_1,label_3_0
+    (bundle may also repeat). Bundles are written as soon as they are available, in
+    no particular order, each as: uint32 name length, name (e.g. 'img_3_0.jpg'),
+    uint32 HTTP status, uint32 body length, body. Integers are little-endian.
+    '''
+    names = [name for arg in flask.request.args.getlist('bundle') for name in arg.split(',') if name != '']
+    if len(names) == 0 or len(names) > settings.BATCH_MAX_BUNDLES:
+        abort(400, 'between 1 and {} bundles'.format(settings.BATCH_MAX_BUNDLES))
+    bundles = []
+    for name in dict.fromkeys(names):
+        match = BUNDLE_NAME_PATTERN.match(name)
+        if match is None:
+            abort(400, 'bad bundle name: ' + name)
+        kind, locationId, bundleIndex = match.group(1), int(match.group(2)), int(match.group(3))
+        bundles.append((name + BUNDLE_EXTENSIONS[kind], 'data{}/{}{}{}'.format(locationId, BUNDLE_PREFIXES[kind], bundleIndex, BUNDLE_EXTENSIONS[kind])))
+    # created here, the worker threads have no flask session
+    backend = getStorage()
+    return flask.Response(streamBundles(folderId, bundles, backend), mimetype='application/vnd.loon.bundles', direct_passthrough=True)
+
+BUNDLE_NAME_PATTERN = re.compile(r'^(img|label)_(\d+)_(\d+)$')
+BUNDLE_PREFIXES = {'img': 'D', 'label': 'L'}
+BUNDLE_EXTENSIONS = {'img': '.jpg', 'label': '.pb'}
+
+def streamBundles(folderId: str, bundles: List[Tuple[str, str]], backend: StorageBackend):
+    with ThreadPoolExecutor(max_workers=settings.BATCH_WORKERS) as executor:
+        futures = {executor.submit(readBundle, folderId, path, backend): name for name, path in bundles}
+        for future in as_completed(futures):
+            status, body = future.result()
+            name = futures[future].encode('utf-8')
+            yield struct.pack('<I', len(name)) + name + struct.pack('<II', status, len(body))
+            yield body
+
+def readBundle(folderId: str, path: str, backend: StorageBackend) -> Tuple[int, bytes]:
+    '''(status, content) of the bundle at path, downloaded into the cache first if needed.'''
+    filePath = cachePath(folderId, path)
+    try:
+        cached = os.path.exists(filePath)
+        if not cached:
+            fileInfo = pathIndex.resolve(backend, folderId, path)
+            if fileInfo is None:
+                return 404, b''
+            fetchBundle(backend, fileInfo, filePath)
+        metrics.cacheRequests.inc(file=metricsFileName(path), result='hit' if cached else 'miss')
+        fileCache.markUsed(filePath)
+        with open(filePath, 'rb') as bundleFile:
+            body = bundleFile.read()
+        metrics.bytesServed.inc(len(body), source='cache' if cached else 'storage')
+        return 200, body
+    except Exception as e:
+        print('ERROR: Failed to fetch bundle', folderId, path, e)
+        return 502, b''
+
+def fetchBundle(backend: StorageBackend, fileInfo: storage.FileInfo, filePath: str) -> None:
+    '''fileInfo comes from the path index, whose size or md5Checksum may predate the bundle being replaced.'''
+    try:
+        prefetch.fetchToCache(backend, fileInfo, filePath)
+    except ValueError:
+        prefetch.fetchToCache(backend, backend.stat(fileInfo.id), filePath)
+
+def getFileInfo(folderId: str, path: str, doNotAbort = False) -> Tuple[storage.FileInfo, StorageBackend]:
+    backend = getStorage()
+    fileInfo = pathIndex.resolve(backend, folderId, path)
+    if fileInfo is None:
         if doNotAbort:
             return None, None
         abort(404)
-    fileId = items[0]['id']
-    return fileId, service
+    return fileInfo, backend
+
+def getStorage() -> StorageBackend:
+    return storage.createStorage(getCredentials)
+
+def getCredentials() -> google.oauth2.credentials.Credentials:
+    if flask.session['allowAccessToAll']:
+        return drivePool.defaultPool.credentialsFromFile(settings.DEMO_CREDENTIALS_FILENAME)
+    credentials = drivePool.defaultPool.credentialsFromInfo(flask.session['credentials'])
+    # keep the session in step with tokens the pooled credentials refreshed
+    if credentials.token is not None and credentials.token != flask.session['credentials']['token']:
+        flask.session['credentials'] = dict(flask.session['credentials'], token=credentials.token)
+    return credentials
 
 def credentialsValid() -> bool:
     if 'credentials' not in flask.session:
         return False
-    credentials = google.oauth2.credentials.Credentials(**flask.session['credentials'])
+    # the pooled Credentials, not a new object per request, and with the token other requests refreshed
+    credentials = drivePool.defaultPool.credentialsFromInfo(flask.session['credentials'])
     return credentials.valid and not credentials.expired
 
 
-def getFileFromGoogleDrive(googleFileId: str, service: googleapiclient.discovery.Resource) -> BytesIO:
-    f = io.BytesIO()
-    request = service.files().get_media(fileId=googleFileId)
-
-    downloader = MediaIoBaseDownload(f, request)
-    done = False
-    while done is False:
-        try:
-            status, done = downloader.next_chunk()
-            print("Download {} %".format(int(status.progress() * 100)), end='\r')
-        except:
-            print("ERROR: Failed to download file from Google Drive. FileID:", googleFileId)
-            return f
-    f.seek(0)
-    return f
-
-def getLastModifiedTimeFromGoogleDrive(googleFileId: str, service: googleapiclient.discovery.Resource) -> float:
-    metadata = getFileMetaDataFromGoogleDrive(googleFileId, service, 'modifiedTime')
-    dateObj = datetime.strptime(metadata['modifiedTime'], '%Y-%m-%dT%H:%M:%S.%fZ')
-    secondsSinceEpoch = (dateObj - datetime(1970, 1, 1)).total_seconds()
-    return secondsSinceEpoch
-
-def getFileMetaDataFromGoogleDrive(googleFileId: str, service: googleapiclient.discovery.Resource, dataFields: str):
-    request = service.files().get(fileId=googleFileId, fields=dataFields)
-    metadata = request.execute()
-    return metadata
-
 @app.route('/spinner.gif')
 def getSpinner():
     return flask.redirect('/static/assets/spinner.gif')
@@ -0,0 +1,98 @@
+"""
+A stand-in for Google Drive: a LocalStorage tree that answers like Drive does,
+with md5 checksums and a (quiet) change feed, and that is as slow and unreliable
+as asked. Every call waits latency seconds, downloads additionally wait for
+their size at bandwidth bytes per second, and a failureRate share of calls fail
+with a retryable error after waiting.
+
+Registered as the 'fakeDrive' storage backend by register().
+"""
+import hashlib
+import random
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import storage
+from storage import FileInfo, LocalStorage, StorageBackend
+
+class FakeDriveStorage(StorageBackend):
+
+    def __init__(self, root: str, latency: float = 0.1, bandwidth: float = 20e6, failureRate: float = 0.0, seed: int = 0):
+        self.local = LocalStorage(root)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.failureRate = failureRate
+        self.calls = 0
+        self.failures = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        # path -> (mtime, md5)
+        self._checksums: Dict[str, Tuple[float, str]] = {}
+
+    def listChildren(self, folderId: str) -> List[FileInfo]:
+        self._wait()
+        return [self._withChecksum(info) for info in self.local.listChildren(folderId)]
+
+    def findChild(self, folderId: str, name: str) -> Optional[FileInfo]:
+        self._wait()
+        info = self.local.findChild(folderId, name)
+        return None if info is None else self._withChecksum(info)
+
+    def findFoldersByName(self, name: str) -> List[FileInfo]:
+        self._wait()
+        return self.local.findFoldersByName(name)
+
+    def stat(self, fileId: str) -> FileInfo:
+        self._wait()
+        return self._withChecksum(self.local.stat(fileId))
+
+    def read(self, fileId: str, start: int = 0, end: Optional[int] = None) -> bytes:
+        self._wait()
+        data = self.local.read(fileId, start, end)
+        self._transfer(len(data))
+        return data
+
+    def iterChunks(self, fileId: str, start: int = 0, end: Optional[int] = None, chunkSize: int = storage.DEFAULT_CHUNK_SIZE) -> Iterator[bytes]:
+        # one Drive request per chunk, like DriveStorage through StorageBackend.iterChunks
+        for chunk in self.local.iterChunks(fileId, start, end, chunkSize):
+            self._wait()
+            self._transfer(len(chunk))
+            yield chunk
+
+    def listChanges(self, pageToken: Optional[str]) -> Optional[Tuple[List[str], str]]:
+        self._wait()
+        return [], 'fake'
+
+    def _wait(self) -> None:
+        with self._lock:
+            self.calls += 1
+            fail = self._random.random() < self.failureRate
+            if fail:
+                self.failures += 1
+        time.sleep(self.latency)
+        if fail:
+            raise ConnectionError('simulated Drive failure')
+
+    def _transfer(self, size: int) -> None:
+        if self.bandwidth > 0:
+            time.sleep(size / self.bandwidth)
+
+    def _withChecksum(self, info: FileInfo) -> FileInfo:
+        if info.isFolder:
+            return info
+        with self._lock:
+            checksum = self._checksums.get(info.id, None)
+        if checksum is None or checksum[0] != info.modifiedTime:
+            md5 = hashlib.md5()
+            with open(self.local._path(info.id), 'rb') as f:
+                for block in iter(lambda: f.read(1024 * 1024), b''):
+                    md5.update(block)
+            checksum = (info.modifiedTime, md5.hexdigest())
+            with self._lock:
+                self._checksums[info.id] = checksum
+        return info._replace(md5Checksum=checksum[1])
+
+def register(backend: FakeDriveStorage) -> None:
+    '''Serves every request from backend, shared so its call counters and random failures span the whole run.'''
+    storage.registerBackend('fakeDrive', lambda getCredentials: backend)
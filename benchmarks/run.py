@@ -0,0 +1,219 @@
+"""
+Benchmarks app.py served over HTTP against the fake Drive of fakeDrive.py and
+synthetic datasets from syntheticData.py, and prints the results as JSON:
+
+    massOverTime    every dataset's massOverTime.pb, first cold then warm (cached)
+    tileScroll      every image and label bundle of every location, in scroll order
+                    through browser-like parallel connections, cold then warm
+    rebuild         /data/update_dataset_list, a full (force=1) then an incremental rebuild
+
+Each gets its request count, errors, wall time, requests and bytes per second and
+p50/p90/p99/max latency. Everything runs in a scratch directory, so the cache of
+the checkout is not touched:
+
+    python benchmarks/run.py --datasets 4 --latency 0.1 --output before.json
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+
+BENCHMARKS_PATH = os.path.dirname(os.path.abspath(__file__))
+REPO_PATH = os.path.dirname(BENCHMARKS_PATH)
+sys.path.insert(0, REPO_PATH)
+# read by settings.py, which the imports below load
+os.environ['STORAGE_BACKEND'] = 'fakeDrive'
+os.environ['TOP_GOOGLE_DRIVE_FOLDER_ID'] = 'Data'
+os.environ.setdefault('FLASK_SECRET_KEY', 'benchmark')
+
+import fakeDrive
+import syntheticData
+
+# (seconds, bytes, ok)
+Sample = Tuple[float, int, bool]
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--datasets', type=int, default=4)
+    parser.add_argument('--locations', type=int, default=4, help='locations per dataset')
+    parser.add_argument('--bundles', type=int, default=10, help='image and label bundles per location')
+    parser.add_argument('--curves', type=int, default=50, help='curves per location')
+    parser.add_argument('--frames', type=int, default=100, help='points per curve')
+    parser.add_argument('--tile-size', type=int, default=128, help='width and height of an image tile in pixels')
+    parser.add_argument('--latency', type=float, default=0.1, help='seconds every fake Drive call takes')
+    parser.add_argument('--bandwidth-mb', type=float, default=20, help='fake Drive download speed in MB/s, 0 for unlimited')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='share of fake Drive calls that fail')
+    parser.add_argument('--concurrency', type=int, default=6, help='parallel client connections, a browser uses 6')
+    parser.add_argument('--repeat', type=int, default=3, help='warm passes per scenario')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', default=None, help='scratch directory, a temporary one by default')
+    parser.add_argument('--output', default=None, help='file to write the JSON results to, stdout by default')
+    parser.add_argument('--verbose', action='store_true', help='keep the log output of the app')
+    args = parser.parse_args()
+    # the server runs inside the scratch directory
+    outputPath = None if args.output is None else os.path.abspath(args.output)
+
+    workPath = args.workdir or tempfile.mkdtemp(prefix='loon-benchmark-')
+    dataPath = os.path.join(workPath, 'drive')
+    shape = syntheticData.DatasetShape(
+        locations=args.locations,
+        curvesPerLocation=args.curves,
+        framesPerCurve=args.frames,
+        bundlesPerLocation=args.bundles,
+        tileSize=args.tile_size)
+    try:
+        folderIds = syntheticData.writeDatasets(dataPath, args.datasets, shape, args.seed)
+        backend = fakeDrive.FakeDriveStorage(dataPath, args.latency, args.bandwidth_mb * 1e6, args.failure_rate, args.seed)
+        resultsOutput = sys.stdout
+        if not args.verbose:
+            # for good, background threads of the app may still log after the run
+            sys.stdout = open(os.devnull, 'w')
+        baseUrl, cookie, stop = startServer(workPath, backend)
+        try:
+            scenarios = runScenarios(Client(baseUrl, cookie), folderIds, shape, args)
+        finally:
+            stop()
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workPath, ignore_errors=True)
+
+    results = {
+        'commit': gitCommit(),
+        'createdAt': time.time(),
+        'config': dict(vars(args), workdir=None, output=None),
+        'driveCalls': backend.calls,
+        'driveFailures': backend.failures,
+        'scenarios': scenarios,
+    }
+    text = json.dumps(results, indent=4)
+    if outputPath is None:
+        print(text, file=resultsOutput)
+    else:
+        with open(outputPath, 'w') as outputFile:
+            outputFile.write(text + '\n')
+
+def startServer(workPath: str, backend: fakeDrive.FakeDriveStorage):
+    '''Imports the app inside workPath (its cache lives in ./static/cache) and serves it on a free port.'''
+    os.makedirs(os.path.join(workPath, 'static/cache/datasetList/derived'), exist_ok=True)
+    if not os.path.exists(os.path.join(workPath, 'templates')):
+        os.symlink(os.path.join(REPO_PATH, 'templates'), os.path.join(workPath, 'templates'))
+    os.chdir(workPath)
+    fakeDrive.register(backend)
+    import app
+    # send_file resolves the relative cache paths against the root path
+    app.app.root_path = workPath
+    from werkzeug.serving import make_server
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    # the fake Drive ignores credentials, they only have to look valid to authRequired
+    session = {'credentials': {'token': 'benchmark', 'refresh_token': None, 'token_uri': None, 'client_id': None, 'client_secret': None, 'scopes': []}}
+    cookie = 'session=' + app.app.session_interface.get_signing_serializer(app.app).dumps(session)
+    server = make_server('127.0.0.1', 0, app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return 'http://127.0.0.1:{}'.format(server.server_port), cookie, server.shutdown
+
+class Client:
+
+    def __init__(self, baseUrl: str, cookie: str):
+        self.baseUrl = baseUrl
+        self.cookie = cookie
+
+    def get(self, path: str) -> Sample:
+        start = time.perf_counter()
+        try:
+            body, _ = self.read(path)
+            return time.perf_counter() - start, len(body), True
+        except Exception:
+            return time.perf_counter() - start, 0, False
+
+    def read(self, path: str) -> Tuple[bytes, str]:
+        '''Body and final url (after redirects) of path.'''
+        request = urllib.request.Request(self.baseUrl + path, headers={'Cookie': self.cookie})
+        with urllib.request.urlopen(request, timeout=600) as response:
+            return response.read(), response.geturl()
+
+def runScenarios(client: Client, folderIds: List[str], shape: syntheticData.DatasetShape, args) -> Dict[str, Dict]:
+    scenarios = {}
+    massOverTimePaths = ['/data/{}/massOverTime.pb'.format(folderId) for folderId in folderIds]
+    scenarios['massOverTime.cold'] = runRequests(client, massOverTimePaths, args.concurrency)
+    scenarios['massOverTime.warm'] = runRequests(client, massOverTimePaths * args.repeat, args.concurrency)
+
+    tilePaths = []
+    for folderId in folderIds:
+        for location in range(1, shape.locations + 1):
+            for bundle in range(shape.bundlesPerLocation):
+                tilePaths.append('/data/{}/img_{}_{}.jpg'.format(folderId, location, bundle))
+                tilePaths.append('/data/{}/label_{}_{}.pb'.format(folderId, location, bundle))
+    scenarios['tileScroll.cold'] = runRequests(client, tilePaths, args.concurrency)
+    scenarios['tileScroll.warm'] = runRequests(client, tilePaths * args.repeat, args.concurrency)
+
+    scenarios['rebuild.full'] = runRebuilds(client, True, 1)
+    scenarios['rebuild.incremental'] = runRebuilds(client, False, args.repeat)
+    return scenarios
+
+def runRequests(client: Client, paths: List[str], concurrency: int) -> Dict:
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        samples = list(executor.map(client.get, paths))
+    return summarize(samples, time.perf_counter() - start)
+
+def runRebuilds(client: Client, force: bool, count: int) -> Dict:
+    '''Rebuilds one after the other, each timed from the request until its job has finished.'''
+    start = time.perf_counter()
+    samples = [runRebuild(client, force) for _ in range(count)]
+    return summarize(samples, time.perf_counter() - start)
+
+def runRebuild(client: Client, force: bool) -> Sample:
+    start = time.perf_counter()
+    try:
+        _, jobUrl = client.read('/data/update_dataset_list' + ('?force=1' if force else ''))
+        jobId = jobUrl.rstrip('/').rsplit('/', 1)[1]
+        while True:
+            job = json.loads(client.read('/data/jobs/{}.json'.format(jobId))[0])
+            if job['status'] in ('done', 'failed'):
+                break
+            time.sleep(0.05)
+        body, _ = client.read('/data/datasetList.json')
+        return time.perf_counter() - start, len(body), job['status'] == 'done'
+    except Exception:
+        return time.perf_counter() - start, 0, False
+
+def summarize(samples: List[Sample], seconds: float) -> Dict:
+    latencies = sorted(sample[0] for sample in samples)
+    totalBytes = sum(sample[1] for sample in samples)
+    return {
+        'requests': len(samples),
+        'errors': sum(1 for sample in samples if not sample[2]),
+        'seconds': seconds,
+        'requestsPerSecond': len(samples) / seconds if seconds > 0 else None,
+        'bytesPerSecond': totalBytes / seconds if seconds > 0 else None,
+        'p50': percentile(latencies, 0.5),
+        'p90': percentile(latencies, 0.9),
+        'p99': percentile(latencies, 0.99),
+        'max': latencies[-1] if len(latencies) > 0 else None,
+    }
+
+def percentile(sortedValues: List[float], fraction: float):
+    '''Nearest rank.'''
+    if len(sortedValues) == 0:
+        return None
+    return sortedValues[max(0, math.ceil(fraction * len(sortedValues)) - 1)]
+
+def gitCommit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO_PATH, stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except Exception:
+        return None
+
+if __name__ == '__main__':
+    main()
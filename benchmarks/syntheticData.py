@@ -0,0 +1,118 @@
+"""
+Writes synthetic datasets laid out the way the storage backends expect them:
+
+    <root>/<group>/<dataset>/.vizMetaData/experimentMetaData.json
+    <root>/<group>/<dataset>/.vizMetaData/massOverTime.pb
+    <root>/<group>/<dataset>/.vizMetaData/imageMetaData.json
+    <root>/<group>/<dataset>/data<N>/D<i>.jpg
+    <root>/<group>/<dataset>/data<N>/L<i>.pb
+
+massOverTime.pb (PbCurveList.proto) and the label bundles (RLE.proto) are valid
+messages with random values; image bundles are grayscale JPEGs of random noise,
+one column of tilesPerBundle tiles, which the server decodes for thumbnails.
+"""
+import io
+import json
+import os
+import random
+from typing import Dict, List, NamedTuple
+
+from PIL import Image
+
+import pbCurveList_pb2
+import RLE_pb2
+
+POINT_ATTR_NAMES = ['X', 'Y', 'Mass (pg)', 'Area', 'Mean Intensity', 'Time (h)', 'Frame ID', 'id']
+CURVE_ATTR_NAMES = ['id', 'Location ID', 'Mean Mass', 'Growth Rate']
+
+class DatasetShape(NamedTuple):
+    locations: int = 8
+    curvesPerLocation: int = 50
+    framesPerCurve: int = 100
+    bundlesPerLocation: int = 10
+    tilesPerBundle: int = 10
+    tileSize: int = 128
+    runsPerRow: int = 6
+    imageQuality: int = 90
+
+def writeDatasets(root: str, count: int, shape: DatasetShape, seed: int = 0) -> List[str]:
+    '''Writes count datasets below root/Data and returns their folder ids (paths relative to root, ':' separated).'''
+    rng = random.Random(seed)
+    folderIds = []
+    for i in range(count):
+        relativePath = 'Data/group{}/dataset{}'.format(i % 4, i)
+        writeDataset(os.path.join(root, relativePath), 'dataset{}'.format(i), shape, rng)
+        folderIds.append(relativePath.replace('/', ':'))
+    return folderIds
+
+def writeDataset(path: str, name: str, shape: DatasetShape, rng: random.Random) -> None:
+    vizMetaDataPath = os.path.join(path, '.vizMetaData')
+    os.makedirs(vizMetaDataPath, exist_ok=True)
+    writeFile(os.path.join(vizMetaDataPath, 'experimentMetaData.json'), json.dumps(experimentMetaData(name, shape)).encode('utf-8'))
+    writeFile(os.path.join(vizMetaDataPath, 'massOverTime.pb'), curveList(shape, rng).SerializeToString())
+    writeFile(os.path.join(vizMetaDataPath, 'imageMetaData.json'), json.dumps(imageMetaData(shape)).encode('utf-8'))
+    for location in range(1, shape.locations + 1):
+        dataPath = os.path.join(path, 'data{}'.format(location))
+        os.makedirs(dataPath, exist_ok=True)
+        for bundle in range(shape.bundlesPerLocation):
+            writeFile(os.path.join(dataPath, 'D{}.jpg'.format(bundle)), imageBundle(shape, rng))
+            writeFile(os.path.join(dataPath, 'L{}.pb'.format(bundle)), imageLabels(shape, rng).SerializeToString())
+
+def experimentMetaData(name: str, shape: DatasetShape) -> Dict:
+    return {
+        'displayName': name,
+        'locationMaps': {'Condition': {'A': [[1, shape.locations]]}},
+    }
+
+def imageMetaData(shape: DatasetShape) -> Dict:
+    return {
+        'tileWidth': shape.tileSize,
+        'tileHeight': shape.tileSize,
+        'numberOfTiles': shape.tilesPerBundle * shape.bundlesPerLocation,
+        'numberOfColumns': 1,
+    }
+
+def curveList(shape: DatasetShape, rng: random.Random) -> pbCurveList_pb2.PbCurveList:
+    message = pbCurveList_pb2.PbCurveList()
+    message.pointAttrNames.extend(POINT_ATTR_NAMES)
+    message.curveAttrNames.extend(CURVE_ATTR_NAMES)
+    curveId = 0
+    for location in range(1, shape.locations + 1):
+        for _ in range(shape.curvesPerLocation):
+            curveId += 1
+            curve = message.curveList.add()
+            curve.id = curveId
+            curve.valueList.extend([curveId, location, rng.uniform(50, 500), rng.uniform(-1, 1)])
+            x, y, mass = rng.uniform(0, 1000), rng.uniform(0, 1000), rng.uniform(50, 500)
+            for frame in range(1, shape.framesPerCurve + 1):
+                x += rng.gauss(0, 2)
+                y += rng.gauss(0, 2)
+                mass *= rng.uniform(0.99, 1.02)
+                point = curve.pointList.add()
+                point.valueList.extend([x, y, mass, rng.uniform(100, 2000), rng.uniform(0, 1), frame / 4.0, frame, curveId])
+    return message
+
+def imageBundle(shape: DatasetShape, rng: random.Random) -> bytes:
+    width, height = shape.tileSize, shape.tileSize * shape.tilesPerBundle
+    image = Image.frombytes('L', (width, height), rng.getrandbits(8 * width * height).to_bytes(width * height, 'little'))
+    output = io.BytesIO()
+    image.save(output, format='JPEG', quality=shape.imageQuality)
+    return output.getvalue()
+
+def imageLabels(shape: DatasetShape, rng: random.Random) -> RLE_pb2.ImageLabels:
+    message = RLE_pb2.ImageLabels()
+    for _ in range(shape.tilesPerBundle * shape.tileSize):
+        row = message.rowList.add()
+        start = 0
+        for _ in range(shape.runsPerRow):
+            start += rng.randint(0, shape.tileSize // shape.runsPerRow)
+            run = row.row.add()
+            run.start = start
+            run.length = rng.randint(1, shape.tileSize // shape.runsPerRow)
+            run.label = rng.randint(1, shape.curvesPerLocation)
+            start += run.length
+    return message
+
+def writeFile(path: str, data: bytes) -> None:
+    with open(path, 'wb') as f:
+        f.write(data)
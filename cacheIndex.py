@@ -0,0 +1,90 @@
+"""
+Persistent (SQLite) index of the datasets in static/cache: size and number of
+files (refreshed by every eviction scan), last access, hit count and whether the
+dataset is pinned, i.e. never evicted.
+
+Hits are counted in memory and written at most every FLUSH_INTERVAL seconds, so
+cache hits do not each pay for a database write.
+"""
+import threading
+import time
+from typing import Dict, List, Set, Tuple
+
+from database import Database
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS datasets (
+    folderId TEXT PRIMARY KEY,
+    size INTEGER NOT NULL DEFAULT 0,
+    files INTEGER NOT NULL DEFAULT 0,
+    lastAccess REAL NOT NULL DEFAULT 0,
+    hits INTEGER NOT NULL DEFAULT 0,
+    pinned INTEGER NOT NULL DEFAULT 0
+);
+"""
+FLUSH_INTERVAL = 5.0
+
+class CacheIndex:
+
+    def __init__(self, dbPath: str):
+        self.dbPath = dbPath
+        self._db = Database(dbPath, SCHEMA)
+        self._lock = threading.Lock()
+        # folderId -> (hits, last access) not yet written
+        self._pendingHits: Dict[str, Tuple[int, float]] = {}
+        self._lastFlush = time.time()
+
+    def recordHit(self, folderId: str) -> None:
+        now = time.time()
+        with self._lock:
+            hits, _ = self._pendingHits.get(folderId, (0, 0.0))
+            self._pendingHits[folderId] = (hits + 1, now)
+            due = now - self._lastFlush > FLUSH_INTERVAL
+        if due:
+            self.flush()
+
+    def flush(self) -> None:
+        with self._lock:
+            pending = self._pendingHits
+            self._pendingHits = {}
+            self._lastFlush = time.time()
+        if len(pending) == 0:
+            return
+        with self._db.connect() as conn:
+            conn.executemany('INSERT OR IGNORE INTO datasets (folderId) VALUES (?)', [(folderId,) for folderId in pending])
+            conn.executemany('UPDATE datasets SET hits = hits + ?, lastAccess = MAX(lastAccess, ?) WHERE folderId = ?',
+                [(hits, lastAccess, folderId) for folderId, (hits, lastAccess) in pending.items()])
+
+    def updateSizes(self, sizes: Dict[str, Tuple[int, int]]) -> None:
+        '''sizes: folderId -> (bytes, files) of every cached dataset. Datasets no longer cached are dropped unless pinned.'''
+        self.flush()
+        with self._db.connect() as conn:
+            conn.executemany('INSERT OR IGNORE INTO datasets (folderId) VALUES (?)', [(folderId,) for folderId in sizes])
+            conn.execute('UPDATE datasets SET size = 0, files = 0')
+            conn.executemany('UPDATE datasets SET size = ?, files = ? WHERE folderId = ?',
+                [(size, files, folderId) for folderId, (size, files) in sizes.items()])
+            conn.execute('DELETE FROM datasets WHERE files = 0 AND pinned = 0')
+
+    def datasets(self) -> List[Dict]:
+        self.flush()
+        with self._db.connect() as conn:
+            rows = conn.execute('SELECT folderId, size, files, lastAccess, hits, pinned FROM datasets ORDER BY size DESC').fetchall()
+        return [{'folderId': row[0], 'size': row[1], 'files': row[2], 'lastAccess': row[3], 'hits': row[4], 'pinned': row[5] == 1}
+            for row in rows]
+
+    def pinnedFolderIds(self) -> Set[str]:
+        with self._db.connect() as conn:
+            return {row[0] for row in conn.execute('SELECT folderId FROM datasets WHERE pinned = 1')}
+
+    def setPinned(self, folderId: str, pinned: bool) -> None:
+        with self._db.connect() as conn:
+            conn.execute('INSERT OR IGNORE INTO datasets (folderId) VALUES (?)', (folderId,))
+            conn.execute('UPDATE datasets SET pinned = ? WHERE folderId = ?', (1 if pinned else 0, folderId))
+
+    def forget(self, folderId: str) -> None:
+        '''After a purge; the pin survives it.'''
+        with self._lock:
+            self._pendingHits.pop(folderId, None)
+        with self._db.connect() as conn:
+            conn.execute('UPDATE datasets SET size = 0, files = 0, hits = 0 WHERE folderId = ?', (folderId,))
+            conn.execute('DELETE FROM datasets WHERE folderId = ? AND pinned = 0', (folderId,))
@@ -0,0 +1,141 @@
+"""
+Compressed copies of cached protobuf, json and packed files, stored next to the
+file as <file>.gz, and as <file>.br and <file>.zst when the brotli and zstandard
+packages are installed.
+
+They are made in background threads the first time the file is served and
+replaced files lose theirs (fileCache.removeVariants), so a variant is always
+the current version compressed. Clients get the variant they accept best, see
+app.negotiateEncoding; with CACHE_SERVE_MODE=accel nginx picks the .gz itself
+(gzip_static in nginx.conf).
+"""
+import os
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Set, Tuple
+
+import cpuBound
+import fileCache
+import settings
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSIBLE_EXTENSIONS = {'.pb', '.json', '.columns', '.labels'}
+# smaller files are not worth a second request's worth of bookkeeping
+MIN_SIZE = 1024
+# compressed a block at a time in cpuBound's threads, so a gevent worker keeps serving meanwhile
+BLOCK_SIZE = 1024 * 1024
+# encoding -> suffix, in order of preference (smallest output first)
+SUFFIXES = {'br': '.br', 'zstd': '.zst', 'gzip': '.gz'}
+# high, but fast enough for files of tens of MB
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 9
+ZSTD_LEVEL = 12
+
+_executor = ThreadPoolExecutor(max_workers=settings.COMPRESSION_WORKERS)
+_lock = threading.Lock()
+_pending: Set[str] = set()
+
+def encodings() -> List[str]:
+    '''Encodings that are both configured in CACHE_COMPRESSION and installed, in order of preference.'''
+    configured = [encoding.strip() for encoding in settings.CACHE_COMPRESSION.split(',')]
+    installed = {'br': brotli is not None, 'zstd': zstandard is not None, 'gzip': True}
+    return [encoding for encoding in SUFFIXES if encoding in configured and installed[encoding]]
+
+def isCompressible(path: str) -> bool:
+    return os.path.splitext(path)[1] in COMPRESSIBLE_EXTENSIONS
+
+def freshVariant(path: str, encoding: str) -> Optional[str]:
+    '''Path of the variant if it was compressed from the current version of path.'''
+    variantPath = path + SUFFIXES[encoding]
+    try:
+        return variantPath if os.path.getmtime(variantPath) >= os.path.getmtime(path) else None
+    except OSError:
+        return None
+
+def chooseVariant(path: str, acceptEncodings) -> Optional[Tuple[str, str]]:
+    '''(encoding, variant path) of the existing variant the client accepts best, preferring smaller ones on ties.'''
+    if not isCompressible(path):
+        return None
+    best = None
+    for encoding in encodings():
+        quality = acceptEncodings[encoding]
+        if quality <= 0 or (best is not None and quality <= best[0]):
+            continue
+        variantPath = freshVariant(path, encoding)
+        if variantPath is not None:
+            best = (quality, encoding, variantPath)
+    return None if best is None else (best[1], best[2])
+
+def schedule(path: str) -> None:
+    '''Queues compressing path unless all its variants exist or are being made.'''
+    if not isCompressible(path):
+        return
+    missing = [encoding for encoding in encodings() if freshVariant(path, encoding) is None]
+    if len(missing) == 0:
+        return
+    try:
+        if os.path.getsize(path) < MIN_SIZE:
+            return
+    except OSError:
+        return
+    with _lock:
+        if path in _pending:
+            return
+        _pending.add(path)
+    _executor.submit(compressFile, path, missing)
+
+def compressFile(path: str, encodings: List[str]) -> None:
+    try:
+        for encoding in encodings:
+            writeVariant(path, encoding)
+    except Exception as e:
+        print('ERROR: Failed to compress', path, e)
+    finally:
+        with _lock:
+            _pending.discard(path)
+
+def writeVariant(path: str, encoding: str) -> None:
+    sourceStat = os.stat(path)
+    compressor = newCompressor(encoding)
+    writer = fileCache.AtomicWriter(path + SUFFIXES[encoding])
+    try:
+        with open(path, 'rb') as source:
+            for block in iter(lambda: source.read(BLOCK_SIZE), b''):
+                writer.write(cpuBound.run(compressor.compress, block))
+        writer.write(cpuBound.run(compressor.flush))
+        writer.commit()
+    finally:
+        writer.discard()
+    currentStat = os.stat(path)
+    if (currentStat.st_mtime, currentStat.st_size) != (sourceStat.st_mtime, sourceStat.st_size):
+        # replaced while we were reading it
+        fileCache.removeVariants(path)
+
+def newCompressor(encoding: str):
+    '''An object with compress(data) and flush(), like zlib's.'''
+    if encoding == 'br':
+        return BrotliCompressor()
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    # wbits 31: gzip header and trailer
+    return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+class BrotliCompressor:
+
+    def __init__(self):
+        self._compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.process(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.finish()
@@ -0,0 +1,33 @@
+"""
+Runs CPU-bound work (protobuf decoding, column transcoding, summaries, md5 of
+large files) without stalling the process.
+
+Under the gevent worker every request shares one OS thread, so a computation of
+seconds would hold up all of them; there the work goes to gevent's thread pool
+and the calling greenlet waits for it. Otherwise it runs in the calling thread.
+The function must not take gevent-patched locks: its thread is not a greenlet.
+"""
+from typing import Callable, Optional, Tuple, TypeVar
+
+try:
+    import gevent
+    import gevent.monkey
+except ImportError:
+    gevent = None
+
+T = TypeVar('T')
+
+def run(function: Callable[..., T], *args) -> T:
+    if gevent is not None and gevent.monkey.is_module_patched('threading'):
+        result, error = gevent.get_hub().threadpool.apply(capture, (function, args))
+        if error is not None:
+            raise error
+        return result
+    return function(*args)
+
+def capture(function: Callable[..., T], args: Tuple) -> Tuple[Optional[T], Optional[Exception]]:
+    '''The pool prints a traceback for every exception it passes on, expected ones (bad queries, say) included.'''
+    try:
+        return function(*args), None
+    except Exception as e:
+        return None, e
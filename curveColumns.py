@@ -0,0 +1,211 @@
+"""
+Column-oriented encoding of a PbCurveList (massOverTime.pb).
+
+The protobuf stores every point as its own message with a repeated float list,
+which is large on the wire and decoded object by object in the browser. The
+columnar file (a packedArrays container with magic 'LCOL') stores each attribute
+as one contiguous array that can be wrapped in a Float32Array without copying.
+
+The header lists pointAttrNames, curveAttrNames, curveCount and pointCount, and
+the arrays are:
+
+    curveId                 uint32[curveCount]
+    curveOffsets            uint32[curveCount + 1], points of curve i are [curveOffsets[i], curveOffsets[i + 1])
+    curve:<curveAttrName>   float32[curveCount], one per curve attribute
+    point:<pointAttrName>   float32[pointCount], one per point attribute
+
+CurveColumns opens such a file memory-mapped and answers subset queries (by
+location, frame range, curve id and attribute) with NumPy, without decoding the
+protobuf again.
+"""
+import itertools
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+import cpuBound
+import packedArrays
+import pbCurveList_pb2
+
+MAGIC = b'LCOL'
+VERSION = 1
+MIMETYPE = 'application/vnd.loon.columns'
+LOCATION_ATTR = 'Location ID'
+FRAME_ATTR = 'Frame ID'
+
+def transcodeFile(pbPath: str, columnsPath: str, meta: Dict) -> None:
+    packedArrays.writePacked(columnsPath, cpuBound.run(transcode, pbPath), meta)
+
+def transcode(pbPath: str) -> List[bytes]:
+    with open(pbPath, 'rb') as pbFile:
+        curveList = pbCurveList_pb2.PbCurveList.FromString(pbFile.read())
+    return encodeColumns(*curveListToColumns(curveList))
+
+def curveListToColumns(curveList: pbCurveList_pb2.PbCurveList) -> Tuple[List[str], List[str], np.ndarray, np.ndarray, Dict[str, np.ndarray], Dict[str, np.ndarray]]:
+    '''(pointAttrNames, curveAttrNames, curveIds, curveOffsets, curve attribute columns, point attribute columns)'''
+    pointAttrNames = list(curveList.pointAttrNames)
+    curveAttrNames = list(curveList.curveAttrNames)
+    curves = curveList.curveList
+    curveCount = len(curves)
+
+    curveIds = np.fromiter((curve.id for curve in curves), dtype='<u4', count=curveCount)
+    pointCounts = np.fromiter((len(curve.pointList) for curve in curves), dtype='<u4', count=curveCount)
+    curveOffsets = np.zeros(curveCount + 1, dtype='<u4')
+    np.cumsum(pointCounts, out=curveOffsets[1:])
+    pointCount = int(curveOffsets[-1])
+
+    curveValues = flattenValues((curve.valueList for curve in curves), curveCount, len(curveAttrNames), 'curve')
+    pointValues = flattenValues((point.valueList for curve in curves for point in curve.pointList), pointCount, len(pointAttrNames), 'point')
+    curveColumns = {name: curveValues[:, i] for i, name in enumerate(curveAttrNames)}
+    pointColumns = {name: pointValues[:, i] for i, name in enumerate(pointAttrNames)}
+    return pointAttrNames, curveAttrNames, curveIds, curveOffsets, curveColumns, pointColumns
+
+def flattenValues(valueLists, count: int, width: int, kind: str) -> np.ndarray:
+    lengths = []
+    def checked(valueList):
+        lengths.append(len(valueList))
+        return valueList
+    flat = np.fromiter(itertools.chain.from_iterable(checked(v) for v in valueLists), dtype='<f4')
+    if len(lengths) != count or flat.size != count * width or any(length != width for length in lengths):
+        raise ValueError('every {} must have one value per {} attribute'.format(kind, kind))
+    return flat.reshape(count, width)
+
+def encodeColumns(pointAttrNames: List[str], curveAttrNames: List[str], curveIds: np.ndarray, curveOffsets: np.ndarray,
+        curveColumns: Dict[str, np.ndarray], pointColumns: Dict[str, np.ndarray]) -> List[bytes]:
+    named = [('curveId', curveIds.astype('<u4')), ('curveOffsets', curveOffsets.astype('<u4'))]
+    named += [('curve:' + name, curveColumns[name].astype('<f4')) for name in curveAttrNames]
+    named += [('point:' + name, pointColumns[name].astype('<f4')) for name in pointAttrNames]
+    fields = {
+        'pointAttrNames': pointAttrNames,
+        'curveAttrNames': curveAttrNames,
+        'curveCount': len(curveIds),
+        'pointCount': int(curveOffsets[-1]),
+    }
+    return packedArrays.pack(MAGIC, VERSION, fields, named)
+
+class CurveColumns:
+    """A columnar file opened memory-mapped, so only the pages a query touches are read."""
+
+    def __init__(self, path: str):
+        header, arrays = packedArrays.unpack(np.memmap(path, dtype='u1', mode='r'), MAGIC, VERSION)
+        self.pointAttrNames: List[str] = header['pointAttrNames']
+        self.curveAttrNames: List[str] = header['curveAttrNames']
+        self.curveIds: np.ndarray = arrays['curveId']
+        self.curveOffsets: np.ndarray = arrays['curveOffsets']
+        self.curveColumns = {name: arrays['curve:' + name] for name in self.curveAttrNames}
+        self.pointColumns = {name: arrays['point:' + name] for name in self.pointAttrNames}
+
+    def subset(self, locations: Optional[List[int]] = None, frameStart: Optional[float] = None, frameEnd: Optional[float] = None,
+            curveIds: Optional[List[int]] = None, pointAttrNames: Optional[List[str]] = None, curveAttrNames: Optional[List[str]] = None):
+        '''
+        Curves in any of locations and curveIds, keeping only their points with
+        frameStart <= Frame ID <= frameEnd and only the named attributes. Curves left
+        without points by the frame range are dropped. Returns the same tuple as
+        curveListToColumns.
+        '''
+        pointAttrNames = self.pointAttrNames if pointAttrNames is None else pointAttrNames
+        curveAttrNames = self.curveAttrNames if curveAttrNames is None else curveAttrNames
+        for name in pointAttrNames:
+            if name not in self.pointColumns:
+                raise ValueError('unknown point attribute: ' + name)
+        for name in curveAttrNames:
+            if name not in self.curveColumns:
+                raise ValueError('unknown curve attribute: ' + name)
+
+        curveMask = np.ones(len(self.curveIds), dtype=bool)
+        if locations is not None:
+            curveMask &= np.isin(self.requireColumn(self.curveColumns, LOCATION_ATTR), locations)
+        if curveIds is not None:
+            curveMask &= np.isin(self.curveIds, curveIds)
+
+        pointCounts = np.diff(self.curveOffsets)
+        if frameStart is None and frameEnd is None:
+            keptCurves = np.flatnonzero(curveMask)
+            # whole curves, so points are taken as contiguous runs
+            pointIndex = concatenateRanges(self.curveOffsets[keptCurves], self.curveOffsets[keptCurves + 1])
+            keptCounts = pointCounts[keptCurves]
+        else:
+            pointMask = np.repeat(curveMask, pointCounts)
+            frames = self.requireColumn(self.pointColumns, FRAME_ATTR)
+            if frameStart is not None:
+                pointMask &= frames >= frameStart
+            if frameEnd is not None:
+                pointMask &= frames <= frameEnd
+            pointIndex = np.flatnonzero(pointMask)
+            pointCurve = np.repeat(np.arange(len(self.curveIds)), pointCounts)
+            newCounts = np.bincount(pointCurve[pointIndex], minlength=len(self.curveIds))
+            keptCurves = np.flatnonzero(curveMask & (newCounts > 0))
+            keptCounts = newCounts[keptCurves]
+
+        offsets = np.zeros(len(keptCurves) + 1, dtype='<u4')
+        np.cumsum(keptCounts, out=offsets[1:])
+        curveColumns = {name: self.curveColumns[name][keptCurves] for name in curveAttrNames}
+        pointColumns = {name: self.pointColumns[name][pointIndex] for name in pointAttrNames}
+        return list(pointAttrNames), list(curveAttrNames), self.curveIds[keptCurves], offsets, curveColumns, pointColumns
+
+    @staticmethod
+    def requireColumn(columns: Dict[str, np.ndarray], name: str) -> np.ndarray:
+        if name not in columns:
+            raise ValueError('dataset has no {} attribute'.format(name))
+        return columns[name]
+
+def concatenateRanges(starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    '''np.concatenate([np.arange(s, e) for s, e in zip(starts, ends)]) without the python loop.'''
+    lengths = (ends - starts).astype(np.int64)
+    total = int(lengths.sum())
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+    nonEmpty = lengths > 0
+    starts, lengths = starts[nonEmpty].astype(np.int64), lengths[nonEmpty]
+    steps = np.ones(total, dtype=np.int64)
+    runStarts = np.zeros(len(lengths), dtype=np.int64)
+    np.cumsum(lengths[:-1], out=runStarts[1:])
+    steps[0] = starts[0]
+    steps[runStarts[1:]] = starts[1:] - (starts[:-1] + lengths[:-1] - 1)
+    return np.cumsum(steps)
+
+def columnsToCurveList(pointAttrNames: List[str], curveAttrNames: List[str], curveIds: np.ndarray, curveOffsets: np.ndarray,
+        curveColumns: Dict[str, np.ndarray], pointColumns: Dict[str, np.ndarray]) -> pbCurveList_pb2.PbCurveList:
+    curveList = pbCurveList_pb2.PbCurveList()
+    curveList.pointAttrNames.extend(pointAttrNames)
+    curveList.curveAttrNames.extend(curveAttrNames)
+    curveValues = np.column_stack([curveColumns[name] for name in curveAttrNames]).tolist() if len(curveAttrNames) > 0 else [[]] * len(curveIds)
+    pointValues = np.column_stack([pointColumns[name] for name in pointAttrNames]).tolist() if len(pointAttrNames) > 0 else [[]] * int(curveOffsets[-1])
+    offsets = curveOffsets.tolist()
+    for i, curveId in enumerate(curveIds.tolist()):
+        curve = curveList.curveList.add()
+        curve.id = curveId
+        curve.valueList.extend(curveValues[i])
+        for valueList in pointValues[offsets[i]:offsets[i + 1]]:
+            curve.pointList.add().valueList.extend(valueList)
+    return curveList
+
+def encodeSubset(columns: CurveColumns, query: Dict, asColumns: bool) -> bytes:
+    '''columns.subset(**query) as a columnar file, or as a serialized PbCurveList; run through cpuBound.'''
+    subset = columns.subset(**query)
+    if asColumns:
+        return b''.join(encodeColumns(*subset))
+    return columnsToCurveList(*subset).SerializeToString()
+
+_openLock = threading.Lock()
+# path -> (mtime, CurveColumns), opened files are shared between requests
+_openFiles: 'OrderedDict[str, Tuple[float, CurveColumns]]' = OrderedDict()
+MAX_OPEN_FILES = 16
+
+def openColumns(path: str) -> CurveColumns:
+    mtime = os.path.getmtime(path)
+    with _openLock:
+        entry = _openFiles.get(path, None)
+        if entry is not None and entry[0] == mtime:
+            _openFiles.move_to_end(path)
+            return entry[1]
+    columns = CurveColumns(path)
+    with _openLock:
+        _openFiles[path] = (mtime, columns)
+        _openFiles.move_to_end(path)
+        while len(_openFiles) > MAX_OPEN_FILES:
+            _openFiles.popitem(last=False)
+    return columns
@@ -0,0 +1,68 @@
+"""
+Summary statistics of a massOverTime dataset, computed once per version of
+massOverTime.pb from its columnar form (see curveColumns.py):
+
+    attributes      per curve and point attribute: count, min, max, mean, quantiles
+                    and a fixed-bin histogram between min and max
+    locations       number of curves and points per Location ID
+    frames          number of points (cells) per Frame ID
+"""
+import json
+from typing import Dict, List, Union
+
+import numpy as np
+
+import cpuBound
+import fileCache
+from curveColumns import CurveColumns, FRAME_ATTR, LOCATION_ATTR
+
+VERSION = 1
+QUANTILES = [0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99]
+HISTOGRAM_BINS = 64
+
+def writeSummary(columns: CurveColumns, summaryPath: str, meta: Dict) -> None:
+    fileCache.writeAtomic(summaryPath, json.dumps(cpuBound.run(summarize, columns)), False, meta)
+
+def summarize(columns: CurveColumns) -> Dict:
+    pointCounts = np.diff(columns.curveOffsets)
+    summary = {
+        'version': VERSION,
+        'curveCount': int(len(columns.curveIds)),
+        'pointCount': int(columns.curveOffsets[-1]),
+        'quantiles': QUANTILES,
+        'curveAttributes': {name: attributeSummary(columns.curveColumns[name]) for name in columns.curveAttrNames},
+        'pointAttributes': {name: attributeSummary(columns.pointColumns[name]) for name in columns.pointAttrNames},
+    }
+    if LOCATION_ATTR in columns.curveColumns:
+        locations = columns.curveColumns[LOCATION_ATTR]
+        values, inverse = np.unique(locations, return_inverse=True)
+        summary['locations'] = {
+            'values': finiteList(values),
+            'curveCounts': np.bincount(inverse, minlength=len(values)).tolist(),
+            'pointCounts': np.bincount(inverse, weights=pointCounts, minlength=len(values)).astype(np.int64).tolist(),
+        }
+    if FRAME_ATTR in columns.pointColumns:
+        values, counts = np.unique(columns.pointColumns[FRAME_ATTR], return_counts=True)
+        summary['frames'] = {'values': finiteList(values), 'pointCounts': counts.tolist()}
+    return summary
+
+def attributeSummary(values: np.ndarray) -> Dict:
+    values = np.asarray(values, dtype=np.float64)
+    finite = values[np.isfinite(values)]
+    if len(finite) == 0:
+        return {'count': 0, 'missing': int(len(values)), 'min': None, 'max': None, 'mean': None, 'quantiles': None, 'histogram': None}
+    low, high = float(finite.min()), float(finite.max())
+    counts, edges = np.histogram(finite, bins=HISTOGRAM_BINS, range=(low, high) if high > low else (low - 0.5, low + 0.5))
+    return {
+        'count': int(len(finite)),
+        'missing': int(len(values) - len(finite)),
+        'min': low,
+        'max': high,
+        'mean': float(finite.mean()),
+        'quantiles': np.quantile(finite, QUANTILES).tolist(),
+        'histogram': {'edges': edges.tolist(), 'counts': counts.tolist()},
+    }
+
+def finiteList(values: np.ndarray) -> List[Union[float, None]]:
+    '''JSON has no NaN, missing values are written as null.'''
+    return [value if np.isfinite(value) else None for value in values.astype(np.float64).tolist()]
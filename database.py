@@ -0,0 +1,44 @@
+"""
+SQLite databases of the persistent indices (pathIndex, cacheIndex, datasetCatalog,
+folderAccess). The file and its folder are created on first use, in WAL mode so
+readers in other processes do not wait for writers.
+
+Each process keeps one connection per database, used by one thread at a time.
+Under the gevent worker threading.local is per greenlet, so a connection per
+thread would mean a new connection (and schema script) for every request.
+"""
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+class Database:
+
+    def __init__(self, dbPath: str, schema: str):
+        self.dbPath = dbPath
+        self.schema = schema
+        # reentrant, so a method holding the connection may call another that takes it
+        self._lock = threading.RLock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._pid: Optional[int] = None
+
+    @contextmanager
+    def connect(self) -> Iterator[sqlite3.Connection]:
+        '''The connection for the duration of the block; its writes are committed at the end, or rolled back if it raises.'''
+        with self._lock:
+            if self._conn is None or self._pid != os.getpid():
+                # a forked process opens its own
+                self._conn = self._open()
+                self._pid = os.getpid()
+            with self._conn:
+                yield self._conn
+
+    def _open(self) -> sqlite3.Connection:
+        folder = os.path.dirname(self.dbPath)
+        if folder != '' and not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+        conn = sqlite3.connect(self.dbPath, timeout=30, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript(self.schema)
+        return conn
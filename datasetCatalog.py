@@ -0,0 +1,117 @@
+"""
+Persistent (SQLite) catalog of the datasets in the dataset list, one row per
+dataset with the fields the overview page filters and sorts on plus its entry as
+it appears in combined.json.
+
+Rebuilds of the dataset list only write the datasets that changed, and every
+change bumps the catalog version, which /data/datasets.json uses as its ETag.
+"""
+import json
+import sqlite3
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from database import Database
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS datasets (
+    uniqueId TEXT PRIMARY KEY,
+    displayName TEXT NOT NULL,
+    author TEXT NOT NULL,
+    folder TEXT NOT NULL,
+    modifiedDate TEXT NOT NULL,
+    fileSize REAL NOT NULL,
+    entry TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS datasetsByAuthor ON datasets (author);
+CREATE INDEX IF NOT EXISTS datasetsByModifiedDate ON datasets (modifiedDate);
+CREATE INDEX IF NOT EXISTS datasetsByFileSize ON datasets (fileSize);
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+SORT_COLUMNS = ('displayName', 'author', 'folder', 'modifiedDate', 'fileSize')
+MAX_PAGE_SIZE = 500
+
+class DatasetCatalog:
+
+    def __init__(self, dbPath: str):
+        self.dbPath = dbPath
+        self._db = Database(dbPath, SCHEMA)
+
+    def uniqueIds(self) -> Set[str]:
+        with self._db.connect() as conn:
+            return {row[0] for row in conn.execute('SELECT uniqueId FROM datasets')}
+
+    def update(self, entries: Iterable[Dict], keepIds: Set[str]) -> int:
+        '''Writes the entries (combined.json form), drops datasets not in keepIds; returns the version.'''
+        rows = [(entry['uniqueId'], entry.get('displayName', ''), entry.get('author', ''), entry.get('folder', ''),
+            entry.get('modifiedDate', ''), float(entry.get('fileSize', 0)), json.dumps(entry)) for entry in entries]
+        with self._db.connect() as conn:
+            removedIds = [row for row in conn.execute('SELECT uniqueId FROM datasets') if row[0] not in keepIds]
+            conn.executemany('INSERT OR REPLACE INTO datasets VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+            conn.executemany('DELETE FROM datasets WHERE uniqueId = ?', removedIds)
+            if len(rows) > 0 or len(removedIds) > 0:
+                conn.execute("INSERT OR REPLACE INTO state VALUES ('version', ?)", (str(self._version(conn) + 1),))
+            return self._version(conn)
+
+    def version(self) -> int:
+        with self._db.connect() as conn:
+            return self._version(conn)
+
+    def search(self, text: Optional[str] = None, authors: Optional[List[str]] = None, folder: Optional[str] = None,
+            modifiedFrom: Optional[str] = None, modifiedTo: Optional[str] = None, minSize: Optional[float] = None,
+            maxSize: Optional[float] = None, sort: str = 'modifiedDate', descending: bool = True,
+            page: int = 1, pageSize: int = 50) -> Tuple[int, List[Dict]]:
+        '''
+        (number of matches, entries of the page). Every word of text has to appear in
+        displayName, folder is a prefix, dates are YYYY-MM-DD and inclusive, sizes are MB.
+        '''
+        if sort not in SORT_COLUMNS:
+            raise ValueError('sort must be one of ' + ', '.join(SORT_COLUMNS))
+        if page < 1 or pageSize < 1 or pageSize > MAX_PAGE_SIZE:
+            raise ValueError('page must be at least 1 and pageSize between 1 and {}'.format(MAX_PAGE_SIZE))
+        conditions = []
+        params = []
+        for word in (text or '').split():
+            conditions.append("displayName LIKE ? ESCAPE '\\'")
+            params.append('%' + escapeLike(word) + '%')
+        if authors:
+            conditions.append('author IN ({})'.format(', '.join('?' * len(authors))))
+            params.extend(authors)
+        if folder:
+            conditions.append("folder LIKE ? ESCAPE '\\'")
+            params.append(escapeLike(folder) + '%')
+        for condition, value in (('modifiedDate >= ?', modifiedFrom), ('modifiedDate <= ?', modifiedTo),
+                ('fileSize >= ?', minSize), ('fileSize <= ?', maxSize)):
+            if value is not None:
+                conditions.append(condition)
+                params.append(value)
+        where = ' WHERE ' + ' AND '.join(conditions) if len(conditions) > 0 else ''
+
+        with self._db.connect() as conn:
+            total = conn.execute('SELECT COUNT(*) FROM datasets' + where, params).fetchone()[0]
+            # uniqueId breaks ties, so pages do not overlap
+            rows = conn.execute('SELECT entry FROM datasets{} ORDER BY {} {}, uniqueId LIMIT ? OFFSET ?'.format(
+                where, sort, 'DESC' if descending else 'ASC'), params + [pageSize, (page - 1) * pageSize]).fetchall()
+        return total, [json.loads(row[0]) for row in rows]
+
+    def facets(self) -> Dict:
+        '''Values to offer in the filters: every author and the range of file sizes (MB).'''
+        with self._db.connect() as conn:
+            authors = [row[0] for row in conn.execute('SELECT DISTINCT author FROM datasets ORDER BY author')]
+            maxSize = conn.execute('SELECT MAX(fileSize) FROM datasets').fetchone()[0]
+        return {'authorList': authors, 'sizeRange': [0, maxSize or 0]}
+
+    def entries(self) -> List[Dict]:
+        with self._db.connect() as conn:
+            rows = conn.execute('SELECT entry FROM datasets ORDER BY uniqueId').fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def _version(self, conn: sqlite3.Connection) -> int:
+        row = conn.execute("SELECT value FROM state WHERE key = 'version'").fetchone()
+        return 0 if row is None else int(row[0])
+
+
+def escapeLike(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
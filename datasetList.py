@@ -0,0 +1,233 @@
+"""
+Builds static/cache/datasetList from every '.vizMetaData' folder in storage.
+
+Datasets are processed concurrently, ancestor folders shared between datasets are
+looked up once, and datasets whose experimentMetaData.json and massOverTime.pb have
+not changed since the previous rebuild keep their existing spec file and catalog
+entry (see datasetCatalog.py). Those files are compared by their listing, as
+writing a file changes neither a Drive folder's modifiedTime nor a local folder's
+mtime. derived/combined.json is written from the catalog.
+"""
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+import fileCache
+import settings
+import storage
+from datasetCatalog import DatasetCatalog
+from storage import StorageBackend
+
+DATASET_LIST_PATH = './static/cache/datasetList/'
+REBUILD_STATE_PATH = DATASET_LIST_PATH + 'derived/rebuildState.json'
+COMBINED_PATH = DATASET_LIST_PATH + 'derived/combined.json'
+# the files of '.vizMetaData' a spec is built from
+SPEC_SOURCE_FILES = ('experimentMetaData.json', 'massOverTime.pb')
+
+catalog = DatasetCatalog(os.path.join(settings.DATABASE_FOLDER, 'catalog.sqlite'))
+
+# (done, total, message)
+ProgressCallback = Callable[[int, int, str], None]
+
+class FolderNameCache:
+    """Memoized (name, parentId) of folders, shared by all datasets of one rebuild."""
+
+    def __init__(self, backend: StorageBackend):
+        self.backend = backend
+        self._folders: Dict[str, Tuple[str, Optional[str]]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, folderId: str) -> Tuple[str, Optional[str]]:
+        with self._lock:
+            folder = self._folders.get(folderId, None)
+        if folder is None:
+            folderInfo = self.backend.stat(folderId)
+            parentId = folderInfo.parents[0] if len(folderInfo.parents) > 0 else None
+            folder = (folderInfo.name, parentId)
+            with self._lock:
+                self._folders[folderId] = folder
+        return folder
+
+def rebuildDatasetList(backend: StorageBackend, force: bool = False, progress: Optional[ProgressCallback] = None) -> Tuple[List[str], str]:
+    candidateFiles = backend.findFoldersByName('.vizMetaData')
+    print('Number of .vizMetaDataFolders:', len(candidateFiles))
+    previousState = {} if force else loadRebuildState()
+    folderNames = FolderNameCache(backend)
+    # folderId -> sourceVersions, written by the threads below, one key each
+    sources: Dict[str, Dict[str, List]] = {}
+    doneCount = [0]
+    doneLock = threading.Lock()
+
+    def build(candidateFile: storage.FileInfo) -> Tuple[Union[Dict, None], str, bool]:
+        try:
+            children = {child.name: child for child in backend.listChildren(candidateFile.id)}
+            sources[candidateFile.id] = sourceVersions(children)
+            previous = previousState.get(candidateFile.id, None)
+            if previous is not None and previous['modifiedTime'] == candidateFile.modifiedTime \
+                    and previous.get('sources', None) == sources[candidateFile.id] \
+                    and os.path.exists(specPath(previous['uniqueId'])):
+                return None, previous['uniqueId'], True
+            dataSpecObj, msg = getDataSpecObj(backend, candidateFile, children, folderNames)
+            return dataSpecObj, msg, False
+        except Exception as e:
+            return None, 'Error: {}'.format(e), False
+        finally:
+            with doneLock:
+                doneCount[0] += 1
+                if progress is not None:
+                    progress(doneCount[0], len(candidateFiles), candidateFile.id)
+
+    with ThreadPoolExecutor(max_workers=settings.DATASET_LIST_WORKERS) as executor:
+        results = list(executor.map(build, candidateFiles))
+
+    skipCount = 0
+    unchangedCount = 0
+    filenameSet = set()
+    textLines = []
+    newState = {}
+    catalogIds = catalog.uniqueIds()
+    catalogEntries = []
+    keepIds = set()
+    for candidateFile, (dataSpecObj, msg, unchanged) in zip(candidateFiles, results):
+        folderId = candidateFile.id
+        if unchanged:
+            filename = msg
+        elif dataSpecObj is None:
+            textLines.append('FAIL (' + msg + ') - ' + folderId)
+            skipCount += 1
+            # listed as it was until a rebuild gets through
+            if folderId in previousState:
+                keepIds.add(previousState[folderId]['uniqueId'])
+            continue
+        else:
+            filename = dataSpecObj['uniqueId']
+        if filename in filenameSet:
+            textLines.append('FAIL (duplicate filename[' + filename + ']) - ' + folderId)
+            # Google allows two file of the same name in a folder.
+            # I do not.
+            continue
+        filenameSet.add(filename)
+        newState[folderId] = {'modifiedTime': candidateFile.modifiedTime, 'sources': sources[folderId], 'uniqueId': filename}
+        if unchanged:
+            textLines.append('PASS (unchanged) - ' + folderId)
+            unchangedCount += 1
+            if filename not in catalogIds:
+                # specs written before the catalog existed
+                with open(specPath(filename), 'r') as specFile:
+                    catalogEntries.append(catalogEntry(json.load(specFile)))
+            continue
+        textLines.append('PASS - ' + folderId)
+        # replaced atomically, together with its compressed copies
+        fileCache.writeAtomic(specPath(filename), json.dumps(dataSpecObj), False)
+        catalogEntries.append(catalogEntry(dataSpecObj))
+    saveRebuildState(newState)
+    catalog.update(catalogEntries, keepIds | filenameSet)
+    summaryText = 'Total: {}; '.format(len(candidateFiles))
+    summaryText += 'Passed: {}; '.format(len(candidateFiles) - skipCount)
+    summaryText += 'Unchanged: {}; '.format(unchangedCount)
+    summaryText += 'Failed: {}; '.format(skipCount)
+    writeCombined()
+    return textLines, summaryText
+
+def getDataSpecObj(backend: StorageBackend, vizMetaDataFolder: storage.FileInfo, children: Dict[str, storage.FileInfo],
+        folderNames: FolderNameCache) -> Tuple[Union[Dict, None], str]:
+    '''children are the files of vizMetaDataFolder by name.'''
+    folderId = vizMetaDataFolder.id
+    metaDataFileInfo = children.get('experimentMetaData.json', None)
+    if metaDataFileInfo is None:
+        msg = 'Missing experimentMetaData.json in ' +  folderId
+        print('\tgetDataSpecObj:' + msg)
+        return None, msg
+
+    massOverTimeFile = children.get('massOverTime.pb', None)
+    if massOverTimeFile is None:
+        msg = 'Missing massOverTime.pb in ' + folderId
+        print('\tgetDataSpecObj: ' + msg)
+        return None, msg
+
+    dataSpecObj = json.loads(backend.read(metaDataFileInfo.id))
+
+    parentId = vizMetaDataFolder.parents[0]
+    folderPathList = getFolderPath(folderNames, settings.TOP_GOOGLE_DRIVE_FOLDER_ID, parentId)
+    unknownFolder = False
+    if len(folderPathList) == 0:
+        unknownFolder = True
+        msg = 'Cannot find ' + parentId + ' in ' + settings.TOP_GOOGLE_DRIVE_FOLDER_ID
+        print('\tgetDataSpecObj: ' + msg)
+        # return None, msg
+
+    dataSpecObj['googleDriveId'] = parentId
+    if dataSpecObj.get('folder', '') == '':
+        if unknownFolder:
+            dataSpecObj['folder'] = 'unknown'
+        else:
+            dataSpecObj['folder'] = '/'.join(folderPathList) + '/'
+    if dataSpecObj.get('author', '') == '':
+        dataSpecObj['author'] = vizMetaDataFolder.owner
+    if dataSpecObj.get('displayName', '') == '':
+        if unknownFolder:
+            dataSpecObj['displayName'] = 'unkown'
+        else:
+            # local storage trees can be shallower than the Drive hierarchy
+            dataSpecObj['displayName'] = folderPathList[min(2, len(folderPathList) - 1)] + '/.../' + folderPathList[-1]
+    if dataSpecObj.get('uniqueId', '') == '':
+        dataSpecObj['uniqueId'] = parentId
+    dataSpecObj['modifiedDate'] = datetime.utcfromtimestamp(vizMetaDataFolder.modifiedTime).strftime('%Y-%m-%d')
+    dataSpecObj['fileSize'] = str(massOverTimeFile.size)
+    return dataSpecObj, 'OK'
+
+def sourceVersions(children: Dict[str, storage.FileInfo]) -> Dict[str, List]:
+    '''What identifies the version of each file a spec is built from, as stored in rebuildState.json.'''
+    versions = {}
+    for name in SPEC_SOURCE_FILES:
+        child = children.get(name, None)
+        if child is not None:
+            versions[name] = [child.id, child.size, child.modifiedTime, child.md5Checksum]
+    return versions
+
+def getFolderPath(folderNames: FolderNameCache, topDir, bottomDir) -> List[str]:
+    pathList = []
+    currentDir = bottomDir
+    while currentDir != topDir:
+        name, parentId = folderNames.get(currentDir)
+        if parentId is None:
+            return []
+        pathList.append(name)
+        currentDir = parentId
+    pathList.append('Data')
+    pathList.reverse()
+    return pathList
+
+def specPath(uniqueId: str) -> str:
+    return DATASET_LIST_PATH + uniqueId + '.json'
+
+def loadRebuildState() -> Dict[str, Dict]:
+    if not os.path.exists(REBUILD_STATE_PATH):
+        return {}
+    with open(REBUILD_STATE_PATH, 'r') as stateFile:
+        return json.load(stateFile)
+
+def saveRebuildState(state: Dict[str, Dict]) -> None:
+    os.makedirs(os.path.dirname(REBUILD_STATE_PATH), exist_ok=True)
+    with open(REBUILD_STATE_PATH, 'w') as stateFile:
+        json.dump(state, stateFile)
+
+def writeCombined() -> None:
+    '''The whole catalog in one file, for clients that do not page through /data/datasets.json.'''
+    totalDatset = catalog.facets()
+    totalDatset['datasetList'] = catalog.entries()
+    fileCache.writeAtomic(COMBINED_PATH, json.dumps(totalDatset, indent=4), False)
+
+def catalogEntry(dataSpecObj: Dict) -> Dict:
+    '''A dataset as listed: with links, fileSize in MB and without its locationMaps.'''
+    fileSpecObj = dict(dataSpecObj)
+    id = fileSpecObj['uniqueId']
+    fileSpecObj['vizLinkHtml'] = '<a href="/detailedView/{}" target="_blank">Viz Link</a>'.format(id)
+    driveUrl = 'https://drive.google.com/drive/u/1/folders/{}'.format(fileSpecObj['googleDriveId'])
+    fileSpecObj['driveLinkHtml'] = '<a href="{}" target="_blank">Drive Link</a>'.format(driveUrl)
+    fileSpecObj['fileSize'] = int(fileSpecObj['fileSize']) / (1024 * 1024.0)
+    fileSpecObj.pop('locationMaps', None) # there is no point in copying these over
+    return fileSpecObj
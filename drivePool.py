@@ -0,0 +1,124 @@
+"""
+Per-process pool of Drive service clients, keyed by credential.
+
+Building a service fetches and parses the discovery document and opens a new TLS
+connection, which dominates the latency of small requests. Services are leased to
+one thread at a time (httplib2 is not thread safe) and returned afterwards, so
+their keep-alive connections are reused by later requests with the same credential.
+Credentials objects are shared per key as well, so a token refreshed by one request
+is used by the next instead of every request refreshing it again.
+"""
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Tuple
+
+import google.auth.transport.requests
+import google.oauth2.credentials
+import googleapiclient.discovery
+
+import metrics
+
+class DriveServicePool:
+
+    def __init__(self, maxCredentials: int = 256, maxIdlePerCredential: int = 8):
+        self.maxCredentials = maxCredentials
+        self.maxIdlePerCredential = maxIdlePerCredential
+        self.builds = 0
+        self.reuses = 0
+        self.refreshes = 0
+        self._lock = threading.Lock()
+        # key -> (credentials, idle services), least recently used first
+        self._entries: 'OrderedDict[Tuple, Tuple[google.oauth2.credentials.Credentials, List]]' = OrderedDict()
+        self._refreshLocks: Dict[Tuple, threading.Lock] = {}
+        self._fileCredentials: Dict[str, google.oauth2.credentials.Credentials] = {}
+
+    def credentialsFromInfo(self, info: Dict) -> google.oauth2.credentials.Credentials:
+        '''Shared Credentials for the dict stored in the flask session.'''
+        key = credentialsKey(info)
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry[0]
+        return self._addEntry(key, google.oauth2.credentials.Credentials(**info))[0]
+
+    def credentialsFromFile(self, filename: str) -> google.oauth2.credentials.Credentials:
+        with self._lock:
+            credentials = self._fileCredentials.get(filename, None)
+        if credentials is None:
+            credentials = google.oauth2.credentials.Credentials.from_authorized_user_file(filename)
+            with self._lock:
+                credentials = self._fileCredentials.setdefault(filename, credentials)
+        return credentials
+
+    @contextmanager
+    def lease(self, credentials: google.oauth2.credentials.Credentials) -> Iterator[googleapiclient.discovery.Resource]:
+        key = objectKey(credentials)
+        credentials = self._addEntry(key, credentials)[0]
+        self._refreshIfNeeded(key, credentials)
+        service = None
+        with self._lock:
+            idle = self._entries[key][1] if key in self._entries else []
+            if len(idle) > 0:
+                service = idle.pop()
+                self.reuses += 1
+        if service is None:
+            service = googleapiclient.discovery.build('drive', 'v3', credentials=credentials, cache_discovery=False)
+            with self._lock:
+                self.builds += 1
+            metrics.driveServices.inc(event='build')
+        else:
+            metrics.driveServices.inc(event='reuse')
+        try:
+            yield service
+        finally:
+            with self._lock:
+                entry = self._entries.get(key, None)
+                if entry is not None and len(entry[1]) < self.maxIdlePerCredential:
+                    entry[1].append(service)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                'builds': self.builds,
+                'reuses': self.reuses,
+                'refreshes': self.refreshes,
+                'credentials': len(self._entries),
+                'idleServices': sum(len(idle) for _, idle in self._entries.values()),
+            }
+
+    def _addEntry(self, key: Tuple, credentials: google.oauth2.credentials.Credentials):
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is None:
+                entry = (credentials, [])
+                self._entries[key] = entry
+                self._refreshLocks[key] = threading.Lock()
+                while len(self._entries) > self.maxCredentials:
+                    oldKey, _ = self._entries.popitem(last=False)
+                    del self._refreshLocks[oldKey]
+            self._entries.move_to_end(key)
+            return entry
+
+    def _refreshIfNeeded(self, key: Tuple, credentials: google.oauth2.credentials.Credentials) -> None:
+        if credentials.valid or credentials.refresh_token is None:
+            return
+        with self._lock:
+            refreshLock = self._refreshLocks.get(key, None) or threading.Lock()
+        with refreshLock:
+            # another thread may have refreshed while we waited
+            if credentials.valid:
+                return
+            credentials.refresh(google.auth.transport.requests.Request())
+            with self._lock:
+                self.refreshes += 1
+            metrics.driveServices.inc(event='refresh')
+
+def credentialsKey(info: Dict) -> Tuple:
+    return (info.get('client_id', None), info.get('refresh_token', None) or info.get('token', None))
+
+def objectKey(credentials: google.oauth2.credentials.Credentials) -> Tuple:
+    return (credentials.client_id, credentials.refresh_token or credentials.token)
+
+defaultPool = DriveServicePool()
@@ -0,0 +1,249 @@
+"""
+On-disk cache of files fetched from storage, kept below static/cache.
+
+Files are written to a temporary name and renamed into place, so concurrent gunicorn
+workers never see a half-written file. Reads record their time in the file's atime
+(mtime is left alone, it is compared against the storage modifiedTime) and files
+are evicted once the cache grows past CACHE_QUOTA_MB: datasets least recently used
+(or, with CACHE_EVICTION_POLICY=lfu, least often used) first and pinned datasets
+never. Per-dataset sizes, hits and pins are kept in cacheIndex.sqlite in DATABASE_FOLDER.
+"""
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import settings
+from cacheIndex import CacheIndex
+
+CACHE_ROOT = './static/cache'
+TEMP_PREFIX = '.tmp-'
+# sidecar with the storage version (validators) a cached file was downloaded from
+META_PREFIX = '.meta-'
+# compressed copies stored next to a cached file, see compressedVariants.py
+VARIANT_SUFFIXES = ('.br', '.zst', '.gz')
+# never evicted: the dataset list, job status files, single-flight lock files and the README
+RESERVED_NAMES = {'datasetList', 'jobs', 'locks', 'README'}
+# evict down to this fraction of the quota so eviction does not run on every write
+LOW_WATERMARK = 0.9
+
+index = CacheIndex(os.path.join(settings.DATABASE_FOLDER, 'cacheIndex.sqlite'))
+_lock = threading.Lock()
+_bytesWrittenSinceScan = 0
+_lastScanTime = 0.0
+
+class AtomicWriter:
+    """Collects a file in a temporary file next to path and renames it into place on commit."""
+
+    def __init__(self, path: str, meta: Optional[Dict] = None):
+        self.path = path
+        self.meta = meta
+        self.size = 0
+        self._file = None
+        self._tempPath = None
+
+    def write(self, data) -> None:
+        if self._file is None:
+            folderPath = os.path.dirname(self.path)
+            os.makedirs(folderPath, exist_ok=True)
+            fd, self._tempPath = tempfile.mkstemp(prefix=TEMP_PREFIX, dir=folderPath)
+            self._file = os.fdopen(fd, 'wb')
+        self._file.write(data)
+        self.size += len(data)
+
+    def commit(self) -> None:
+        if self._file is None:
+            self.write(b'')
+        self._file.close()
+        # mkstemp creates the file private, but nginx may serve it directly
+        os.chmod(self._tempPath, 0o644)
+        removeMeta(self.path)
+        removeVariants(self.path)
+        os.replace(self._tempPath, self.path)
+        self._file = None
+        self._tempPath = None
+        if self.meta is not None:
+            writeMeta(self.path, self.meta)
+        recordWrite(self.size)
+
+    def discard(self) -> None:
+        if self._tempPath is None:
+            return
+        self._file.close()
+        os.remove(self._tempPath)
+        self._file = None
+        self._tempPath = None
+
+def writeAtomic(path: str, data, isBinary = True, meta: Optional[Dict] = None) -> None:
+    writer = AtomicWriter(path, meta)
+    try:
+        writer.write(data if isBinary else data.encode('utf-8'))
+        writer.commit()
+    finally:
+        writer.discard()
+
+def metaPath(path: str) -> str:
+    return os.path.join(os.path.dirname(path), META_PREFIX + os.path.basename(path) + '.json')
+
+def readMeta(path: str) -> Optional[Dict]:
+    try:
+        with open(metaPath(path), 'r') as metaFile:
+            return json.load(metaFile)
+    except (OSError, ValueError):
+        return None
+
+def writeMeta(path: str, meta: Dict) -> None:
+    writeAtomic(metaPath(path), json.dumps(meta), False)
+
+def removeMeta(path: str) -> None:
+    try:
+        os.remove(metaPath(path))
+    except OSError:
+        pass
+
+def removeVariants(path: str) -> None:
+    '''Compressed copies of the previous version must not outlive it.'''
+    for suffix in VARIANT_SUFFIXES:
+        try:
+            os.remove(path + suffix)
+        except OSError:
+            pass
+
+def markUsed(path: str) -> None:
+    try:
+        fileStat = os.stat(path)
+        os.utime(path, (time.time(), fileStat.st_mtime))
+    except OSError:
+        return
+    folderId = datasetOf(path)
+    if folderId is not None:
+        index.recordHit(folderId)
+
+def datasetOf(path: str) -> Optional[str]:
+    '''The folderId a path below static/cache belongs to, None for reserved folders.'''
+    relativePath = os.path.relpath(path, CACHE_ROOT)
+    name = relativePath.split(os.sep)[0]
+    if name in RESERVED_NAMES or name.startswith('.') or relativePath == name:
+        return None
+    return name
+
+def recordWrite(numBytes: int) -> None:
+    global _bytesWrittenSinceScan
+    with _lock:
+        _bytesWrittenSinceScan += numBytes
+    maybeEvict()
+
+def maybeEvict() -> None:
+    '''Scans the cache when enough was written since the last scan or the scan interval passed.'''
+    global _bytesWrittenSinceScan, _lastScanTime
+    quota = quotaBytes()
+    if quota <= 0:
+        return
+    with _lock:
+        due = _bytesWrittenSinceScan > quota * (1 - LOW_WATERMARK) or time.time() - _lastScanTime > settings.CACHE_EVICTION_INTERVAL
+        if not due:
+            return
+        _bytesWrittenSinceScan = 0
+        _lastScanTime = time.time()
+    evict(quota)
+
+def evict(quota: int) -> int:
+    '''Removes files of the lowest ranked datasets until the cache fits in LOW_WATERMARK * quota. Returns bytes freed.'''
+    entries = listCachedFiles()
+    datasets = scanDatasets(entries)
+    totalSize = sum(size for _, size, _ in entries)
+    if totalSize <= quota:
+        return 0
+    target = quota * LOW_WATERMARK
+    freed = 0
+    ranks = datasetRanks(datasets)
+    pinned = index.pinnedFolderIds()
+    entries = [entry for entry in entries if datasetOf(entry[0]) not in pinned]
+    # lowest ranked dataset first, least recently used file first within it
+    entries.sort(key=lambda entry: (ranks.get(datasetOf(entry[0]), (0, 0)), entry[2]))
+    for path, size, _ in entries:
+        if totalSize - freed <= target:
+            break
+        try:
+            os.remove(path)
+            freed += size
+        except OSError:
+            continue
+        removeMeta(path)
+        removeEmptyFolders(os.path.dirname(path))
+    print('fileCache: evicted {} MB'.format(freed // (1024 * 1024)))
+    if freed > 0:
+        scanDatasets()
+    return freed
+
+def scanDatasets(entries: Optional[List[Tuple[str, int, float]]] = None) -> Dict[str, Dict]:
+    '''Size, file count and newest access of every cached dataset, also stored in the index.'''
+    datasets: Dict[str, Dict] = {}
+    for path, size, accessTime in listCachedFiles() if entries is None else entries:
+        folderId = datasetOf(path)
+        dataset = datasets.setdefault(folderId, {'size': 0, 'files': 0, 'lastAccess': 0.0})
+        dataset['size'] += size
+        dataset['files'] += 1
+        dataset['lastAccess'] = max(dataset['lastAccess'], accessTime)
+    index.updateSizes({folderId: (dataset['size'], dataset['files']) for folderId, dataset in datasets.items()})
+    return datasets
+
+def datasetRanks(datasets: Dict[str, Dict]) -> Dict[str, Tuple]:
+    '''Sort keys of the datasets, lowest is evicted first.'''
+    ranks = {}
+    for entry in index.datasets():
+        if entry['folderId'] not in datasets:
+            continue
+        # files written but never served since count as used when written
+        lastAccess = max(entry['lastAccess'], datasets[entry['folderId']]['lastAccess'])
+        if settings.CACHE_EVICTION_POLICY == 'lfu':
+            ranks[entry['folderId']] = (entry['hits'], lastAccess)
+        else:
+            ranks[entry['folderId']] = (lastAccess, entry['hits'])
+    return ranks
+
+def purgeDataset(folderId: str) -> int:
+    '''Removes everything cached for a dataset, pinned or not. Returns bytes freed.'''
+    folderPath = os.path.join(CACHE_ROOT, folderId)
+    if datasetOf(os.path.join(folderPath, 'x')) != folderId or not os.path.isdir(folderPath):
+        return 0
+    freed = 0
+    for dirPath, _, filenames in os.walk(folderPath):
+        for filename in filenames:
+            freed += os.path.getsize(os.path.join(dirPath, filename))
+    shutil.rmtree(folderPath, ignore_errors=True)
+    index.forget(folderId)
+    return freed
+
+def listCachedFiles() -> List[Tuple[str, int, float]]:
+    '''(path, size, last access time) of every evictable file in the cache.'''
+    entries = []
+    for name in os.listdir(CACHE_ROOT):
+        if name in RESERVED_NAMES or not os.path.isdir(os.path.join(CACHE_ROOT, name)):
+            continue
+        for dirPath, _, filenames in os.walk(os.path.join(CACHE_ROOT, name)):
+            for filename in filenames:
+                if filename.startswith(TEMP_PREFIX) or filename.startswith(META_PREFIX):
+                    continue
+                path = os.path.join(dirPath, filename)
+                try:
+                    fileStat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((path, fileStat.st_size, fileStat.st_atime))
+    return entries
+
+def removeEmptyFolders(folderPath: str) -> None:
+    root = os.path.realpath(CACHE_ROOT)
+    while os.path.realpath(folderPath) != root:
+        try:
+            os.rmdir(folderPath)
+        except OSError:
+            return
+        folderPath = os.path.dirname(folderPath)
+
+def quotaBytes() -> int:
+    return int(settings.CACHE_QUOTA_MB * 1024 * 1024)
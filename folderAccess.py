@@ -0,0 +1,80 @@
+"""
+Persistent (SQLite) record of which dataset folders each user may read, so that
+requests for cached files enforce Drive's permissions without a Drive call.
+
+A user's access to a folder is checked once by looking the folder up in storage
+with their credentials; the answer is kept for ttl seconds (deniedTtl for
+refusals, so newly shared folders show up soon). Users are told apart by a hash
+of their OAuth client and refresh token, tokens themselves are never stored.
+revoke() forgets answers early, for a folder or for everyone, in every process.
+"""
+import hashlib
+import time
+from typing import Dict, Iterable, Optional
+
+import googleapiclient.errors
+
+import drivePool
+from database import Database
+from storage import StorageBackend
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS decisions (
+    user TEXT NOT NULL,
+    folderId TEXT NOT NULL,
+    allowed INTEGER NOT NULL,
+    checkedAt REAL NOT NULL,
+    PRIMARY KEY (user, folderId)
+);
+CREATE INDEX IF NOT EXISTS decisionsByFolderId ON decisions (folderId);
+"""
+# Drive answers both for folders that do not exist and for folders the user may not see
+DENIED_HTTP_STATUSES = {403, 404}
+
+class FolderAccess:
+
+    def __init__(self, dbPath: str, ttl: float, deniedTtl: float):
+        self.dbPath = dbPath
+        self.ttl = ttl
+        self.deniedTtl = deniedTtl
+        self._db = Database(dbPath, SCHEMA)
+
+    def isAllowed(self, user: str, folderId: str, backend: StorageBackend) -> bool:
+        '''The remembered decision while it is fresh, otherwise asks storage. Raises when storage could not tell.'''
+        with self._db.connect() as conn:
+            row = conn.execute('SELECT allowed, checkedAt FROM decisions WHERE user = ? AND folderId = ?', (user, folderId)).fetchone()
+        if row is not None and time.time() - row[1] < (self.ttl if row[0] else self.deniedTtl):
+            return bool(row[0])
+        allowed = canRead(backend, folderId)
+        with self._db.connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO decisions VALUES (?, ?, ?, ?)', (user, folderId, int(allowed), time.time()))
+        return allowed
+
+    def revoke(self, folderId: Optional[str] = None) -> int:
+        '''Forgets the decisions about folderId, or all of them; returns how many.'''
+        with self._db.connect() as conn:
+            if folderId is None:
+                return conn.execute('DELETE FROM decisions').rowcount
+            return conn.execute('DELETE FROM decisions WHERE folderId = ?', (folderId,)).rowcount
+
+    def revokeFolders(self, folderIds: Iterable[str]) -> None:
+        '''For storage change feeds: a changed folder may have been shared or unshared.'''
+        with self._db.connect() as conn:
+            conn.executemany('DELETE FROM decisions WHERE folderId = ?', [(folderId,) for folderId in folderIds])
+
+def canRead(backend: StorageBackend, folderId: str) -> bool:
+    try:
+        backend.stat(folderId)
+        return True
+    except FileNotFoundError:
+        # local storage
+        return False
+    except googleapiclient.errors.HttpError as e:
+        if int(e.resp.status) in DENIED_HTTP_STATUSES and 'ateLimitExceeded' not in str(e.content):
+            return False
+        raise
+
+def userKey(credentials: Dict) -> str:
+    '''Identifies the user of the credentials stored in the flask session.'''
+    # the key the service pool shares Credentials by, stays the same when the access token is refreshed
+    return hashlib.sha256(repr(drivePool.credentialsKey(credentials)).encode('utf-8')).hexdigest()
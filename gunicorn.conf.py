@@ -0,0 +1,23 @@
+"""
+gunicorn settings, read automatically when gunicorn is started from this folder.
+
+The default 'gevent' worker serves every request in a greenlet. With its monkey
+patching, sockets, httplib2 and time.sleep yield to other greenlets, so a request
+waiting on Google Drive no longer blocks the worker and hundreds of tile requests
+can be in flight in one process. 'gthread' is the fallback without gevent: a
+fixed pool of GUNICORN_THREADS threads per worker.
+"""
+import settings
+
+bind = settings.GUNICORN_BIND
+workers = settings.GUNICORN_WORKERS
+worker_class = settings.GUNICORN_WORKER_CLASS
+# gevent: concurrent requests per worker
+worker_connections = settings.GUNICORN_WORKER_CONNECTIONS
+# gthread: threads per worker
+threads = settings.GUNICORN_THREADS
+timeout = settings.GUNICORN_TIMEOUT
+# streamed downloads and /data/<folderId>/bundles keep connections open for a while
+keepalive = 5
+# the app must be imported after the gevent worker has patched the standard library
+preload_app = False
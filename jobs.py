@@ -0,0 +1,178 @@
+"""
+In-process background job queue for work too long to run inside a request, such as
+rebuilding the dataset list or prefetching a dataset into the cache.
+
+Submitting returns a Job immediately; worker threads run it and its status and
+progress are mirrored to static/cache/jobs/<jobId>.json, so any gunicorn worker can
+answer status requests for jobs running in another one. Jobs are lost with their
+process; a persisted job still queued or running in a process that is gone is
+reported, and rewritten, as failed.
+"""
+import json
+import os
+import threading
+import time
+import traceback
+import uuid
+from queue import Queue
+from typing import Callable, Dict, Optional
+
+import fileCache
+
+JOBS_PATH = fileCache.CACHE_ROOT + '/jobs'
+# progress updates are written to disk at most this often
+PERSIST_INTERVAL = 0.5
+# finished jobs are forgotten after this many seconds
+RETENTION = 7 * 24 * 3600
+# tells this process apart from an earlier one given the same pid
+PROCESS_ID = uuid.uuid4().hex
+
+class Job:
+
+    def __init__(self, kind: str, key: str):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.key = key
+        self.status = 'queued'
+        self.done = 0
+        self.total = 0
+        self.message = ''
+        self.result = None
+        self.error = None
+        self.createdAt = time.time()
+        self.startedAt = None
+        self.finishedAt = None
+        self._lastPersist = 0.0
+
+    def setProgress(self, done: int, total: int, message: Optional[str] = None) -> None:
+        self.done = done
+        self.total = total
+        if message is not None:
+            self.message = message
+        if time.time() - self._lastPersist > PERSIST_INTERVAL:
+            self.persist()
+
+    def isActive(self) -> bool:
+        return self.status in ('queued', 'running')
+
+    def toDict(self) -> Dict:
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'key': self.key,
+            'status': self.status,
+            'done': self.done,
+            'total': self.total,
+            'message': self.message,
+            'result': self.result,
+            'error': self.error,
+            'createdAt': self.createdAt,
+            'startedAt': self.startedAt,
+            'finishedAt': self.finishedAt,
+            'pid': os.getpid(),
+            'processId': PROCESS_ID,
+        }
+
+    def persist(self) -> None:
+        self._lastPersist = time.time()
+        fileCache.writeAtomic(jobPath(self.id), json.dumps(self.toDict()), False)
+
+class JobQueue:
+
+    def __init__(self, numWorkers: int):
+        self.numWorkers = numWorkers
+        self._queue: Queue = Queue()
+        self._jobs: Dict[str, Job] = {}
+        self._activeByKey: Dict[str, Job] = {}
+        self._lock = threading.Lock()
+        self._workers = []
+
+    def submit(self, kind: str, key: str, fn: Callable, *args, **kwargs) -> Job:
+        '''
+        Queues fn(job, *args, **kwargs). While a job with the same kind and key is
+        still queued or running, that job is returned instead of queueing another.
+        '''
+        with self._lock:
+            self._startWorkers()
+            self._prune()
+            active = self._activeByKey.get(kind + ':' + key, None)
+            if active is not None and active.isActive():
+                return active
+            job = Job(kind, key)
+            self._jobs[job.id] = job
+            self._activeByKey[kind + ':' + key] = job
+        job.persist()
+        self._queue.put((job, fn, args, kwargs))
+        return job
+
+    def get(self, jobId: str) -> Optional[Dict]:
+        with self._lock:
+            job = self._jobs.get(jobId, None)
+        if job is not None:
+            return job.toDict()
+        # possibly submitted to another process
+        path = jobPath(jobId)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r') as jobFile:
+            job = json.load(jobFile)
+        if job['status'] in ('queued', 'running') and not isProcessAlive(job):
+            job.update(status='failed', error='the worker process running the job exited', finishedAt=time.time())
+            fileCache.writeAtomic(path, json.dumps(job), False)
+        return job
+
+    def _prune(self) -> None:
+        cutoff = time.time() - RETENTION
+        for jobId, job in list(self._jobs.items()):
+            if not job.isActive() and job.finishedAt < cutoff:
+                del self._jobs[jobId]
+        if not os.path.exists(JOBS_PATH):
+            return
+        for filename in os.listdir(JOBS_PATH):
+            path = JOBS_PATH + '/' + filename
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                continue
+
+    def _startWorkers(self) -> None:
+        # started lazily so they are created after gunicorn forks its workers
+        while len(self._workers) < self.numWorkers:
+            worker = threading.Thread(target=self._work, name='job-worker-{}'.format(len(self._workers)), daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def _work(self) -> None:
+        while True:
+            job, fn, args, kwargs = self._queue.get()
+            job.status = 'running'
+            job.startedAt = time.time()
+            job.persist()
+            try:
+                job.result = fn(job, *args, **kwargs)
+                job.status = 'done'
+            except Exception as e:
+                traceback.print_exc()
+                job.error = str(e)
+                job.status = 'failed'
+            job.finishedAt = time.time()
+            job.persist()
+
+def isProcessAlive(job: Dict) -> bool:
+    '''Whether the process that persisted job still runs; jobs of this one are in memory, unless it was a previous process with our pid.'''
+    if job.get('processId', None) == PROCESS_ID:
+        return True
+    pid = job.get('pid', None)
+    if pid is None or pid == os.getpid():
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def jobPath(jobId: str) -> str:
+    return JOBS_PATH + '/' + jobId + '.json'
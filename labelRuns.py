@@ -0,0 +1,51 @@
+"""
+Packed form of a label bundle (L{i}.pb, an RLE.proto ImageLabels message).
+
+Every LabelRun is a submessage of three varints, decoded one object at a time in
+the browser. The packed file (a packedArrays container with magic 'LRLE') holds
+the same runs as four arrays instead, each stored in the narrowest integer type
+that fits its values:
+
+    rowOffsets      rowCount + 1 entries, runs of row i are [rowOffsets[i], rowOffsets[i + 1])
+    start           runCount entries
+    length          runCount entries
+    label           runCount entries
+
+The header has rowCount and runCount.
+"""
+import itertools
+from typing import Dict, List
+
+import numpy as np
+
+import cpuBound
+import packedArrays
+import RLE_pb2
+
+MAGIC = b'LRLE'
+VERSION = 1
+MIMETYPE = 'application/vnd.loon.labels'
+
+def transcodeFile(pbPath: str, packedPath: str, meta: Dict) -> None:
+    packedArrays.writePacked(packedPath, cpuBound.run(transcode, pbPath), meta)
+
+def transcode(pbPath: str) -> List[bytes]:
+    with open(pbPath, 'rb') as pbFile:
+        imageLabels = RLE_pb2.ImageLabels.FromString(pbFile.read())
+    return encodeLabels(imageLabels)
+
+def encodeLabels(imageLabels: RLE_pb2.ImageLabels) -> List[bytes]:
+    rows = imageLabels.rowList
+    runCounts = np.fromiter((len(row.row) for row in rows), dtype=np.int64, count=len(rows))
+    rowOffsets = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum(runCounts, out=rowOffsets[1:])
+    runCount = int(rowOffsets[-1])
+
+    runs = itertools.chain.from_iterable(row.row for row in rows)
+    values = np.fromiter(itertools.chain.from_iterable((run.start, run.length, run.label) for run in runs),
+        dtype=np.int32, count=3 * runCount).reshape(runCount, 3)
+
+    named = [('rowOffsets', rowOffsets)]
+    named += [(name, values[:, i]) for i, name in enumerate(('start', 'length', 'label'))]
+    named = [(name, array.astype(packedArrays.smallestIntDtype(array))) for name, array in named]
+    return packedArrays.pack(MAGIC, VERSION, {'rowCount': len(rows), 'runCount': runCount}, named)
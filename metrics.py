@@ -0,0 +1,138 @@
+"""
+In-process counters and latency histograms, rendered in the Prometheus text format
+by /metrics. Every gunicorn worker process keeps its own values.
+"""
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Sequence, Tuple
+
+# seconds, from a cache hit served in a millisecond to a large download
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_lock = threading.Lock()
+_metrics: List['Metric'] = []
+# per request (greenlet under gevent) count and seconds of the timed calls, for the slow request log
+_request = threading.local()
+
+class Metric:
+
+    def __init__(self, name: str, help: str, labelNames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelNames = tuple(labelNames)
+        with _lock:
+            _metrics.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, '')) for name in self.labelNames)
+
+    def _labelText(self, key: Tuple[str, ...], extra: str = '') -> str:
+        pairs = ['{}="{}"'.format(name, escapeLabel(value)) for name, value in zip(self.labelNames, key)]
+        if extra != '':
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if len(pairs) > 0 else ''
+
+class Counter(Metric):
+
+    def __init__(self, name: str, help: str, labelNames: Sequence[str] = ()):
+        super().__init__(name, help, labelNames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def snapshot(self) -> Dict:
+        '''Called with _lock held.'''
+        return dict(self._values)
+
+    def render(self, values: Dict) -> List[str]:
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} counter'.format(self.name)]
+        for key, value in sorted(values.items()):
+            lines.append('{}{} {}'.format(self.name, self._labelText(key), formatValue(value)))
+        return lines
+
+class Histogram(Metric):
+
+    def __init__(self, name: str, help: str, labelNames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labelNames)
+        self.buckets = tuple(buckets)
+        # key -> (count per bucket, sum, count)
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], float, int]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with _lock:
+            bucketCounts, total, count = self._values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    bucketCounts[i] += 1
+            self._values[key] = (bucketCounts, total + value, count + 1)
+
+    def snapshot(self) -> Dict:
+        '''Called with _lock held; the bucket lists are updated in place, so they are copied too.'''
+        return {key: (list(bucketCounts), total, count) for key, (bucketCounts, total, count) in self._values.items()}
+
+    def render(self, values: Dict) -> List[str]:
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} histogram'.format(self.name)]
+        for key, (bucketCounts, total, count) in sorted(values.items()):
+            for bound, bucketCount in zip(self.buckets, bucketCounts):
+                lines.append('{}_bucket{} {}'.format(self.name, self._labelText(key, 'le="{}"'.format(formatValue(bound))), bucketCount))
+            lines.append('{}_bucket{} {}'.format(self.name, self._labelText(key, 'le="+Inf"'), count))
+            lines.append('{}_sum{} {}'.format(self.name, self._labelText(key), formatValue(total)))
+            lines.append('{}_count{} {}'.format(self.name, self._labelText(key), count))
+        return lines
+
+def render() -> str:
+    # copied under the lock, formatted outside it
+    with _lock:
+        snapshots = [(metric, metric.snapshot()) for metric in _metrics]
+    lines = []
+    for metric, values in snapshots:
+        lines.extend(metric.render(values))
+    return '\n'.join(lines) + '\n'
+
+@contextmanager
+def timed(histogram: Histogram, kind: str, **labels):
+    '''Observes the duration of the block, and adds it to the breakdown of the current request under kind.'''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        histogram.observe(seconds, **labels)
+        addTiming(kind, seconds)
+
+def beginRequest() -> None:
+    _request.timings = {}
+
+def addTiming(kind: str, seconds: float) -> None:
+    timings = getattr(_request, 'timings', None)
+    if timings is not None:
+        count, total = timings.get(kind, (0, 0.0))
+        timings[kind] = (count + 1, total + seconds)
+
+def endRequest() -> Dict[str, Tuple[int, float]]:
+    '''kind -> (calls, seconds) timed since beginRequest.'''
+    timings = getattr(_request, 'timings', None) or {}
+    _request.timings = None
+    return timings
+
+def escapeLabel(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def formatValue(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+requestSeconds = Histogram('loon_request_duration_seconds', 'Time until a route returned its response (streamed bodies excluded).', ('endpoint', 'status'))
+authSeconds = Histogram('loon_auth_check_duration_seconds', 'Time spent in authRequired before the route runs.')
+storageSeconds = Histogram('loon_storage_call_duration_seconds', 'Duration of storage backend calls; iterChunks is timed per chunk.', ('backend', 'method'))
+storageErrors = Counter('loon_storage_call_errors_total', 'Storage backend calls that raised.', ('backend', 'method'))
+storageBytes = Counter('loon_storage_downloaded_bytes_total', 'Bytes downloaded from storage.', ('backend',))
+pathResolveSeconds = Histogram('loon_path_resolve_duration_seconds', 'Time to resolve a dataset relative path to a file through the path index.')
+cacheRequests = Counter('loon_cache_requests_total', 'File requests answered from static/cache (hit) or storage (miss).', ('file', 'result'))
+bytesServed = Counter('loon_served_bytes_total', 'Bytes of files sent to clients.', ('source',))
+driveServices = Counter('loon_drive_services_total', 'Drive service clients built and leased again from the pool, and credential refreshes.', ('event',))
+slowRequests = Counter('loon_slow_requests_total', 'Requests slower than SLOW_REQUEST_SECONDS.', ('endpoint',))
@@ -0,0 +1,85 @@
+"""
+Container for a few named typed arrays, laid out so the browser can wrap each of
+them in a TypedArray view of the response without copying:
+
+    magic                   4 bytes
+    uint32                  format version
+    uint32                  byte length of the JSON header
+    JSON header             padded with spaces to a multiple of 4 bytes
+    arrays                  little-endian, each starting at a multiple of 4 bytes
+
+Besides format specific fields, header['arrays'] lists the name, dtype, absolute
+byte offset and element count of every array.
+"""
+import json
+import struct
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+import fileCache
+
+PREAMBLE = struct.Struct('<4sII')
+ALIGNMENT = 4
+
+def pack(magic: bytes, version: int, fields: Dict, named: List[Tuple[str, np.ndarray]]) -> List[bytes]:
+    '''Returns the file as a list of chunks: preamble and header first, then arrays and padding.'''
+    named = [(name, np.ascontiguousarray(array, dtype=array.dtype.newbyteorder('<'))) for name, array in named]
+
+    def headerBytes(dataStart: int) -> bytes:
+        descriptions = []
+        offset = dataStart
+        for name, array in named:
+            descriptions.append({'name': name, 'dtype': array.dtype.name, 'offset': offset, 'length': int(array.size)})
+            offset += array.nbytes + padding(array.nbytes)
+        header = json.dumps(dict(fields, arrays=descriptions)).encode('utf-8')
+        return header + b' ' * padding(len(header))
+
+    # array offsets depend on the header length, which depends on the offsets' digits
+    dataStart = PREAMBLE.size
+    header = headerBytes(dataStart)
+    while PREAMBLE.size + len(header) != dataStart:
+        dataStart = PREAMBLE.size + len(header)
+        header = headerBytes(dataStart)
+
+    chunks = [PREAMBLE.pack(magic, version, len(header)) + header]
+    for _, array in named:
+        chunks.append(array.tobytes())
+        if padding(array.nbytes) > 0:
+            chunks.append(b'\0' * padding(array.nbytes))
+    return chunks
+
+def unpack(data: np.ndarray, magic: bytes, version: int) -> Tuple[Dict, Dict[str, np.ndarray]]:
+    '''data is a uint8 array (typically np.memmap); the returned arrays are views of it.'''
+    fileMagic, fileVersion, headerLength = PREAMBLE.unpack(data[:PREAMBLE.size].tobytes())
+    if fileMagic != magic or fileVersion != version:
+        raise ValueError('not a version {} {} file'.format(version, magic.decode('ascii')))
+    header = json.loads(data[PREAMBLE.size:PREAMBLE.size + headerLength].tobytes().decode('utf-8'))
+    arrays = {}
+    for description in header['arrays']:
+        arrays[description['name']] = np.frombuffer(data, dtype=np.dtype(description['dtype']).newbyteorder('<'),
+            count=description['length'], offset=description['offset'])
+    return header, arrays
+
+def writePacked(path: str, chunks: List[bytes], meta: Dict) -> None:
+    writer = fileCache.AtomicWriter(path, meta)
+    try:
+        for chunk in chunks:
+            writer.write(chunk)
+        writer.commit()
+    finally:
+        writer.discard()
+
+def padding(length: int) -> int:
+    return -length % ALIGNMENT
+
+def smallestIntDtype(values: np.ndarray) -> np.dtype:
+    '''The narrowest of (u)int8/16/32 holding every value, so runs of small images take fewer bytes.'''
+    if len(values) == 0:
+        return np.dtype('<u1')
+    low, high = int(values.min()), int(values.max())
+    for dtype in ('<u1', '<u2', '<u4') if low >= 0 else ('<i1', '<i2', '<i4'):
+        info = np.iinfo(dtype)
+        if info.min <= low and high <= info.max:
+            return np.dtype(dtype)
+    return np.dtype('<i8')
@@ -0,0 +1,143 @@
+"""
+Persistent (SQLite) index from (folderId, relative path) to file metadata.
+
+Resolving 'data3/D5.jpg' below a dataset folder lists the dataset folder once and
+'data3' once, storing every child it sees, so later bundles in the same location
+resolve without any storage calls until the listing is older than the TTL or the
+storage backend reports a change below one of the listed folders.
+
+A Drive change feed only reports files its user can see, so every user polls
+their own (a page token per changesFeedKey) on their requests. A change nobody
+who can see it polls for is picked up by the TTL, as are failed polls.
+"""
+import time
+from typing import Callable, Dict, List, Optional
+
+import metrics
+from database import Database
+from storage import FileInfo, StorageBackend
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    folderId TEXT NOT NULL,
+    path TEXT NOT NULL,
+    fileId TEXT NOT NULL,
+    name TEXT NOT NULL,
+    isFolder INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    modifiedTime REAL NOT NULL,
+    md5Checksum TEXT,
+    parentId TEXT NOT NULL,
+    PRIMARY KEY (folderId, path)
+);
+CREATE INDEX IF NOT EXISTS entriesByParent ON entries (parentId);
+CREATE TABLE IF NOT EXISTS listings (
+    folderId TEXT NOT NULL,
+    path TEXT NOT NULL,
+    listedFileId TEXT NOT NULL,
+    listedAt REAL NOT NULL,
+    PRIMARY KEY (folderId, path)
+);
+CREATE INDEX IF NOT EXISTS listingsByFileId ON listings (listedFileId);
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+class PathIndex:
+
+    def __init__(self, dbPath: str, ttl: float, changesPollInterval: float = 0):
+        self.dbPath = dbPath
+        self.ttl = ttl
+        self.changesPollInterval = changesPollInterval
+        self._db = Database(dbPath, SCHEMA)
+        # changesFeedKey -> time of its last poll
+        self._lastChangesPolls: Dict[str, float] = {}
+        # called with the ids reported by every poll of the change feed
+        self.changeListeners: List[Callable[[List[str]], None]] = []
+
+    def resolve(self, backend: StorageBackend, folderId: str, path: str) -> Optional[FileInfo]:
+        with metrics.timed(metrics.pathResolveSeconds, 'pathResolve'):
+            return self._resolve(backend, folderId, path)
+
+    def _resolve(self, backend: StorageBackend, folderId: str, path: str) -> Optional[FileInfo]:
+        self._pollChanges(backend)
+        parentPath = ''
+        parentId = folderId
+        info = None
+        for name in path.strip('/').split('/'):
+            self._ensureListed(backend, folderId, parentPath, parentId)
+            childPath = name if parentPath == '' else parentPath + '/' + name
+            info = self._lookup(folderId, childPath)
+            if info is None:
+                return None
+            parentPath = childPath
+            parentId = info.id
+        return info
+
+    def invalidate(self, folderId: str) -> None:
+        with self._db.connect() as conn:
+            conn.execute('DELETE FROM listings WHERE folderId = ?', (folderId,))
+            conn.execute('DELETE FROM entries WHERE folderId = ?', (folderId,))
+
+    def _ensureListed(self, backend: StorageBackend, folderId: str, path: str, listedFileId: str) -> None:
+        with self._db.connect() as conn:
+            row = conn.execute(
+                'SELECT listedFileId, listedAt FROM listings WHERE folderId = ? AND path = ?', (folderId, path)).fetchone()
+        if row is not None and row[0] == listedFileId and time.time() - row[1] < self.ttl:
+            return
+        children = backend.listChildren(listedFileId)
+        self._storeListing(folderId, path, listedFileId, children)
+
+    def _storeListing(self, folderId: str, path: str, listedFileId: str, children: List[FileInfo]) -> None:
+        prefix = '' if path == '' else path + '/'
+        with self._db.connect() as conn:
+            conn.execute('DELETE FROM entries WHERE folderId = ? AND parentId = ?', (folderId, listedFileId))
+            conn.executemany(
+                'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                [(folderId, prefix + child.name, child.id, child.name, int(child.isFolder), child.size,
+                    child.modifiedTime, child.md5Checksum, listedFileId) for child in children])
+            conn.execute('INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?)', (folderId, path, listedFileId, time.time()))
+
+    def _lookup(self, folderId: str, path: str) -> Optional[FileInfo]:
+        with self._db.connect() as conn:
+            row = conn.execute(
+                'SELECT fileId, name, isFolder, size, modifiedTime, md5Checksum, parentId FROM entries WHERE folderId = ? AND path = ?',
+                (folderId, path)).fetchone()
+        if row is None:
+            return None
+        fileId, name, isFolder, size, modifiedTime, md5Checksum, parentId = row
+        return FileInfo(id=fileId, name=name, isFolder=bool(isFolder), size=size, modifiedTime=modifiedTime,
+            md5Checksum=md5Checksum, parents=[parentId], owner='')
+
+    def _pollChanges(self, backend: StorageBackend) -> None:
+        if self.changesPollInterval <= 0:
+            return
+        feedKey = backend.changesFeedKey()
+        if time.time() - self._lastChangesPolls.get(feedKey, 0.0) < self.changesPollInterval:
+            return
+        self._lastChangesPolls[feedKey] = time.time()
+        stateKey = 'changesPageToken:' + feedKey
+        with self._db.connect() as conn:
+            row = conn.execute('SELECT value FROM state WHERE key = ?', (stateKey,)).fetchone()
+        pageToken = None if row is None else row[0]
+        try:
+            result = backend.listChanges(pageToken)
+        except Exception as e:
+            # the request can still be answered, listings expire by the TTL meanwhile
+            print('ERROR: Failed to poll the storage change feed', e)
+            return
+        if result is None:
+            # backend has no change feed, rely on the TTL alone
+            self.changesPollInterval = 0
+            return
+        changedIds, newPageToken = result
+        with self._db.connect() as conn:
+            for changedId in changedIds:
+                # re-list the folder itself and, for removed files, the folder they were listed in
+                conn.execute('DELETE FROM listings WHERE listedFileId = ? OR listedFileId IN (SELECT parentId FROM entries WHERE fileId = ?)',
+                    (changedId, changedId))
+            conn.execute('INSERT OR REPLACE INTO state VALUES (?, ?)', (stateKey, newPageToken))
+        for listener in self.changeListeners:
+            listener(changedIds)
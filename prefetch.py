@@ -0,0 +1,247 @@
+"""
+Mirrors a whole dataset into static/cache ahead of time: massOverTime.pb,
+imageMetaData.json and every image and label bundle of every location.
+
+Files already cached at the current size and checksum are skipped, interrupted
+downloads resume from their partial file, and rate limited or failed Drive calls
+are retried with exponential backoff. Files of PARALLEL_DOWNLOAD_MIN_SIZE and more
+are fetched as byte ranges over several connections at once.
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+import cpuBound
+import fileCache
+import settings
+import singleFlight
+import storage
+import thumbnails
+from storage import FileInfo, StorageBackend
+
+VIZ_META_DATA_FILES = ('massOverTime.pb', 'imageMetaData.json')
+DATA_FOLDER_PATTERN = re.compile(r'^data\d+$')
+BUNDLE_PATTERN = re.compile(r'^(D\d+\.jpg|L\d+\.pb)$')
+HASH_BLOCK_SIZE = 1024 * 1024
+
+# (done, total, message)
+ProgressCallback = Callable[[int, int, str], None]
+
+def prefetchDataset(backend: StorageBackend, folderId: str, progress: Optional[ProgressCallback] = None) -> Dict:
+    files = listDatasetFiles(backend, folderId)
+    summary = {'files': len(files), 'downloaded': 0, 'cached': 0, 'failed': 0, 'bytes': 0, 'errors': []}
+    doneCount = 0
+
+    def fetch(entry: Tuple[str, FileInfo]) -> Tuple[str, FileInfo, str]:
+        cacheRelativePath, fileInfo = entry
+        try:
+            return cacheRelativePath, fileInfo, fetchToCache(backend, fileInfo, fileCache.CACHE_ROOT + '/' + cacheRelativePath)
+        except Exception as e:
+            return cacheRelativePath, fileInfo, 'failed: {}'.format(e)
+
+    with ThreadPoolExecutor(max_workers=settings.PREFETCH_WORKERS) as executor:
+        for cacheRelativePath, fileInfo, outcome in executor.map(fetch, files):
+            doneCount += 1
+            if outcome == 'downloaded':
+                summary['downloaded'] += 1
+                summary['bytes'] += fileInfo.size
+            elif outcome == 'cached':
+                summary['cached'] += 1
+            else:
+                summary['failed'] += 1
+                summary['errors'].append(cacheRelativePath + ' ' + outcome)
+            if progress is not None:
+                progress(doneCount, len(files), cacheRelativePath)
+    return summary
+
+def listDatasetFiles(backend: StorageBackend, folderId: str) -> List[Tuple[str, FileInfo]]:
+    '''(cache path relative to static/cache, file) for every file the data routes can serve.'''
+    files = []
+    for child in storage.callWithRetry(backend.listChildren, folderId):
+        if child.name == '.vizMetaData':
+            for metaDataFile in storage.callWithRetry(backend.listChildren, child.id):
+                if metaDataFile.name in VIZ_META_DATA_FILES:
+                    files.append((folderId + '/' + metaDataFile.name, metaDataFile))
+        elif child.isFolder and DATA_FOLDER_PATTERN.match(child.name):
+            for bundle in storage.callWithRetry(backend.listChildren, child.id):
+                if BUNDLE_PATTERN.match(bundle.name):
+                    files.append((folderId + '/' + child.name + '/' + bundle.name, bundle))
+    return files
+
+def fetchToCache(backend: StorageBackend, fileInfo: FileInfo, path: str) -> str:
+    '''Returns 'cached' if path already holds this version of the file, 'downloaded' otherwise.'''
+    if isCachedVersion(path, fileInfo):
+        return 'cached'
+    flight = singleFlight.defaultGroup.acquire(path)
+    try:
+        # whoever held the flight before us may have fetched it
+        if flight is not None and isCachedVersion(path, fileInfo):
+            return 'cached'
+        return download(backend, fileInfo, path)
+    finally:
+        if flight is not None:
+            flight.release()
+
+def download(backend: StorageBackend, fileInfo: FileInfo, path: str) -> str:
+    partPath = partialPath(path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if isParallel(fileInfo):
+        downloadRanges(backend, fileInfo, partPath)
+    else:
+        if os.path.exists(progressPath(partPath)):
+            # left by a parallel download, the part file is not a prefix of the file
+            discardPartial(partPath)
+        storage.callWithRetry(downloadRemaining, backend, fileInfo, partPath)
+    if fileInfo.md5Checksum is not None and cpuBound.run(fileMd5, partPath) != fileInfo.md5Checksum:
+        discardPartial(partPath)
+        raise ValueError('md5Checksum mismatch')
+    os.chmod(partPath, 0o644)
+    # the validators and compressed copies of the previous version must not outlive it
+    fileCache.removeMeta(path)
+    fileCache.removeVariants(path)
+    os.replace(partPath, path)
+    fileCache.writeMeta(path, fileValidators(fileInfo))
+    fileCache.recordWrite(fileInfo.size)
+    thumbnails.schedule(path)
+    return 'downloaded'
+
+def fileValidators(fileInfo: FileInfo) -> Dict:
+    '''What the cached copy is checked against, stored next to it (fileCache.writeMeta).'''
+    return {
+        'fileId': fileInfo.id,
+        'size': fileInfo.size,
+        'modifiedTime': fileInfo.modifiedTime,
+        'md5Checksum': fileInfo.md5Checksum,
+        'checkedAt': time.time(),
+    }
+
+def downloadRemaining(backend: StorageBackend, fileInfo: FileInfo, partPath: str) -> None:
+    '''Appends whatever partPath is missing; retrying this call resumes where the last attempt stopped.'''
+    offset = os.path.getsize(partPath) if os.path.exists(partPath) else 0
+    if offset > fileInfo.size:
+        offset = 0
+    with open(partPath, 'ab' if offset > 0 else 'wb') as partFile:
+        for chunk in backend.iterChunks(fileInfo.id, offset, fileInfo.size, settings.STREAM_CHUNK_SIZE):
+            partFile.write(chunk)
+    if os.path.getsize(partPath) != fileInfo.size:
+        # dropped connections raise while reading, so the file itself is not the size fileInfo says
+        raise sizeMismatch(fileInfo)
+
+def isParallel(fileInfo: FileInfo) -> bool:
+    return settings.DOWNLOAD_CONNECTIONS > 1 and fileInfo.size >= settings.PARALLEL_DOWNLOAD_MIN_SIZE
+
+def downloadRanges(backend: StorageBackend, fileInfo: FileInfo, partPath: str) -> None:
+    '''
+    Fetches the file as DOWNLOAD_RANGE_SIZE byte ranges over DOWNLOAD_CONNECTIONS connections at
+    once, each written in place into partPath. The bytes done per range are kept next to it, so a
+    later call resumes every range where it stopped.
+    '''
+    progress = RangeProgress(progressPath(partPath), fileInfo, settings.DOWNLOAD_RANGE_SIZE)
+    if not progress.resumed or not os.path.exists(partPath) or os.path.getsize(partPath) != fileInfo.size:
+        progress.reset()
+        with open(partPath, 'wb') as partFile:
+            partFile.truncate(fileInfo.size)
+    ranges = [(index, start, min(start + settings.DOWNLOAD_RANGE_SIZE, fileInfo.size))
+        for index, start in enumerate(range(0, fileInfo.size, settings.DOWNLOAD_RANGE_SIZE))]
+    with ThreadPoolExecutor(max_workers=settings.DOWNLOAD_CONNECTIONS) as executor:
+        futures = [executor.submit(storage.callWithRetry, downloadRange, backend, fileInfo, partPath, progress, index, start, end)
+            for index, start, end in ranges]
+        # the other ranges still finish, and are kept for the next attempt
+        for future in futures:
+            future.result()
+    os.remove(progress.path)
+
+def downloadRange(backend: StorageBackend, fileInfo: FileInfo, partPath: str, progress: 'RangeProgress', index: int, start: int, end: int) -> None:
+    offset = start + progress.done(index)
+    if offset >= end:
+        return
+    partFile = os.open(partPath, os.O_WRONLY)
+    try:
+        for chunk in backend.iterChunks(fileInfo.id, offset, end, settings.STREAM_CHUNK_SIZE):
+            if offset + len(chunk) > end:
+                # would overwrite the next range
+                raise sizeMismatch(fileInfo)
+            os.pwrite(partFile, chunk, offset)
+            offset += len(chunk)
+            progress.record(index, offset - start)
+    finally:
+        os.close(partFile)
+    if offset != end:
+        raise sizeMismatch(fileInfo)
+
+def sizeMismatch(fileInfo: FileInfo) -> ValueError:
+    '''Storage returned more or fewer bytes than fileInfo.size: a stale size, which retrying would not change.'''
+    return ValueError('size of {} is not {}, it changed in storage'.format(fileInfo.id, fileInfo.size))
+
+class RangeProgress:
+    """Bytes done per range of a parallel download, saved as json after every chunk."""
+
+    def __init__(self, path: str, fileInfo: FileInfo, rangeSize: int):
+        self.path = path
+        # a saved progress only counts for the same version of the file split the same way
+        self._version = {'fileId': fileInfo.id, 'size': fileInfo.size, 'md5Checksum': fileInfo.md5Checksum,
+            'modifiedTime': fileInfo.modifiedTime, 'rangeSize': rangeSize}
+        self._done: Dict[int, int] = {}
+        self._lock = threading.Lock()
+        self.resumed = False
+        try:
+            with open(path) as progressFile:
+                saved = json.load(progressFile)
+            if saved['version'] == self._version:
+                self._done = {int(index): done for index, done in saved['done'].items()}
+                self.resumed = True
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def done(self, index: int) -> int:
+        with self._lock:
+            return self._done.get(index, 0)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._done = {}
+            self._save()
+
+    def record(self, index: int, done: int) -> None:
+        with self._lock:
+            self._done[index] = done
+            self._save()
+
+    def _save(self) -> None:
+        with open(self.path + '.new', 'w') as progressFile:
+            json.dump({'version': self._version, 'done': self._done}, progressFile)
+        os.replace(self.path + '.new', self.path)
+
+def isCachedVersion(path: str, fileInfo: FileInfo) -> bool:
+    if not os.path.exists(path):
+        return False
+    fileStat = os.stat(path)
+    if fileStat.st_size != fileInfo.size or fileStat.st_mtime < fileInfo.modifiedTime:
+        return False
+    return fileInfo.md5Checksum is None or cpuBound.run(fileMd5, path) == fileInfo.md5Checksum
+
+def partialPath(path: str) -> str:
+    # the temp prefix keeps partial files out of cache eviction
+    return os.path.join(os.path.dirname(path), fileCache.TEMP_PREFIX + os.path.basename(path) + '.part')
+
+def progressPath(partPath: str) -> str:
+    return partPath + '.ranges'
+
+def discardPartial(partPath: str) -> None:
+    for path in (partPath, progressPath(partPath)):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def fileMd5(path: str) -> str:
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            md5.update(block)
+    return md5.hexdigest()
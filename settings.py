@@ -14,3 +14,86 @@ DEMO_CREDENTIALS_FILENAME = os.getenv('DEMO_CREDENTIALS_FILENAME')
 DEMO_NAME = os.getenv('DEMO_NAME')
 DEMO_ID = os.getenv('DEMO_ID')
 
+
+# SQLite databases (path index, cache index, dataset catalog, folder access), kept out of the publicly served static folder
+DATABASE_FOLDER = os.getenv('DATABASE_FOLDER', './databases')
+
+# 'drive' (default) or 'local'
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'drive')
+LOCAL_STORAGE_ROOT = os.getenv('LOCAL_STORAGE_ROOT')
+
+# seconds before a cached folder listing is fetched again from storage
+PATH_INDEX_TTL = float(os.getenv('PATH_INDEX_TTL', 600))
+# seconds between polls of each user's Drive changes feed (it only reports files that user can see), 0 to rely on PATH_INDEX_TTL only
+PATH_INDEX_CHANGES_POLL_INTERVAL = float(os.getenv('PATH_INDEX_CHANGES_POLL_INTERVAL', 60))
+
+# size of static/cache before files of the least used datasets are evicted, 0 for unbounded
+CACHE_QUOTA_MB = float(os.getenv('CACHE_QUOTA_MB', 20 * 1024))
+# seconds between eviction scans of static/cache
+CACHE_EVICTION_INTERVAL = float(os.getenv('CACHE_EVICTION_INTERVAL', 300))
+# which cached datasets are evicted first: 'lru' (least recently used) or 'lfu' (least often used)
+CACHE_EVICTION_POLICY = os.getenv('CACHE_EVICTION_POLICY', 'lru')
+
+# bytes fetched from storage per request while streaming a file to the client
+STREAM_CHUNK_SIZE = int(os.getenv('STREAM_CHUNK_SIZE', 4 * 1024 * 1024))
+# files at least this many bytes are downloaded as DOWNLOAD_RANGE_SIZE byte ranges over DOWNLOAD_CONNECTIONS connections at once, 1 connection to never split
+PARALLEL_DOWNLOAD_MIN_SIZE = int(os.getenv('PARALLEL_DOWNLOAD_MIN_SIZE', 64 * 1024 * 1024))
+DOWNLOAD_RANGE_SIZE = int(os.getenv('DOWNLOAD_RANGE_SIZE', 16 * 1024 * 1024))
+DOWNLOAD_CONNECTIONS = int(os.getenv('DOWNLOAD_CONNECTIONS', 4))
+
+# datasets processed concurrently by /data/update_dataset_list
+DATASET_LIST_WORKERS = int(os.getenv('DATASET_LIST_WORKERS', 8))
+
+# threads running background jobs (dataset list rebuilds, prefetches) per process
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 2))
+
+# enables the /admin routes for requests carrying it in X-Admin-Token or ?adminToken=
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
+# files downloaded concurrently when prefetching a dataset
+PREFETCH_WORKERS = int(os.getenv('PREFETCH_WORKERS', 4))
+
+# seconds a user's access to a dataset folder, checked once with their credentials, is trusted without asking storage again;
+# also how long a user may keep reading a folder unshared from them (their change feed only sometimes notices sooner)
+FOLDER_ACCESS_TTL = float(os.getenv('FOLDER_ACCESS_TTL', 600))
+# the same for refusals, kept short so newly shared folders become readable soon
+FOLDER_ACCESS_DENIED_TTL = float(os.getenv('FOLDER_ACCESS_DENIED_TTL', 60))
+
+# seconds a cached massOverTime.pb is served without asking storage whether it changed
+REVALIDATE_TTL = float(os.getenv('REVALIDATE_TTL', 300))
+
+# bundles fetched from storage concurrently by /data/<folderId>/bundles, and the most one request may ask for
+BATCH_WORKERS = int(os.getenv('BATCH_WORKERS', 8))
+BATCH_MAX_BUNDLES = int(os.getenv('BATCH_MAX_BUNDLES', 256))
+
+# gunicorn (see gunicorn.conf.py): 'gevent' serves requests waiting on storage concurrently in one process, 'gthread' or 'sync' otherwise
+GUNICORN_BIND = os.getenv('GUNICORN_BIND', '127.0.0.1:5000')
+GUNICORN_WORKERS = int(os.getenv('GUNICORN_WORKERS', 1))
+GUNICORN_WORKER_CLASS = os.getenv('GUNICORN_WORKER_CLASS', 'gevent')
+GUNICORN_WORKER_CONNECTIONS = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', 1000))
+GUNICORN_THREADS = int(os.getenv('GUNICORN_THREADS', 32))
+GUNICORN_TIMEOUT = int(os.getenv('GUNICORN_TIMEOUT', 3600))
+
+# seconds a request waits for another request fetching the same file before fetching it itself
+SINGLE_FLIGHT_TIMEOUT = float(os.getenv('SINGLE_FLIGHT_TIMEOUT', 600))
+
+# how cache hits reach the client: 'sendfile' (served by the app with zero-copy sendfile) or 'accel' (X-Accel-Redirect to nginx)
+CACHE_SERVE_MODE = os.getenv('CACHE_SERVE_MODE', 'sendfile')
+# internal nginx location aliasing static/cache, used by 'accel'
+CACHE_ACCEL_PREFIX = os.getenv('CACHE_ACCEL_PREFIX', '/protected-cache/')
+# seconds browsers may reuse image and label bundles without asking again
+CACHE_MAX_AGE = int(os.getenv('CACHE_MAX_AGE', 3600))
+# compressed copies kept of cached .pb/.json files: any of 'br', 'zstd' (when their packages are installed) and 'gzip', empty for none
+CACHE_COMPRESSION = os.getenv('CACHE_COMPRESSION', 'br,zstd,gzip')
+# threads compressing newly cached files per process
+COMPRESSION_WORKERS = int(os.getenv('COMPRESSION_WORKERS', 1))
+# downscaled copies made of cached image bundles, as divisors of their width and height, empty for none
+THUMBNAIL_SCALES = os.getenv('THUMBNAIL_SCALES', '2,4,8')
+# formats of the downscaled copies: 'jpeg', and 'webp' for clients accepting image/webp
+THUMBNAIL_FORMATS = os.getenv('THUMBNAIL_FORMATS', 'jpeg')
+# JPEG/WebP quality of the downscaled copies
+THUMBNAIL_QUALITY = int(os.getenv('THUMBNAIL_QUALITY', 85))
+# processes per app process decoding and resizing image bundles
+THUMBNAIL_WORKERS = int(os.getenv('THUMBNAIL_WORKERS', 2))
+
+# requests taking longer than this many seconds are logged with their storage and path lookup times, 0 to log none
+SLOW_REQUEST_SECONDS = float(os.getenv('SLOW_REQUEST_SECONDS', 0))
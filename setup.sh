@@ -9,4 +9,5 @@ echo OAUTHLIB_INSECURE_TRANSPORT = \<1 for development, delete for production\>
 echo OAUTHLIB_RELAX_TOKEN_SCOPE = 1 >> .env
 echo FLASK_SECRET_KEY = \<secret key, e.g. output of [python3 -c 'import os; print(os.urandom(16).hex())']\> >> .env
 echo FLASK_ENV=\<development \| production \> >> .env
-echo FLASK_SERVER_NAME=\<url, e.g. for development localhost:8080\> >> .env
\ No newline at end of file
+echo FLASK_SERVER_NAME=\<url, e.g. for development localhost:8080\> >> .env
+echo STORAGE_BACKEND=drive >> .env
\ No newline at end of file
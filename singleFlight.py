@@ -0,0 +1,101 @@
+"""
+Coalesces concurrent cache misses for the same file.
+
+Whoever acquires the flight for a key fetches the file into the cache; everyone
+else blocks in acquire until it is released, then finds the file cached and serves
+it from there. Flights are exclusive between the threads (or greenlets) of one
+process through a lock per key, and between gunicorn workers through an flock on
+one of LOCK_STRIPES files in static/cache/locks, chosen by the hash of the key.
+"""
+import fcntl
+import hashlib
+import os
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+import fileCache
+import settings
+
+LOCKS_PATH = fileCache.CACHE_ROOT + '/locks'
+# seconds between attempts to take the file lock, flock is not waited on directly so gevent keeps running
+POLL_INTERVAL = 0.05
+# keys share this many lock files, so their number stays bounded however many files get cached
+LOCK_STRIPES = 4096
+
+class Flight:
+    """A held flight; release is idempotent so it can be tied to both a generator and response close."""
+
+    def __init__(self, group: 'SingleFlightGroup', key: str, lockFile):
+        self.group = group
+        self.key = key
+        self._lockFile = lockFile
+        self._released = False
+
+    def release(self) -> None:
+        if self._released:
+            return
+        self._released = True
+        self.group._release(self.key, self._lockFile)
+
+    def __enter__(self) -> 'Flight':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.release()
+
+class SingleFlightGroup:
+
+    def __init__(self, locksPath: str):
+        self.locksPath = locksPath
+        self._lock = threading.Lock()
+        # key -> (lock, number of threads holding or waiting for it)
+        self._keys: Dict[str, Tuple[threading.Lock, int]] = {}
+
+    def acquire(self, key: str, timeout: Optional[float] = None) -> Optional[Flight]:
+        '''Blocks until the flight for key is ours; None if that took longer than timeout.'''
+        timeout = settings.SINGLE_FLIGHT_TIMEOUT if timeout is None else timeout
+        deadline = time.time() + timeout
+        with self._lock:
+            keyLock, users = self._keys.get(key, (threading.Lock(), 0))
+            self._keys[key] = (keyLock, users + 1)
+        if not keyLock.acquire(timeout=timeout):
+            self._forget(key)
+            return None
+
+        os.makedirs(self.locksPath, exist_ok=True)
+        lockFile = open(self.lockPath(key), 'a')
+        while True:
+            try:
+                fcntl.flock(lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return Flight(self, key, lockFile)
+            except BlockingIOError:
+                if time.time() > deadline:
+                    lockFile.close()
+                    keyLock.release()
+                    self._forget(key)
+                    return None
+                time.sleep(POLL_INTERVAL)
+
+    def lockPath(self, key: str) -> str:
+        stripe = int(hashlib.sha1(key.encode('utf-8')).hexdigest(), 16) % LOCK_STRIPES
+        return self.locksPath + '/{}.lock'.format(stripe)
+
+    def _release(self, key: str, lockFile) -> None:
+        # lock files are never removed, that could let two processes lock different inodes
+        fcntl.flock(lockFile, fcntl.LOCK_UN)
+        lockFile.close()
+        with self._lock:
+            keyLock, _ = self._keys[key]
+        keyLock.release()
+        self._forget(key)
+
+    def _forget(self, key: str) -> None:
+        with self._lock:
+            keyLock, users = self._keys[key]
+            if users <= 1:
+                del self._keys[key]
+            else:
+                self._keys[key] = (keyLock, users - 1)
+
+defaultGroup = SingleFlightGroup(LOCKS_PATH)
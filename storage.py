@@ -0,0 +1,343 @@
+"""
+Storage backends that the /data routes read experiments from.
+
+Folder and file ids are opaque strings. For Google Drive they are Drive ids, for
+the local backend they are paths relative to LOCAL_STORAGE_ROOT (with ':' in place
+of '/' so they fit in a single url segment), so a dataset laid out on disk as
+
+    <LOCAL_STORAGE_ROOT>/<folderId>/.vizMetaData/massOverTime.pb
+    <LOCAL_STORAGE_ROOT>/<folderId>/.vizMetaData/imageMetaData.json
+    <LOCAL_STORAGE_ROOT>/<folderId>/data<N>/D<i>.jpg
+    <LOCAL_STORAGE_ROOT>/<folderId>/data<N>/L<i>.pb
+
+is served under the same urls as the Drive folder <folderId>.
+"""
+import hashlib
+import os
+import pwd
+import random
+import socket
+import time
+from datetime import datetime
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+import metrics
+import settings
+
+# Google drive
+import google.oauth2.credentials
+import googleapiclient.errors
+import drivePool
+from drivePool import DriveServicePool
+
+DRIVE_FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+DRIVE_FILE_FIELDS = 'id, name, mimeType, size, modifiedTime, md5Checksum, parents, owners(displayName), trashed'
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+RETRYABLE_HTTP_STATUSES = {429, 500, 502, 503, 504}
+LOCAL_ID_SEPARATOR = ':'
+
+class FileInfo(NamedTuple):
+    id: str
+    name: str
+    isFolder: bool
+    size: int
+    modifiedTime: float # seconds since epoch
+    md5Checksum: Optional[str]
+    parents: List[str]
+    owner: str
+
+class StorageBackend:
+    """Read-only view of a tree of folders and files addressed by id."""
+
+    def listChildren(self, folderId: str) -> List[FileInfo]:
+        raise NotImplementedError
+
+    def findChild(self, folderId: str, name: str) -> Optional[FileInfo]:
+        for child in self.listChildren(folderId):
+            if child.name == name:
+                return child
+        return None
+
+    def findFoldersByName(self, name: str) -> List[FileInfo]:
+        raise NotImplementedError
+
+    def stat(self, fileId: str) -> FileInfo:
+        '''Raises FileNotFoundError for files that do not exist or are in the trash.'''
+        raise NotImplementedError
+
+    def read(self, fileId: str, start: int = 0, end: Optional[int] = None) -> bytes:
+        '''Returns bytes [start, end) of the file, or through the end of the file if end is None.'''
+        raise NotImplementedError
+
+    def iterChunks(self, fileId: str, start: int = 0, end: Optional[int] = None, chunkSize: int = DEFAULT_CHUNK_SIZE) -> Iterator[bytes]:
+        if end is None:
+            end = self.stat(fileId).size
+        offset = start
+        while offset < end:
+            chunkEnd = min(offset + chunkSize, end)
+            yield self.read(fileId, offset, chunkEnd)
+            offset = chunkEnd
+
+    def listChanges(self, pageToken: Optional[str]) -> Optional[Tuple[List[str], str]]:
+        '''
+        Returns the ids of files changed since pageToken together with the ids of their
+        parent folders, and the token to pass next time. A None pageToken only fetches
+        the starting token. Backends without a change feed return None.
+        '''
+        return None
+
+    def changesFeedKey(self) -> str:
+        '''Tells apart the change feeds of backends reading as different users, each reporting only what its user can see.'''
+        return ''
+
+class DriveStorage(StorageBackend):
+    """Every call leases a service client from the pool for just the duration of the call."""
+
+    def __init__(self, credentials: google.oauth2.credentials.Credentials, pool: DriveServicePool = drivePool.defaultPool):
+        self.credentials = credentials
+        self.pool = pool
+
+    def listChildren(self, folderId: str) -> List[FileInfo]:
+        return self._list("'{}' in parents and trashed = false".format(folderId))
+
+    def findChild(self, folderId: str, name: str) -> Optional[FileInfo]:
+        query = "'{}' in parents and name = '{}' and trashed = false".format(folderId, escapeQueryString(name))
+        items = self._list(query, pageSize=10, firstPageOnly=True)
+        if len(items) == 0:
+            return None
+        return items[0]
+
+    def findFoldersByName(self, name: str) -> List[FileInfo]:
+        return self._list("name = '{}' and trashed = false".format(escapeQueryString(name)))
+
+    def stat(self, fileId: str) -> FileInfo:
+        with self.pool.lease(self.credentials) as service:
+            metadata = service.files().get(fileId=fileId, fields=DRIVE_FILE_FIELDS).execute()
+        # files().get still answers for trashed files, with their last metadata
+        if metadata.get('trashed', False):
+            raise FileNotFoundError('trashed: ' + fileId)
+        return driveFileInfo(metadata)
+
+    def read(self, fileId: str, start: int = 0, end: Optional[int] = None) -> bytes:
+        if end is not None and end <= start:
+            return b''
+        with self.pool.lease(self.credentials) as service:
+            request = service.files().get_media(fileId=fileId)
+            if start > 0 or end is not None:
+                request.headers['Range'] = 'bytes={}-{}'.format(start, '' if end is None else end - 1)
+            return request.execute()
+
+    def listChanges(self, pageToken: Optional[str]) -> Optional[Tuple[List[str], str]]:
+        if pageToken is None:
+            with self.pool.lease(self.credentials) as service:
+                return [], service.changes().getStartPageToken().execute()['startPageToken']
+        changedIds = set()
+        while True:
+            with self.pool.lease(self.credentials) as service:
+                results = service.changes().list(pageToken=pageToken, pageSize=1000,
+                    fields='nextPageToken, newStartPageToken, changes(fileId, file(parents))').execute()
+            for change in results.get('changes', []):
+                changedIds.add(change['fileId'])
+                changedIds.update(change.get('file', {}).get('parents', []))
+            if 'newStartPageToken' in results:
+                return list(changedIds), results['newStartPageToken']
+            pageToken = results['nextPageToken']
+
+    def changesFeedKey(self) -> str:
+        # tokens themselves are not stored
+        return hashlib.sha256(repr(drivePool.objectKey(self.credentials)).encode('utf-8')).hexdigest()
+
+    def _list(self, query: str, pageSize: int = 1000, firstPageOnly: bool = False) -> List[FileInfo]:
+        responseFields = 'nextPageToken, files({})'.format(DRIVE_FILE_FIELDS)
+        fileList = []
+        pageToken = None
+        while True:
+            with self.pool.lease(self.credentials) as service:
+                results = service.files().list(q=query, fields=responseFields, pageSize=pageSize, pageToken=pageToken).execute()
+            fileList.extend(driveFileInfo(f) for f in results.get('files', []))
+            pageToken = results.get('nextPageToken', None)
+            if pageToken is None or firstPageOnly:
+                return fileList
+
+def isRetryable(error: Exception) -> bool:
+    '''Rate limiting, server errors and dropped connections are worth retrying; missing files and permission errors are not.'''
+    if isinstance(error, googleapiclient.errors.HttpError):
+        status = int(error.resp.status)
+        if status == 403:
+            # rateLimitExceeded and userRateLimitExceeded
+            return 'ateLimitExceeded' in str(error.content)
+        return status in RETRYABLE_HTTP_STATUSES
+    return isinstance(error, (ConnectionError, TimeoutError, socket.timeout))
+
+def callWithRetry(fn: Callable, *args, retries: int = 5, baseDelay: float = 1.0, **kwargs):
+    '''Calls fn, retrying retryable errors with jittered exponential backoff.'''
+    for attempt in range(retries + 1):
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            if attempt == retries or not isRetryable(e):
+                raise
+            time.sleep(baseDelay * (2 ** attempt) * random.uniform(0.5, 1.0))
+
+def escapeQueryString(value: str) -> str:
+    return value.replace('\\', '\\\\').replace("'", "\\'")
+
+def parseDriveTime(timeString: str) -> float:
+    dateObj = datetime.strptime(timeString, '%Y-%m-%dT%H:%M:%S.%fZ')
+    return (dateObj - datetime(1970, 1, 1)).total_seconds()
+
+def driveFileInfo(metadata: Dict) -> FileInfo:
+    owners = metadata.get('owners', [])
+    return FileInfo(
+        id=metadata['id'],
+        name=metadata.get('name', ''),
+        isFolder=metadata.get('mimeType', '') == DRIVE_FOLDER_MIME_TYPE,
+        size=int(metadata.get('size', 0)),
+        modifiedTime=parseDriveTime(metadata['modifiedTime']) if 'modifiedTime' in metadata else 0.0,
+        md5Checksum=metadata.get('md5Checksum', None),
+        parents=metadata.get('parents', []),
+        owner=owners[0]['displayName'] if len(owners) > 0 else '')
+
+class LocalStorage(StorageBackend):
+    """
+    Serves a directory tree, e.g. an NFS mount of the experiment folders.
+    Ids are LOCAL_ID_SEPARATOR separated paths relative to root; the root itself is ''.
+    """
+
+    def __init__(self, root: str):
+        self.root = os.path.realpath(root)
+
+    def listChildren(self, folderId: str) -> List[FileInfo]:
+        folderPath = self._path(folderId)
+        if not os.path.isdir(folderPath):
+            return []
+        return [self.stat(joinId(folderId, name)) for name in sorted(os.listdir(folderPath))]
+
+    def findChild(self, folderId: str, name: str) -> Optional[FileInfo]:
+        if name in ('', '.', '..') or '/' in name or LOCAL_ID_SEPARATOR in name:
+            return None
+        fileId = joinId(folderId, name)
+        if not os.path.exists(self._path(fileId)):
+            return None
+        return self.stat(fileId)
+
+    def findFoldersByName(self, name: str) -> List[FileInfo]:
+        folderList = []
+        for dirPath, dirNames, _ in os.walk(self.root):
+            if name in dirNames:
+                folderId = os.path.relpath(os.path.join(dirPath, name), self.root).replace(os.sep, LOCAL_ID_SEPARATOR)
+                folderList.append(self.stat(folderId))
+            # do not descend into the matched folders themselves
+            dirNames[:] = [d for d in dirNames if d != name]
+        return folderList
+
+    def stat(self, fileId: str) -> FileInfo:
+        path = self._path(fileId)
+        fileStat = os.stat(path)
+        parentId = fileId.rpartition(LOCAL_ID_SEPARATOR)[0]
+        return FileInfo(
+            id=fileId,
+            name=os.path.basename(path),
+            isFolder=os.path.isdir(path),
+            size=fileStat.st_size,
+            modifiedTime=fileStat.st_mtime,
+            md5Checksum=None,
+            parents=[parentId] if fileId != '' else [],
+            owner=ownerName(fileStat.st_uid))
+
+    def read(self, fileId: str, start: int = 0, end: Optional[int] = None) -> bytes:
+        with open(self._path(fileId), 'rb') as f:
+            f.seek(start)
+            if end is None:
+                return f.read()
+            return f.read(max(0, end - start))
+
+    def iterChunks(self, fileId: str, start: int = 0, end: Optional[int] = None, chunkSize: int = DEFAULT_CHUNK_SIZE) -> Iterator[bytes]:
+        with open(self._path(fileId), 'rb') as f:
+            f.seek(start)
+            remaining = None if end is None else end - start
+            while remaining is None or remaining > 0:
+                chunk = f.read(chunkSize if remaining is None else min(chunkSize, remaining))
+                if not chunk:
+                    return
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+
+    def _path(self, fileId: str) -> str:
+        path = os.path.realpath(os.path.join(self.root, *fileId.split(LOCAL_ID_SEPARATOR)))
+        if path != self.root and not path.startswith(self.root + os.sep):
+            raise FileNotFoundError(fileId)
+        return path
+
+def joinId(folderId: str, name: str) -> str:
+    if folderId == '':
+        return name
+    return folderId + LOCAL_ID_SEPARATOR + name
+
+def ownerName(uid: int) -> str:
+    try:
+        return pwd.getpwuid(uid).pw_name
+    except KeyError:
+        return str(uid)
+
+class InstrumentedStorage(StorageBackend):
+    """Times every call of the wrapped backend into the storage metrics of metrics.py."""
+
+    def __init__(self, backend: StorageBackend, name: str):
+        self.backend = backend
+        self.name = name
+
+    def listChildren(self, folderId: str) -> List[FileInfo]:
+        return self._call('listChildren', self.backend.listChildren, folderId)
+
+    def findChild(self, folderId: str, name: str) -> Optional[FileInfo]:
+        return self._call('findChild', self.backend.findChild, folderId, name)
+
+    def findFoldersByName(self, name: str) -> List[FileInfo]:
+        return self._call('findFoldersByName', self.backend.findFoldersByName, name)
+
+    def stat(self, fileId: str) -> FileInfo:
+        return self._call('stat', self.backend.stat, fileId)
+
+    def read(self, fileId: str, start: int = 0, end: Optional[int] = None) -> bytes:
+        data = self._call('read', self.backend.read, fileId, start, end)
+        metrics.storageBytes.inc(len(data), backend=self.name)
+        return data
+
+    def iterChunks(self, fileId: str, start: int = 0, end: Optional[int] = None, chunkSize: int = DEFAULT_CHUNK_SIZE) -> Iterator[bytes]:
+        chunks = self.backend.iterChunks(fileId, start, end, chunkSize)
+        while True:
+            chunk = self._call('iterChunks', next, chunks, None)
+            if chunk is None:
+                return
+            metrics.storageBytes.inc(len(chunk), backend=self.name)
+            yield chunk
+
+    def listChanges(self, pageToken: Optional[str]) -> Optional[Tuple[List[str], str]]:
+        return self._call('listChanges', self.backend.listChanges, pageToken)
+
+    def changesFeedKey(self) -> str:
+        return self.backend.changesFeedKey()
+
+    def _call(self, method: str, fn: Callable, *args):
+        try:
+            with metrics.timed(metrics.storageSeconds, 'storage', backend=self.name, method=method):
+                return fn(*args)
+        except Exception:
+            metrics.storageErrors.inc(backend=self.name, method=method)
+            raise
+
+CredentialsGetter = Callable[[], google.oauth2.credentials.Credentials]
+
+_backendFactories: Dict[str, Callable[[CredentialsGetter], StorageBackend]] = {
+    'drive': lambda getCredentials: DriveStorage(getCredentials()),
+    'local': lambda getCredentials: LocalStorage(settings.LOCAL_STORAGE_ROOT),
+}
+
+def registerBackend(name: str, factory: Callable[[CredentialsGetter], StorageBackend]) -> None:
+    _backendFactories[name] = factory
+
+def createStorage(getCredentials: CredentialsGetter) -> StorageBackend:
+    '''getCredentials is only called by backends that need Google credentials.'''
+    return InstrumentedStorage(_backendFactories[settings.STORAGE_BACKEND](getCredentials), settings.STORAGE_BACKEND)
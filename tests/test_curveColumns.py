@@ -0,0 +1,91 @@
+import random
+
+import numpy as np
+import pytest
+
+import curveColumns
+import pbCurveList_pb2
+from curveColumns import CurveColumns, concatenateRanges
+
+def naiveConcatenate(starts, ends):
+    return np.concatenate([np.arange(s, e) for s, e in zip(starts, ends)] + [np.zeros(0, dtype=np.int64)]).astype(np.int64)
+
+@pytest.mark.parametrize('seed', range(50))
+def testConcatenateRangesMatchesNaive(seed):
+    rng = np.random.RandomState(seed)
+    count = rng.randint(0, 20)
+    starts = rng.randint(0, 1000, size=count).astype('<u4')
+    # about a third of the ranges are empty
+    lengths = rng.randint(0, 30, size=count) * (rng.rand(count) > 0.3)
+    ends = (starts + lengths).astype('<u4')
+    result = concatenateRanges(starts, ends)
+    assert result.dtype == np.int64
+    np.testing.assert_array_equal(result, naiveConcatenate(starts, ends))
+
+@pytest.mark.parametrize('starts,ends', [
+    ([], []),
+    ([5, 9], [5, 9]),
+    ([0], [4]),
+    ([3, 3, 0], [3, 5, 2]),
+    ([7, 0], [10, 0]),
+])
+def testConcatenateRangesEdgeCases(starts, ends):
+    starts, ends = np.array(starts, dtype='<u4'), np.array(ends, dtype='<u4')
+    np.testing.assert_array_equal(concatenateRanges(starts, ends), naiveConcatenate(starts, ends))
+
+def makeCurveList(seed: int) -> pbCurveList_pb2.PbCurveList:
+    rng = random.Random(seed)
+    curveList = pbCurveList_pb2.PbCurveList()
+    curveList.pointAttrNames.extend([curveColumns.FRAME_ATTR, 'Mass (pg)'])
+    curveList.curveAttrNames.extend([curveColumns.LOCATION_ATTR, 'id'])
+    for curveId in range(40):
+        curve = curveList.curveList.add()
+        curve.id = curveId
+        curve.valueList.extend([rng.randint(0, 4), curveId])
+        for _ in range(rng.randint(0, 8)):
+            curve.pointList.add().valueList.extend([rng.randint(0, 20), rng.random()])
+    return curveList
+
+def naiveSubset(curveList, locations=None, frameStart=None, frameEnd=None, curveIds=None):
+    '''[(curve id, [frames of its kept points])], the slow way.'''
+    kept = []
+    for curve in curveList.curveList:
+        if locations is not None and curve.valueList[0] not in locations:
+            continue
+        if curveIds is not None and curve.id not in curveIds:
+            continue
+        frames = [point.valueList[0] for point in curve.pointList]
+        if frameStart is not None or frameEnd is not None:
+            frames = [frame for frame in frames
+                if (frameStart is None or frame >= frameStart) and (frameEnd is None or frame <= frameEnd)]
+            if len(frames) == 0:
+                continue
+        kept.append((curve.id, frames))
+    return kept
+
+@pytest.fixture
+def columnsAndCurveList(tmp_path):
+    curveList = makeCurveList(0)
+    path = tmp_path / 'massOverTime.columns'
+    path.write_bytes(b''.join(curveColumns.encodeColumns(*curveColumns.curveListToColumns(curveList))))
+    return CurveColumns(str(path)), curveList
+
+@pytest.mark.parametrize('query', [
+    {},
+    {'locations': [1, 3]},
+    {'curveIds': [0, 5, 17, 39]},
+    {'frameStart': 5, 'frameEnd': 12},
+    {'locations': [2], 'frameStart': 10},
+    {'locations': [99]},
+])
+def testSubsetMatchesNaiveFiltering(columnsAndCurveList, query):
+    columns, curveList = columnsAndCurveList
+    _, _, curveIds, offsets, _, pointColumns = columns.subset(**query)
+    frames = pointColumns[curveColumns.FRAME_ATTR].tolist()
+    got = [(curveId, frames[offsets[i]:offsets[i + 1]]) for i, curveId in enumerate(curveIds.tolist())]
+    assert got == naiveSubset(curveList, **query)
+
+def testSubsetRejectsUnknownAttributes(columnsAndCurveList):
+    columns, _ = columnsAndCurveList
+    with pytest.raises(ValueError):
+        columns.subset(pointAttrNames=['Volume'])
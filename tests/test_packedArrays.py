@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+import packedArrays
+
+MAGIC = b'TEST'
+
+def roundTrip(fields, named, magic=MAGIC, version=1):
+    chunks = packedArrays.pack(MAGIC, 1, fields, named)
+    return packedArrays.unpack(np.frombuffer(b''.join(chunks), dtype='u1'), magic, version)
+
+def testPackUnpackRoundTrip():
+    named = [
+        ('ids', np.arange(7, dtype='<u4')),
+        ('small', np.array([1, 2, 3], dtype='u1')),
+        ('signed', np.array([-5, 300, 0, 7, -1], dtype='<i2')),
+        ('values', np.linspace(0, 1, 11, dtype='<f4')),
+        ('empty', np.zeros(0, dtype='<f8')),
+        # big-endian input is stored little-endian
+        ('bigEndian', np.array([1.5, -2.25], dtype='>f8')),
+    ]
+    header, arrays = roundTrip({'curveCount': 7, 'names': ['a', 'b']}, named)
+    assert header['curveCount'] == 7
+    assert header['names'] == ['a', 'b']
+    assert list(arrays) == [name for name, _ in named]
+    for name, array in named:
+        assert arrays[name].dtype == array.dtype.newbyteorder('<')
+        np.testing.assert_array_equal(arrays[name], array)
+    for description in header['arrays']:
+        assert description['offset'] % packedArrays.ALIGNMENT == 0
+
+def testHeaderLengthIsAligned():
+    # header lengths around a change in the number of offset digits
+    for nameLength in range(1, 40):
+        chunks = packedArrays.pack(MAGIC, 1, {'x': 'y' * nameLength}, [('a', np.arange(3, dtype='u1'))])
+        assert len(chunks[0]) % packedArrays.ALIGNMENT == 0
+        header, arrays = packedArrays.unpack(np.frombuffer(b''.join(chunks), dtype='u1'), MAGIC, 1)
+        assert header['arrays'][0]['offset'] == len(chunks[0])
+        np.testing.assert_array_equal(arrays['a'], [0, 1, 2])
+
+def testUnpackRejectsOtherFormats():
+    named = [('a', np.arange(3, dtype='<u4'))]
+    with pytest.raises(ValueError):
+        roundTrip({}, named, magic=b'LCOL')
+    with pytest.raises(ValueError):
+        roundTrip({}, named, version=2)
+
+@pytest.mark.parametrize('values,dtype', [
+    ([], '<u1'),
+    ([0, 255], '<u1'),
+    ([0, 256], '<u2'),
+    ([-1, 127], '<i1'),
+    ([-129, 0], '<i2'),
+    ([0, 2 ** 32 - 1], '<u4'),
+    ([-1, 2 ** 31], '<i8'),
+])
+def testSmallestIntDtype(values, dtype):
+    assert packedArrays.smallestIntDtype(np.array(values, dtype=np.int64)) == np.dtype(dtype)
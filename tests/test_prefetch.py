@@ -0,0 +1,119 @@
+import hashlib
+import os
+import random
+from typing import List, Optional, Tuple
+
+import pytest
+
+import fileCache
+import prefetch
+import storage
+from storage import FileInfo, StorageBackend
+
+RANGE_SIZE = 1000
+CHUNK_SIZE = 250
+
+class FlakyStorage(StorageBackend):
+    """One file in memory; reads starting inside failRange raise once failures runs out."""
+
+    def __init__(self, data: bytes):
+        self.data = data
+        self.reads: List[Tuple[int, int]] = []
+        self.failRange: Optional[Tuple[int, int]] = None
+        self.failAfter = 0
+        self.error: Exception = PermissionError('storage is down')
+
+    def read(self, fileId: str, start: int = 0, end: Optional[int] = None) -> bytes:
+        end = len(self.data) if end is None else end
+        if self.failRange is not None and self.failRange[0] <= start < self.failRange[1]:
+            if self.failAfter == 0:
+                self.failRange = None
+                raise self.error
+            self.failAfter -= 1
+        self.reads.append((start, end))
+        return self.data[start:end]
+
+@pytest.fixture
+def rangedDownloads(monkeypatch):
+    monkeypatch.setattr(prefetch.settings, 'PARALLEL_DOWNLOAD_MIN_SIZE', 0)
+    monkeypatch.setattr(prefetch.settings, 'DOWNLOAD_CONNECTIONS', 4)
+    monkeypatch.setattr(prefetch.settings, 'DOWNLOAD_RANGE_SIZE', RANGE_SIZE)
+    monkeypatch.setattr(prefetch.settings, 'STREAM_CHUNK_SIZE', CHUNK_SIZE)
+    # the test files are not below static/cache, nothing to account or evict
+    monkeypatch.setattr(fileCache, 'recordWrite', lambda numBytes: None)
+    # no backoff between retries
+    monkeypatch.setattr(storage.time, 'sleep', lambda seconds: None)
+
+def fileInfoOf(data: bytes) -> FileInfo:
+    return FileInfo(id='file', name='massOverTime.pb', isFolder=False, size=len(data), modifiedTime=0.0,
+        md5Checksum=hashlib.md5(data).hexdigest(), parents=[], owner='')
+
+def randomData(size: int) -> bytes:
+    return random.Random(size).getrandbits(8 * size).to_bytes(size, 'little')
+
+def testFailedRangeResumesWhereItStopped(tmp_path, rangedDownloads):
+    data = randomData(4500)
+    backend = FlakyStorage(data)
+    fileInfo = fileInfoOf(data)
+    path = str(tmp_path / 'massOverTime.pb')
+    # range 2 gets two chunks in, then fails for good
+    backend.failRange = (2000, 3000)
+    backend.failAfter = 2
+    with pytest.raises(PermissionError):
+        prefetch.download(backend, fileInfo, path)
+    assert not os.path.exists(path)
+    partPath = prefetch.partialPath(path)
+    assert os.path.exists(prefetch.progressPath(partPath))
+
+    backend.reads = []
+    assert prefetch.download(backend, fileInfo, path) == 'downloaded'
+    # only the rest of the failed range is fetched again
+    assert backend.reads == [(2500, 2750), (2750, 3000)]
+    with open(path, 'rb') as f:
+        assert f.read() == data
+    assert not os.path.exists(partPath)
+    assert not os.path.exists(prefetch.progressPath(partPath))
+    assert fileCache.readMeta(path)['md5Checksum'] == fileInfo.md5Checksum
+
+def testTransientErrorsAreRetriedWithinTheDownload(tmp_path, rangedDownloads):
+    data = randomData(3000)
+    backend = FlakyStorage(data)
+    backend.failRange = (1000, 2000)
+    backend.error = ConnectionError('connection reset')
+    path = str(tmp_path / 'massOverTime.pb')
+    assert prefetch.download(backend, fileInfoOf(data), path) == 'downloaded'
+    with open(path, 'rb') as f:
+        assert f.read() == data
+
+def testProgressOfAnotherVersionIsDiscarded(tmp_path, rangedDownloads):
+    data = randomData(3000)
+    backend = FlakyStorage(data)
+    backend.failRange = (1000, 2000)
+    path = str(tmp_path / 'massOverTime.pb')
+    with pytest.raises(PermissionError):
+        prefetch.download(backend, fileInfoOf(data), path)
+
+    changed = randomData(3001)
+    backend.data = changed
+    backend.reads = []
+    prefetch.download(backend, fileInfoOf(changed), path)
+    assert sorted(start for start, _ in backend.reads) == list(range(0, 3001, CHUNK_SIZE))
+    with open(path, 'rb') as f:
+        assert f.read() == changed
+
+def testStaleSizeFailsWithoutRetrying(tmp_path, rangedDownloads):
+    data = randomData(3000)
+    backend = FlakyStorage(data)
+    stale = fileInfoOf(data)._replace(size=3500, md5Checksum=None)
+    with pytest.raises(ValueError):
+        prefetch.download(backend, stale, str(tmp_path / 'massOverTime.pb'))
+    # a retry would read the short last range again
+    assert len(backend.reads) == len(set(backend.reads))
+
+def testReplacingACachedFileReplacesItsValidators(tmp_path, rangedDownloads):
+    path = str(tmp_path / 'massOverTime.pb')
+    old = randomData(2000)
+    prefetch.download(FlakyStorage(old), fileInfoOf(old), path)
+    new = randomData(1500)
+    prefetch.download(FlakyStorage(new), fileInfoOf(new), path)
+    assert fileCache.readMeta(path)['size'] == 1500
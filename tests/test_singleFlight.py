@@ -0,0 +1,66 @@
+import threading
+import time
+
+from singleFlight import SingleFlightGroup
+
+def testWaiterGetsTheFlightAfterRelease(tmp_path):
+    group = SingleFlightGroup(str(tmp_path))
+    flight = group.acquire('file', timeout=5)
+    fetched = []
+    seen = []
+
+    def waiter():
+        with group.acquire('file', timeout=5):
+            # what the holder fetched is visible once the flight is ours
+            seen.append(list(fetched))
+
+    thread = threading.Thread(target=waiter)
+    thread.start()
+    time.sleep(0.1)
+    assert seen == []
+    fetched.append('done')
+    flight.release()
+    thread.join(5)
+    assert seen == [['done']]
+    assert group._keys == {}
+
+def testOtherKeysDoNotWait(tmp_path):
+    group = SingleFlightGroup(str(tmp_path))
+    # keys sharing a lock stripe do wait for each other
+    assert group.lockPath('a') != group.lockPath('b')
+    with group.acquire('a', timeout=5):
+        start = time.time()
+        other = group.acquire('b', timeout=5)
+        assert other is not None and time.time() - start < 1
+        other.release()
+
+def testAcquireTimesOutWhileHeldInThisProcess(tmp_path):
+    group = SingleFlightGroup(str(tmp_path))
+    flight = group.acquire('file', timeout=5)
+    start = time.time()
+    assert group.acquire('file', timeout=0.2) is None
+    assert 0.15 < time.time() - start < 2
+    flight.release()
+    # the timed out waiter left no bookkeeping behind
+    assert group._keys == {}
+    assert group.acquire('file', timeout=0.2) is not None
+
+def testAcquireTimesOutWhileHeldByAnotherProcess(tmp_path):
+    # a second group opens the lock file on its own, as another gunicorn worker would
+    group = SingleFlightGroup(str(tmp_path))
+    otherProcess = SingleFlightGroup(str(tmp_path))
+    flight = otherProcess.acquire('file', timeout=5)
+    assert group.acquire('file', timeout=0.2) is None
+    assert group._keys == {}
+    flight.release()
+    second = group.acquire('file', timeout=1)
+    assert second is not None
+    second.release()
+
+def testReleaseIsIdempotent(tmp_path):
+    group = SingleFlightGroup(str(tmp_path))
+    flight = group.acquire('file', timeout=5)
+    flight.release()
+    flight.release()
+    with group.acquire('file', timeout=0.2) as again:
+        assert again is not None
@@ -0,0 +1,143 @@
+"""
+Downscaled copies of cached image bundles (D{i}.jpg), for previews that do not
+need every pixel. Each scale in THUMBNAIL_SCALES is stored next to the bundle as
+D{i}.s{scale}.jpg, and as D{i}.s{scale}.webp when THUMBNAIL_FORMATS has webp, and is
+width / scale by height / scale pixels, so a tile of the bundle is
+tileWidth / scale by tileHeight / scale.
+
+Bundles are decoded and resized in a pool of THUMBNAIL_WORKERS processes (spawned,
+not forked, so they do not inherit gevent), once for all missing scales, as soon
+as a bundle enters the cache. A thumbnail is current if it is newer than its bundle.
+"""
+import io
+import multiprocessing
+import os
+import re
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, List, Optional, Tuple
+
+from PIL import Image
+
+import fileCache
+import settings
+
+BUNDLE_PATTERN = re.compile(r'^D\d+\.jpg$')
+EXTENSIONS = {'jpeg': '.jpg', 'webp': '.webp'}
+MIMETYPES = {'jpeg': 'image/jpeg', 'webp': 'image/webp'}
+
+_lock = threading.Lock()
+_processes: Optional[ProcessPoolExecutor] = None
+# feeds the process pool and writes what it returns
+_threads = ThreadPoolExecutor(max_workers=settings.THUMBNAIL_WORKERS)
+# bundle path -> its generation in progress
+_pending: Dict[str, Future] = {}
+
+def scales() -> List[int]:
+    return [int(scale) for scale in settings.THUMBNAIL_SCALES.split(',') if scale.strip() != '']
+
+def formats() -> List[str]:
+    '''Configured formats, JPEG always, as every client can show it.'''
+    configured = [format.strip() for format in settings.THUMBNAIL_FORMATS.split(',')]
+    return [format for format in EXTENSIONS if format == 'jpeg' or format in configured]
+
+def isBundle(path: str) -> bool:
+    return BUNDLE_PATTERN.match(os.path.basename(path)) is not None
+
+def thumbnailPath(path: str, scale: int, format: str) -> str:
+    return os.path.splitext(path)[0] + '.s{}{}'.format(scale, EXTENSIONS[format])
+
+def freshThumbnail(path: str, scale: int, format: str) -> Optional[str]:
+    thumbnail = thumbnailPath(path, scale, format)
+    try:
+        return thumbnail if os.path.getmtime(thumbnail) >= os.path.getmtime(path) else None
+    except OSError:
+        return None
+
+def schedule(path: str) -> Optional[Future]:
+    '''Queues making the missing thumbnails of a cached bundle; the future of that, None if there are none to make.'''
+    if not isBundle(path):
+        return None
+    missing = [(scale, format) for scale in scales() for format in formats() if freshThumbnail(path, scale, format) is None]
+    if len(missing) == 0:
+        return None
+    with _lock:
+        future = _pending.get(path, None)
+        if future is None:
+            future = _threads.submit(generate, path, missing)
+            _pending[path] = future
+            future.add_done_callback(lambda done: finished(path, done))
+    return future
+
+def ensure(path: str, scale: int, format: str) -> str:
+    '''Path of the current thumbnail of a cached bundle, made first if need be.'''
+    thumbnail = freshThumbnail(path, scale, format)
+    if thumbnail is not None:
+        return thumbnail
+    future = schedule(path)
+    if future is not None:
+        # raises whatever making it raised
+        future.result(timeout=settings.SINGLE_FLIGHT_TIMEOUT)
+    thumbnail = freshThumbnail(path, scale, format)
+    if thumbnail is None:
+        raise RuntimeError('no thumbnail made for ' + path)
+    return thumbnail
+
+def finished(path: str, future: Future) -> None:
+    with _lock:
+        if _pending.get(path, None) is future:
+            del _pending[path]
+    # scheduled in the background, nobody may be waiting for the result
+    if not future.cancelled() and future.exception() is not None:
+        print('ERROR: Failed to make thumbnails', path, future.exception())
+
+def generate(path: str, thumbnails: List[Tuple[int, str]]) -> None:
+    sourceStat = os.stat(path)
+    pool = processPool()
+    try:
+        images = pool.submit(render, path, thumbnails, settings.THUMBNAIL_QUALITY).result()
+    except BrokenProcessPool:
+        # a worker died (killed for memory, say), the next bundle gets a new pool
+        discardProcessPool(pool)
+        raise
+    for (scale, format), data in zip(thumbnails, images):
+        fileCache.writeAtomic(thumbnailPath(path, scale, format), data)
+    currentStat = os.stat(path)
+    if (currentStat.st_mtime, currentStat.st_size) != (sourceStat.st_mtime, sourceStat.st_size):
+        # replaced while we were reading it, the thumbnails are newer than the bundle but of its old version
+        for scale, format in thumbnails:
+            try:
+                os.remove(thumbnailPath(path, scale, format))
+            except OSError:
+                pass
+
+def processPool() -> ProcessPoolExecutor:
+    global _processes
+    with _lock:
+        # created on first use, after gunicorn forked its workers
+        if _processes is None:
+            _processes = ProcessPoolExecutor(max_workers=settings.THUMBNAIL_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+        return _processes
+
+def discardProcessPool(pool: ProcessPoolExecutor) -> None:
+    global _processes
+    with _lock:
+        if _processes is pool:
+            _processes = None
+    pool.shutdown(wait=False)
+
+def render(path: str, thumbnails: List[Tuple[int, str]], quality: int) -> List[bytes]:
+    '''Runs in the process pool: the encoded thumbnails, decoding the bundle once.'''
+    images = []
+    with Image.open(path) as image:
+        image.load()
+        for scale, format in thumbnails:
+            size = (max(1, round(image.width / scale)), max(1, round(image.height / scale)))
+            thumbnail = image.resize(size, Image.LANCZOS)
+            if format == 'webp' and thumbnail.mode not in ('RGB', 'RGBA'):
+                thumbnail = thumbnail.convert('RGB')
+            output = io.BytesIO()
+            thumbnail.save(output, format=format.upper(), quality=quality)
+            images.append(output.getvalue())
+    return images